@@ -1,73 +1,83 @@
 import os
-import json
-import pandas as pd
-from pandas import json_normalize
-
-REMOVE_COLUMNS = {"products", "activityControls"}
-
-def simplify_column_names(columns):
-    """Keep only the lowest-level key from dot-separated column names."""
-    return [col.split('.')[-1] for col in columns]
-
-def preprocess_json(obj):
-    """
-    Recursively walk through the object.
-    - Convert list of one element to the element itself.
-    """
-    if isinstance(obj, list):
-        if len(obj) == 1:
-            return preprocess_json(obj[0])
-        return [preprocess_json(item) for item in obj]
-    elif isinstance(obj, dict):
-        return {k: preprocess_json(v) for k, v in obj.items()}
-    else:
-        return obj
-
-def flatten_json_to_dataframe(json_data):
-    """Flatten nested JSON into a pandas DataFrame with simplified columns."""
-    json_data = preprocess_json(json_data)
-
-    if isinstance(json_data, dict):
-        data_to_normalize = [json_data]
-    elif isinstance(json_data, list):
-        data_to_normalize = json_data
-    else:
-        raise ValueError("Unsupported JSON format: must be a dict or list")
-
-    df = json_normalize(data_to_normalize)
-
-    # Simplify column names
-    df.columns = simplify_column_names(df.columns)
-
-    # Drop unwanted columns if present
-    columns_to_drop = [col for col in df.columns if col in REMOVE_COLUMNS]
-    df.drop(columns=columns_to_drop, inplace=True, errors='ignore')
-
-    return df
-
-def convert_json_files_in_dir(directory):
-    for filename in os.listdir(directory):
-        if filename.lower().endswith('.json'):
-            base_name = os.path.splitext(filename)[0]
-            print(f"Processing: {filename}")
-
-            try:
-                with open(os.path.join(directory, filename), 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-
-                df = flatten_json_to_dataframe(data)
-
-                tsv_path = os.path.join(directory, f"{base_name}.tsv")
-                # df.to_csv(tsv_path, sep='\t', index=False)
-
-                xlsx_path = os.path.join(directory, f"{base_name}.xlsx")
-                df.to_excel(xlsx_path, index=False, engine='openpyxl')
-
-                print(f"Saved: {tsv_path} and {xlsx_path}")
-
-            except Exception as e:
-                print(f"Error processing {filename}: {e}")
+import sys
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from store import STORE_EXT, read_frame, export_xlsx
+from profiling import trace_from_env
+from ingest import CHUNK_SIZE, WORKERS, account_prefix, convert_json_file, convert_zip_member, map_files, takeout_jobs
+
+# Also write an .xlsx copy next to each converted file
+EXPORT_XLSX = False
+
+# Read the JSON incrementally and write fixed-size chunks, keeping memory flat
+STREAMING = True
+
+def report(name, output_path, rows, error):
+    if error is not None:
+        print(f"Error processing {name}: {error}")
+        return
+
+    print(f"Saved: {output_path} ({rows} rows)")
+
+    if EXPORT_XLSX:
+        xlsx_path = os.path.splitext(output_path)[0] + ".xlsx"
+        export_xlsx(read_frame(output_path), xlsx_path)
+        print(f"Exported: {xlsx_path}")
+
+def convert_json_files_in_dir(directory, streaming=STREAMING, chunk_size=CHUNK_SIZE, workers=WORKERS):
+    filenames = sorted(f for f in os.listdir(directory) if f.lower().endswith('.json'))
+    jobs = []
+    for filename in filenames:
+        base_name = os.path.splitext(filename)[0]
+        print(f"Processing: {filename}")
+        src = os.path.join(directory, filename)
+        dst = os.path.join(directory, f"{base_name}{STORE_EXT}")
+        jobs.append((src, dst, streaming, chunk_size, account_prefix(filename)))
+
+    # Files are converted in parallel, results are reported in file order
+    for (src, output_path, *_), rows, error in map_files(convert_json_file, jobs, workers):
+        report(os.path.basename(src), output_path, rows, error)
+
+def convert_zip_files_in_dir(directory, streaming=STREAMING, chunk_size=CHUNK_SIZE, workers=WORKERS):
+    # History files are streamed straight out of each Takeout archive, nothing is extracted
+    archives = sorted(f for f in os.listdir(directory) if f.lower().endswith('.zip'))
+    found = []
+    for filename in archives:
+        archive = os.path.join(directory, filename)
+        try:
+            members = takeout_jobs(archive)
+        except Exception as e:
+            print(f"Error processing {filename}: {e}")
+            continue
+        found.extend((archive, member, kind, source) for member, kind, source in members)
+
+    # Members of one account and kind (e.g. two exports in one archive) are numbered,
+    # "AB-1 watch-history.parquet", "AB-2 ...", so none overwrites another
+    counts = Counter((source, kind) for _, _, kind, source in found)
+    numbered = Counter()
+    jobs, destinations = [], {}
+    for archive, member, kind, source in found:
+        name = f"{os.path.basename(archive)}/{member}"
+        print(f"Processing: {name}")
+        prefix = source
+        if counts[source, kind] > 1:
+            numbered[source, kind] += 1
+            prefix = f"{source}-{numbered[source, kind]}"
+        # "<account> watch-history.parquet", the same name a prefixed and copied file gets
+        dst = os.path.join(directory, f"{prefix} {os.path.splitext(kind)[0]}{STORE_EXT}")
+        # Compared case-insensitively, as on Windows and macOS file systems
+        if dst.lower() in destinations:
+            raise ValueError(f"{name} and {destinations[dst.lower()]} would both be written to {dst}")
+        destinations[dst.lower()] = name
+        jobs.append((archive, member, dst, streaming, chunk_size, source))
+
+    for (archive, member, output_path, *_), rows, error in map_files(convert_zip_member, jobs, workers):
+        report(f"{os.path.basename(archive)}/{member}", output_path, rows, error)
 
 if __name__ == "__main__":
     root = os.path.dirname(os.path.abspath(__file__))
-    convert_json_files_in_dir(root)
+    # Set PIPELINE_TRACE=trace.json to record stage timings
+    with trace_from_env("3_json_to_xlsx"):
+        convert_json_files_in_dir(root)
+        convert_zip_files_in_dir(root)
@@ -1,90 +1,103 @@
 import os
-import pandas as pd
-from datetime import timedelta
+import sys
+import numpy as np
 
-import warnings
-warnings.filterwarnings('ignore', category=pd.errors.SettingWithCopyWarning)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from store import STORE_EXT, concat_frames, read_frame, write_frame, export_xlsx, index_path, read_index, write_index
+from profiling import stage, trace_from_env
+from ingest import WORKERS, dedup_masks, file_event_hashes, map_files, sorted_unique
+from utils_1 import TIMEZONE, load_and_clean_file
+from search_index import read_search_index, update_search_index, write_search_index
 
-# Time offset (5 hours, 30 minutes)
-# YouTube Timestamps are in +00:00
-TIME_OFFSET = timedelta(hours=5, minutes=30)
+# Also write an .xlsx copy of the combined files
+EXPORT_XLSX = False
 
-def clean_dataframe(df):
+# Keep the keys of merged events next to the output and only append events not seen
+# before, so a re-run with one new export skips cleaning everything already merged
+KNOWN_EVENTS = False
 
-    # 1. Remove rows where 'name' or 'name.1' contains "Google Ads"
-    for col in ['name', 'name.1']:
-        if col in df.columns:
-            df = df[~df[col].str.contains('Google Ads', na=False)]
+def combine_xlsx_files_to_one(directory, type, output_suffix='joined', workers=WORKERS, known_events=KNOWN_EVENTS):
+    output_file = os.path.join(directory, f'{type}-{output_suffix}{STORE_EXT}')
+    jobs = []
 
-    # 2. Remove rows where 'titleUrl' is empty or null
-    df = df[df['titleUrl'].notna() & (df['titleUrl'].str.strip() != '')]
-
-    # 3. Remove rows where 'titleUrl' contains 'www.google.com'
-    df = df[~df['titleUrl'].str.contains('www.google.com', na=False)]
-
-    # 4. Drop 'subtitles' and 'name.1' if both exist and are fully empty
-    empty_cols = []
-    for col in ['subtitles', 'name.1', 'description']:
-        if col in df.columns and df[col].isna().all():
-            empty_cols.append(col)
-    if empty_cols:
-        df.drop(columns=empty_cols, inplace=True)
-    
-    return df
-
-def format_dataframe(df, search=False):
-    
-    # 1. Replace "//music." with "//www." in title and titleUrl
-    df['title'] = df['title'].str.replace('//music.', '//www.', regex=False)
-    df['titleUrl'] = df['titleUrl'].str.replace('//music.', '//www.', regex=False)
-
-    # 2. Drop rows where name is "From Google Ads"
-    df = df[df['name'] != 'From Google Ads']
-
-    # 3. Remove starting "Watched " from title
-    df['title'] = df['title'].str.removeprefix('Watched ')
-
-    if search:
-        df['title'] = df['title'].str.removeprefix('Searched for ')
-        df.drop(columns=[col for col in ['titleUrl', 'name', 'description'] if col in df.columns], inplace=True)
-
-    # 4. Convert time column to datetime
-    df['time'] = pd.to_datetime(df['time'].str.slice(0, 19), format='%Y-%m-%dT%H:%M:%S', errors='coerce') + TIME_OFFSET
-    df['time'] = df['time'].dt.strftime('%Y-%m-%d %H:%M:%S')
-
-    return df
-
-def combine_xlsx_files_to_one(directory, type, output_suffix='joined'):
-    output_file = os.path.join(directory, f'{type}-{output_suffix}.xlsx')
-    all_dfs = []
-
-    for filename in os.listdir(directory):
-        if filename.lower().endswith(f'{type}.xlsx') and filename != os.path.basename(output_file):
+    for filename in sorted(os.listdir(directory)):
+        if filename.lower().endswith(f'{type}{STORE_EXT}') and filename != os.path.basename(output_file):
             filepath = os.path.join(directory, filename)
-            if not os.path.isfile(filepath):
+            if not os.path.exists(filepath):
                 continue
             print(f"Reading: {filename}")
-            try:
-                df = pd.read_excel(filepath, engine='openpyxl')
-                all_dfs.append(df)
-            except Exception as e:
-                print(f"Skipping {filename} due to error: {e}")
+            jobs.append((filepath, type == 'search-history'))
+
+    # 1. Hash the events of each file in a worker
+    readable, key_arrays = [], []
+    hashed = map_files(file_event_hashes, [(path,) for path, _ in jobs], workers)
+    for (filepath, search), (_, keys, error) in zip(jobs, hashed):
+        if error is not None:
+            print(f"Skipping {os.path.basename(filepath)} due to error: {error}")
+            continue
+        readable.append((filepath, search))
+        key_arrays.append(keys)
+
+    # 2. Keep each event only in the first file it appears in (and skip known events)
+    keys_path = index_path(output_file)
+    known = read_index(keys_path) if known_events and os.path.exists(output_file) else None
+    masks, all_keys = dedup_masks(key_arrays, known)
+    duplicates = sum(len(keys) for keys in key_arrays) - sum(int(mask.sum()) for mask in masks)
+    if duplicates:
+        print(f"Dropped {duplicates} duplicate events")
+
+    # 3. Only the surviving rows are cleaned, pieces are merged in file order
+    jobs = [(path, search, TIMEZONE, mask) for (path, search), mask in zip(readable, masks) if mask.any()]
+    all_dfs, failed = [], set()
+    for (filepath, *_), df, error in map_files(load_and_clean_file, jobs, workers):
+        if error is not None:
+            print(f"Skipping {os.path.basename(filepath)} due to error: {error}")
+            failed.add(filepath)
+            continue
+        all_dfs.append(df)
+
+    # Events of files that failed to clean were not merged, so they are not recorded as known
+    if failed:
+        merged = [keys[mask] for (path, _), keys, mask in zip(readable, key_arrays, masks) if path not in failed]
+        all_keys = sorted_unique(np.concatenate([np.empty(0, dtype=np.uint64) if known is None else known, *merged]))
+
+    if known is not None:
+        if not all_dfs:
+            print(f"No new events, {output_file} is unchanged.\n")
+            return
+        print(f"Appending {sum(len(df) for df in all_dfs)} new events")
+        all_dfs.insert(0, read_frame(output_file))
 
     if all_dfs:
-        combined_df = pd.concat(all_dfs, ignore_index=True)
-
-        if type == 'watch-history':
-            combined_df = clean_dataframe(combined_df)
-        combined_df = format_dataframe(combined_df, search=(type == 'search-history'))
-        combined_df.sort_values(by='time', ascending=False, inplace=True)
+        with stage("concat and sort", rows_in=sum(len(df) for df in all_dfs)):
+            combined_df = concat_frames(all_dfs)
+            combined_df.sort_values(by='time', ascending=False, inplace=True)
     
-        combined_df.to_excel(output_file, index=False, engine='openpyxl')
+        write_frame(combined_df, output_file)
+        if known_events:
+            write_index(all_keys, keys_path)
+
+        # Titles, channel names and search queries of new events go into the search index
+        index, index_keys = read_search_index(output_file)
+        index, index_keys = update_search_index(combined_df, index, index_keys, search=type == 'search-history')
+        if index is not None:
+            write_search_index(index, index_keys, output_file)
+            print(f"Search index: {len(index)} texts, {len(index.terms)} words")
         
         print(f"\nCombined {len(all_dfs)} files into: {output_file}\n")
+
+        if EXPORT_XLSX:
+            xlsx_file = os.path.join(directory, f'{type}-{output_suffix}.xlsx')
+            export_xlsx(combined_df, xlsx_file)
+            print(f"Exported: {xlsx_file}")
     else:
-        print("No valid .xlsx files found to combine.")
+        print(f"No valid {STORE_EXT} files found to combine.")
 
 if __name__ == "__main__":
     root = os.path.dirname(os.path.abspath(__file__))
-    combine_xlsx_files_to_one(root, 'watch-history')
-    combine_xlsx_files_to_one(root, 'search-history')
+    # Set PIPELINE_TRACE=trace.json to record stage timings
+    with trace_from_env("4_merge_xlsx"):
+        with stage("watch-history"):
+            combine_xlsx_files_to_one(root, 'watch-history')
+        with stage("search-history"):
+            combine_xlsx_files_to_one(root, 'search-history')
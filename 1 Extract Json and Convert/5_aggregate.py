@@ -1,83 +1,56 @@
 import os
-import pandas as pd
-import ast
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from store import STORE_EXT, read_frame, write_frame, export_xlsx, index_path, read_index, write_index
+from utils_2 import read_cubes, update_aggregate, update_cubes, write_cubes
+from profiling import trace_from_env
+
+# Also write an .xlsx copy of the aggregate
+EXPORT_XLSX = False
 
 def clean_and_aggregate(input_dir, file_name, get_year_counts=True):
 
     input_path = os.path.join(input_dir, file_name)
-    output_path = os.path.join(input_dir, 'watch-history-aggregated.xlsx')
+    output_path = os.path.join(input_dir, f'watch-history-aggregated{STORE_EXT}')
 
     if not os.path.isfile(input_path):
         print(f"File not found: {input_path}")
         return
 
     # Read the data
-    df = pd.read_excel(input_path, engine='openpyxl')
-    
-    # Check if aggregate file exists
+    df = read_frame(input_path)
     
+    existing_agg, keys = None, None
+    keys_path = index_path(output_path)
     if os.path.isfile(output_path):
-        # Read existing aggregated data
-        existing_agg = pd.read_excel(output_path, engine='openpyxl')
-        
-        # Safely convert string representation of time_list back to set
-        existing_agg['time_list'] = existing_agg['time_list'].apply(
-            lambda x: ast.literal_eval(x) if isinstance(x, str) else x
-        )
-        
-        # Get all unique timestamps from existing data
-        existing_times = set()
-        for times in existing_agg['time_list']:
-            existing_times.update(times)
-        
-        # Filter df to only include rows with new timestamps
-        df = df[~df['time'].isin(existing_times)]
-        
-        if len(df) == 0:
-            print("\nNo new entries found to update. Aggregate file remains unchanged.\n")
-            return
-        
-        # Create mapping of titleUrl to header from existing aggregate
-        header_mapping = existing_agg.set_index('titleUrl')['header'].to_dict()
-        mask = df['titleUrl'].isin(header_mapping.keys())
-        df.loc[mask, 'header'] = df.loc[mask, 'titleUrl'].map(header_mapping)
-        
-        # Prepare existing data for merging by exploding time_list
-        existing_data = existing_agg.explode('time_list').rename(columns={'time_list': 'time'})
-        existing_data = existing_data[['titleUrl', 'title', 'time', 'header']]  # Keep only necessary columns
-        
-        # Combine with existing data for re-aggregation
-        df = pd.concat([existing_data, df], ignore_index=True)
-
-    # 1. Aggregate by titleUrl
-    grouped = df.groupby('titleUrl').agg({
-        'title': 'first',
-        'time': ['min', 'max', lambda x : len(set(x)), lambda x: set(x)],
-        'header': lambda x: (
-            'YouTube Music' if 'YouTube Music' in x.values
-            else x.mode().iloc[0] if not x.mode().empty
-            else None
-        )
-    }).reset_index()
-
-    # Flatten multi-level columns
-    grouped.columns = ['titleUrl', 'title', 'first_time', 'last_time', 'frequency', 'time_list', 'header']
-
-    # Get the year counts from the original df
-    if get_year_counts:
-        df['year'] = df['time'].str[2:4]  # extract last 2 digits of year
-        year_counts = df.pivot_table(index='titleUrl', columns='year', values='time', aggfunc='count').fillna(0).astype(int)
-        year_counts.columns = [str(y).zfill(2) for y in year_counts.columns]  # e.g. '21', '22'
-
-    grouped = grouped.merge(year_counts, on='titleUrl', how='left')
-    
-    grouped.sort_values(by='first_time', ascending=False, inplace=True)
-    
-    # Save output
-    grouped.to_excel(output_path, index=False, engine='openpyxl')
+        # Read existing aggregated data and its event index
+        existing_agg = read_frame(output_path)
+        keys = read_index(keys_path)
+
+    # Daily/weekly/monthly and weekday x hour counts, from the events missing from the index
+    cubes = update_cubes(df, read_cubes(output_path), keys)
+
+    # Only events missing from the index are aggregated and merged in
+    grouped, keys = update_aggregate(df, existing_agg, keys, get_year_counts)
+    if grouped is not None:
+        # Save output
+        write_frame(grouped, output_path)
+        write_index(keys, keys_path)
+    if cubes is not None:
+        write_cubes(cubes, output_path)
+    if grouped is None:
+        return
 
     print(f"\nAggregated {len(grouped)} rows into: {output_path}\n")
 
+    if EXPORT_XLSX:
+        xlsx_path = os.path.join(input_dir, 'watch-history-aggregated.xlsx')
+        export_xlsx(grouped, xlsx_path)
+        print(f"Exported: {xlsx_path}")
+
 if __name__ == "__main__":
     script_dir = os.path.dirname(os.path.abspath(__file__))
-    clean_and_aggregate(script_dir, "watch-history-joined.xlsx")
+    # Set PIPELINE_TRACE=trace.json to record stage timings
+    with trace_from_env("5_aggregate"):
+        clean_and_aggregate(script_dir, f"watch-history-joined{STORE_EXT}")
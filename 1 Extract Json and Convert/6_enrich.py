@@ -0,0 +1,45 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from store import STORE_EXT, read_frame, write_frame, export_xlsx
+from utils_3 import API_KEY_ENV, MetadataCache, backend_from_env, enrich_videos
+from profiling import trace_from_env
+
+# Also write an .xlsx copy of the enriched aggregate
+EXPORT_XLSX = False
+
+def enrich(input_dir, file_name):
+
+    input_path = os.path.join(input_dir, file_name)
+    output_path = os.path.join(input_dir, f'watch-history-enriched{STORE_EXT}')
+    cache_path = os.path.join(input_dir, 'videos.sqlite')
+
+    if not os.path.isfile(input_path):
+        print(f"File not found: {input_path}")
+        return
+
+    df = read_frame(input_path)
+
+    # Without an API key only metadata already in the cache is added
+    backend = backend_from_env()
+    if backend is None:
+        print(f"{API_KEY_ENV} is not set, using cached video metadata only")
+
+    with MetadataCache(cache_path) as cache:
+        df, stats = enrich_videos(df, cache, backend)
+    print(stats.summary())
+
+    write_frame(df, output_path)
+    print(f"\nEnriched {len(df)} rows into: {output_path}\n")
+
+    if EXPORT_XLSX:
+        xlsx_path = os.path.join(input_dir, 'watch-history-enriched.xlsx')
+        export_xlsx(df, xlsx_path)
+        print(f"Exported: {xlsx_path}")
+
+if __name__ == "__main__":
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    # Set PIPELINE_TRACE=trace.json to record stage timings
+    with trace_from_env("6_enrich"):
+        enrich(script_dir, f"watch-history-aggregated{STORE_EXT}")
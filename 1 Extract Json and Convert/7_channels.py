@@ -0,0 +1,52 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from store import STORE_EXT, read_frame, write_frame, export_xlsx, index_path, read_index, write_index
+from utils_4 import update_channel_rollup
+from profiling import trace_from_env
+
+# Also write an .xlsx copy of the channel rollup
+EXPORT_XLSX = False
+
+def rollup_channels(input_dir):
+
+    # The enriched aggregate if there is one, the plain aggregate otherwise
+    input_path = os.path.join(input_dir, f'watch-history-enriched{STORE_EXT}')
+    if not os.path.exists(input_path):
+        input_path = os.path.join(input_dir, f'watch-history-aggregated{STORE_EXT}')
+    output_path = os.path.join(input_dir, f'watch-history-channels{STORE_EXT}')
+
+    if not os.path.exists(input_path):
+        print(f"File not found: {input_path}")
+        return
+
+    df = read_frame(input_path)
+
+    existing, keys = None, None
+    keys_path = index_path(output_path, "videos")
+    if os.path.isfile(output_path):
+        # Only channels with new views are rolled up again
+        existing = read_frame(output_path)
+        keys = read_index(keys_path)
+
+    rollup, keys = update_channel_rollup(df, existing, keys)
+    if rollup is None:
+        print("\nNo new views found. Channel rollup remains unchanged.\n")
+        return
+
+    write_frame(rollup, output_path)
+    write_index(keys, keys_path)
+
+    print(f"\nRolled up {len(df)} videos into {len(rollup)} channels: {output_path}\n")
+
+    if EXPORT_XLSX:
+        xlsx_path = os.path.join(input_dir, 'watch-history-channels.xlsx')
+        export_xlsx(rollup, xlsx_path)
+        print(f"Exported: {xlsx_path}")
+
+if __name__ == "__main__":
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    # Set PIPELINE_TRACE=trace.json to record stage timings
+    with trace_from_env("7_channels"):
+        rollup_channels(script_dir)
@@ -1,11 +1,18 @@
 import streamlit as st
-import pandas as pd
-import json
 import os
-from datetime import datetime
-from dashboard import show_dashboard  # Assuming dashboard.py exists
-from utils_1 import clean_on_merge
-from utils_2 import aggregate
+import time
+import tempfile
+from datetime import datetime, timedelta
+from dashboard import show_dashboard, show_overview, show_table
+from zoneinfo import available_timezones
+from utils_1 import TIMEZONE, load_and_clean_upload
+from utils_2 import read_cubes, update_aggregate, update_cubes, write_cubes
+from utils_3 import API_KEY_ENV, MetadataCache, backend_from_env, enrich_videos
+from utils_4 import update_channel_rollup
+from search_index import read_search_index, search_paths, update_search_index, write_search_index
+from jobs import ACTIVE, QUEUED, RUNNING, JobRunner, note
+from ingest import WORKERS, drop_duplicate_events, map_files
+from store import EXCEL_MAX_ROWS, EXPORT_FORMATS, STORE_EXT, DiskCache, concat_frames, content_key, date_range, export_columns, export_stream, file_signature, read_frame, write_frame, index_path, read_index, write_index
 
 # Set wide layout
 st.set_page_config(page_title="JSON & Excel Processor", layout="wide")
@@ -14,98 +21,287 @@ OUTPUT_DIR = "output"
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 # Define output file paths at the top
-MERGED_PATH = os.path.join(OUTPUT_DIR, "1_processed.xlsx")
-AGG_PATH = os.path.join(OUTPUT_DIR, "2_aggregated.xlsx")
-ENRICHED_PATH = os.path.join(OUTPUT_DIR, "3_enriched.xlsx")
-ENRICHED_CHANNELS_PATH = os.path.join(OUTPUT_DIR, "4_enriched_channels.xlsx")
+MERGED_PATH = os.path.join(OUTPUT_DIR, "1_processed" + STORE_EXT)
+AGG_PATH = os.path.join(OUTPUT_DIR, "2_aggregated" + STORE_EXT)
+ENRICHED_PATH = os.path.join(OUTPUT_DIR, "3_enriched" + STORE_EXT)
+ENRICHED_CHANNELS_PATH = os.path.join(OUTPUT_DIR, "4_enriched_channels" + STORE_EXT)
+
+# Parsed and cleaned uploads, keyed on file contents, kept across sessions
+PARSE_CACHE_DIR = os.path.join(OUTPUT_DIR, "cache", "uploads")
+PARSE_CACHE_BYTES = 2 << 30
+# Bump when parsing or cleaning changes so stale pieces are not reused
+PARSE_CACHE_VERSION = 2
+
+# Video metadata looked up during enrichment, kept across runs
+VIDEO_CACHE_PATH = os.path.join(OUTPUT_DIR, "cache", "videos.sqlite")
+
+# Seconds between refreshes of the job panel while a job is queued or running
+JOB_POLL_SECONDS = 1.0
+# Most recent jobs listed in the job panel
+SHOWN_JOBS = 5
 
 st.title("JSON & Excel Processor & Viewer with Dashboard")
 
-# Upload multiple JSON or Excel files
+# Local timezone that watch times are converted to
+timezone = st.sidebar.selectbox(
+    "Timezone",
+    sorted(available_timezones()),
+    index=sorted(available_timezones()).index(TIMEZONE)
+)
+
+# Processes used to parse uploaded files in parallel
+workers = st.sidebar.number_input("Worker processes", min_value=1, max_value=64, value=min(WORKERS, 64))
+
+# Optional cProfile of one stage of the next traced run (e.g. "groupby")
+profile_stage = st.sidebar.text_input("Profile stage (cProfile)", value="").strip() or None
+
+# Upload multiple JSON, Excel or Takeout zip files (read without extracting)
 uploaded_files = st.file_uploader(
-    "Upload JSON or Excel files",
-    type=["json", "xlsx", "xls"],
+    "Upload JSON, Excel or Takeout zip files",
+    type=["json", "xlsx", "xls", "zip"],
     accept_multiple_files=True
 )
 
-def merge_uploaded_files(uploaded_files, output_path):
+@st.cache_resource
+def get_parse_cache():
+    return DiskCache(PARSE_CACHE_DIR, PARSE_CACHE_BYTES)
+
+def merge_uploaded_files(uploads, cache, output_path, timezone=TIMEZONE, workers=WORKERS):
+    # `uploads` are (name, contents) pairs, read from the uploader before the job is queued
+    pieces = [None] * len(uploads)
+    keys = [None] * len(uploads)
+    jobs, positions = [], []
+
+    # 1. Reuse pieces of files parsed before with the same contents and settings
+    for i, (name, data) in enumerate(uploads):
+        keys[i] = content_key(data, PARSE_CACHE_VERSION, timezone)
+        pieces[i] = cache.get(keys[i])
+        if pieces[i] is None:
+            jobs.append((name, data, False, timezone))
+            positions.append(i)
+
+    # 2. Parse and clean only new or changed files, in worker processes
+    results = map_files(load_and_clean_upload, jobs, workers)
+    for i, ((name, *_), df, error) in zip(positions, results):
+        if error is not None:
+            note("error", f"Error reading {name}: {error}")
+            continue
+        if not df.empty:
+            cache.put(keys[i], df)
+        pieces[i] = df
+
+    # 3. Merge the pieces in upload order
     all_data = []
-    for file in uploaded_files:
-        try:
-            if file.name.lower().endswith(".json"):
-                data = json.load(file)
-                if isinstance(data, dict):
-                    df = pd.DataFrame([data])
-                elif isinstance(data, list):
-                    df = pd.DataFrame(data)
-                else:
-                    st.warning(f"Skipping file {file.name}: Unsupported JSON structure")
-                    continue
-            else:  # Excel
-                df = pd.read_excel(file)
-            all_data.append(df)
-        except Exception as e:
-            st.error(f"Error reading {file.name}: {e}")
+    for (name, _), df in zip(uploads, pieces):
+        if df is None:
+            continue
+        if df.empty:
+            note("warning", f"Skipping file {name}: No records found")
+            continue
+        all_data.append(df)
     if all_data:
-        final_df = pd.concat(all_data, ignore_index=True)
-        final_df = clean_on_merge(final_df)
-        final_df.to_excel(output_path, index=False)
-        st.success(f"Combined Excel saved: {output_path}")
+        final_df = concat_frames(all_data)
+        # Overlapping exports repeat most events, keep each one once
+        rows = len(final_df)
+        final_df, _ = drop_duplicate_events(final_df)
+        if len(final_df) < rows:
+            note("info", f"Dropped {rows - len(final_df)} duplicate events")
+        write_frame(final_df, output_path)
+        note("success", f"Combined data saved: {output_path}")
+        # Only texts of events not indexed before are added
+        index, keys = read_search_index(output_path)
+        index, keys = update_search_index(final_df, index, keys)
+        if index is not None:
+            write_search_index(index, keys, output_path)
+
+def require(path, message):
+    # Inputs are checked when the step runs, an earlier step of the same job may create them
+    if not os.path.exists(path):
+        raise FileNotFoundError(message)
 
 def placeholder_aggregate(input_path, output_path):
-    df = pd.read_excel(input_path)
-    df_agg = None
-    # if os.path.isfile(output_path):
-    #     df_agg = pd.read_excel(output_path)
-    df_agg = aggregate(df, df_agg)
-    df_agg.to_excel(output_path, index=False)
-
-def placeholder_enrich(input_path, output_path):
-    df = pd.read_excel(input_path)
-    df.to_excel(output_path, index=False)
-
-def placeholder_enrich_channels(input_path, output_path):
-    df = pd.read_excel(input_path)
-    df.to_excel(output_path, index=False)
-
-# Four left-aligned buttons in a single row
+    require(input_path, "Merged file not found. Please process data first.")
+    df = read_frame(input_path)
+    df_agg, keys = None, None
+    keys_path = index_path(output_path)
+    if os.path.isfile(output_path):
+        df_agg = read_frame(output_path)
+        keys = read_index(keys_path)
+    # Cubes count the events missing from the index as it was before this update
+    cubes = update_cubes(df, read_cubes(output_path), keys)
+    df_agg, keys = update_aggregate(df, df_agg, keys)
+    if df_agg is not None:
+        write_frame(df_agg, output_path)
+        write_index(keys, keys_path)
+    # Written after the index, so a failed update never counts events twice
+    if cubes is not None:
+        write_cubes(cubes, output_path)
+    if df_agg is None:
+        note("info", "No new entries found. Aggregate is unchanged.")
+        return False
+    note("success", f"Aggregated data saved: {output_path}")
+    return True
+
+def enrich_data(input_path, output_path):
+    require(input_path, "Aggregated file not found. Please aggregate data first.")
+    df = read_frame(input_path)
+    backend = backend_from_env()
+    if backend is None:
+        note("warning", f"{API_KEY_ENV} is not set, only cached video metadata is used.")
+    with MetadataCache(VIDEO_CACHE_PATH) as cache:
+        df, stats = enrich_videos(df, cache, backend)
+    note("info", stats.summary())
+    write_frame(df, output_path)
+    note("success", f"Enriched data saved: {output_path}")
+
+def enrich_channels(input_path, output_path):
+    require(input_path, "Enriched file not found. Please enrich data first.")
+    df = read_frame(input_path)
+    rollup, keys = None, None
+    keys_path = index_path(output_path, "videos")
+    if os.path.isfile(output_path):
+        rollup = read_frame(output_path)
+        keys = read_index(keys_path)
+    rollup, keys = update_channel_rollup(df, rollup, keys)
+    if rollup is None:
+        note("info", "No new views found. Channel rollup is unchanged.")
+        return
+    write_frame(rollup, output_path)
+    write_index(keys, keys_path)
+    note("success", f"Channel rollup saved: {output_path} ({len(rollup)} channels)")
+
+@st.cache_resource(max_entries=2)
+def load_search_index(path, signature):
+    # Reloaded when the index is rewritten, `signature` only keys the cache
+    return read_search_index(path)[0]
+
+@st.cache_resource
+def get_job_runner():
+    # One runner per server process, so jobs outlive page refreshes
+    return JobRunner()
+
+runner = get_job_runner()
+
+def signature(path):
+    return file_signature(path) if os.path.exists(path) else None
+
+def process_step():
+    uploads = [(file.name, file.getvalue()) for file in uploaded_files]
+    key = ("process", tuple(content_key(data) for _, data in uploads), timezone)
+    return ("Process Data", merge_uploaded_files, (uploads, get_parse_cache(), MERGED_PATH, timezone, workers)), key
+
+def aggregate_step():
+    return ("Aggregate Data", placeholder_aggregate, (MERGED_PATH, AGG_PATH)), ("aggregate", signature(MERGED_PATH))
+
+def enrich_step():
+    return ("Enrich Data", enrich_data, (AGG_PATH, ENRICHED_PATH)), ("enrich", signature(AGG_PATH))
+
+def enrich_channels_step():
+    return ("Enrich Channels", enrich_channels, (ENRICHED_PATH, ENRICHED_CHANNELS_PATH)), ("enrich_channels", signature(ENRICHED_PATH))
+
+def submit(name, steps):
+    # Identical inputs make an identical key, a repeated click joins the queued or running job
+    steps, keys = zip(*steps)
+    job, created = runner.submit(name, steps, keys, profile_stage)
+    if not created:
+        st.info(f"{name} is already {job.status}.")
+
+# Left-aligned buttons in a single row, each queues a background job
 with st.container():
-    cols = st.columns([1, 1, 1, 1, 6])
+    cols = st.columns([1, 1, 1, 1, 1, 5])
     with cols[0]:
         if st.button("Process Data"):
             if uploaded_files:
-                merge_uploaded_files(uploaded_files, MERGED_PATH)
+                submit("Process Data", [process_step()])
             else:
                 st.warning("Please upload files first.")
 
     with cols[1]:
         if st.button("Aggregate Data"):
-            if os.path.exists(MERGED_PATH):
-                placeholder_aggregate(MERGED_PATH, AGG_PATH)
-                st.success(f"Aggregated Excel saved: {AGG_PATH}")
-            else:
-                st.warning("Merged file not found. Please process data first.")
+            submit("Aggregate Data", [aggregate_step()])
 
     with cols[2]:
         if st.button("Enrich Data"):
-            if os.path.exists(AGG_PATH):
-                placeholder_enrich(AGG_PATH, ENRICHED_PATH)
-                st.success(f"Enriched Excel saved: {ENRICHED_PATH}")
-            else:
-                st.warning("Aggregated file not found. Please aggregate data first.")
+            submit("Enrich Data", [enrich_step()])
 
     with cols[3]:
         if st.button("Enrich Channels"):
-            if os.path.exists(ENRICHED_PATH):
-                placeholder_enrich_channels(ENRICHED_PATH, ENRICHED_CHANNELS_PATH)
-                st.success(f"Enriched Channels Excel saved: {ENRICHED_CHANNELS_PATH}")
-            else:
-                st.warning("Enriched file not found. Please enrich data first.")
+            submit("Enrich Channels", [enrich_channels_step()])
+
+    with cols[4]:
+        # Process (when files are uploaded) -> Aggregate -> Enrich -> Enrich Channels as one job
+        if st.button("Run All"):
+            steps = [process_step()] if uploaded_files else []
+            steps += [aggregate_step(), enrich_step(), enrich_channels_step()]
+            submit("Run All", steps)
+
+def show_jobs(watching):
+    jobs = runner.jobs()[:SHOWN_JOBS]
+    if not jobs:
+        return
+    st.subheader("Jobs")
+    for job in jobs:
+        with st.container(border=True):
+            status = "cancelling" if job.status == RUNNING and job.cancelled else job.status
+            took = f" in {job.seconds:.1f} s" if job.seconds is not None and job.status not in ACTIVE else ""
+            st.markdown(f"**{job.name}**: {status}{took}")
+            if job.status in ACTIVE:
+                st.progress(job.fraction, text=job.activity or ("Waiting in queue" if job.status == QUEUED else None))
+                if st.button("Cancel", key=f"cancel-{job.id}", disabled=job.cancelled):
+                    job.cancel()
+            for level, text in job.notes:
+                getattr(st, level)(text)
+            if job.error:
+                st.error(job.error)
+    # Redraw the whole page once the last job finishes so new outputs are listed
+    if watching and not runner.active():
+        st.rerun()
+
+# Polls only while something is queued or running
+watching = bool(runner.active())
+st.fragment(show_jobs, run_every=JOB_POLL_SECONDS if watching else None)(watching)
+
+# Timing of the last job that ran
+trace = next((job.trace for job in runner.jobs() if job.status not in ACTIVE and job.trace is not None), None)
+if trace is not None and trace.stages:
+    total = sum(s.seconds for s in trace.stages if s.depth == 0)
+    with st.expander(f"Timing: {trace.name} ({total:.2f} s)"):
+        st.dataframe(trace.to_frame(), use_container_width=True, hide_index=True)
+        for s in trace.stages:
+            if s.profile:
+                st.text(f"cProfile: {s.name}")
+                st.code(s.profile)
+
+# Parse cache readout, counts are for this server process. Lookups of a
+# running job show up when the page is redrawn after the job finishes
+parse_cache = get_parse_cache()
+if st.sidebar.button("Clear upload cache"):
+    parse_cache.clear()
+st.sidebar.caption(
+    f"Upload cache: {parse_cache.hits} hits, {parse_cache.misses} misses, "
+    f"{len(parse_cache)} files, {parse_cache.nbytes / 2**20:.1f} MB"
+)
+
+# Overview charts come from the small rollup cubes next to the aggregate
+show_overview(AGG_PATH, MERGED_PATH if os.path.exists(MERGED_PATH) else None, timezone)
+
+# Word-prefix search over watched titles and channel names
+search_arrays = search_paths(MERGED_PATH)[1]
+if os.path.exists(search_arrays):
+    st.subheader("🔎 Search History")
+    search_text = st.text_input("Titles and channels containing words starting with", placeholder="e.g. lofi beat")
+    if search_text.strip():
+        index = load_search_index(MERGED_PATH, file_signature(search_arrays))
+        start = time.perf_counter()
+        found = index.search(search_text)
+        seconds = time.perf_counter() - start
+        st.caption(f"{len(index.matches(search_text)):,} of {len(index):,} texts match, top {len(found)} in {seconds * 1000:.1f} ms")
+        st.dataframe(found.assign(last_time=found["last_time"].dt.tz_localize(None)), use_container_width=True, hide_index=True)
 
 # Always show output files
 st.subheader("Available Output Files")
 output_files = sorted(
-    [f for f in os.listdir(OUTPUT_DIR) if f.lower().endswith(".xlsx")],
+    [f for f in os.listdir(OUTPUT_DIR) if f.lower().endswith(STORE_EXT)],
     reverse=True
 )
 
@@ -114,39 +310,49 @@ if output_files:
     file_path = os.path.join(OUTPUT_DIR, selected_file)
 
     try:
-        df_view = pd.read_excel(file_path)
-
-        # Auto-parse potential date columns
-        for col in df_view.columns:
-            if df_view[col].dtype == "object":
-                try:
-                    parsed = pd.to_datetime(df_view[col], errors="coerce")
-                    if parsed.notna().sum() > 0:
-                        df_view[col] = parsed
-                except Exception:
-                    pass
-
-        # Remove timezone information from datetime columns for display
-        for col in df_view.columns:
-            if pd.api.types.is_datetime64_any_dtype(df_view[col]):
-                if df_view[col].dt.tz is not None:
-                    df_view[col] = df_view[col].dt.tz_localize(None)
+        # Only the visible page is read from the file
+        show_table(file_path, timezone)
 
-        st.dataframe(df_view, use_container_width=True, height=700)
-
-        # Show dashboard below
-        show_dashboard(df_view)
+        # Show dashboard below, its charts query the file directly
+        show_dashboard(file_path, timezone)
 
     except Exception as e:
         st.error(f"Error reading {selected_file}: {e}")
 
-    # Download button
-    with open(file_path, "rb") as f:
-        st.download_button(
-            label=f"Download {selected_file}",
-            data=f,
-            file_name=selected_file,
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
+    # Exports are only produced when downloaded, written batch by batch to a temporary file
+    with st.expander(f"Export {selected_file}"):
+        try:
+            all_columns, date_columns = export_columns(file_path)
+            fmt = st.radio("Format", list(EXPORT_FORMATS), horizontal=True)
+            if fmt == ".xlsx":
+                st.caption(f"An Excel sheet holds at most {EXCEL_MAX_ROWS:,} rows; larger exports stop there.")
+            export_cols = st.multiselect("Columns", all_columns, default=all_columns)
+            date_col, start, end = None, None, None
+            if date_columns:
+                date_col = st.selectbox("Limit dates on", [None] + date_columns, format_func=lambda c: "all rows" if c is None else c)
+            if date_col is not None:
+                low, high = date_range(file_path, date_col)
+                if low is not None:
+                    picked = st.date_input("Export dates", value=(low.date(), high.date()), min_value=low.date(), max_value=high.date())
+                    if len(picked) == 2:
+                        # End date is inclusive in the picker, exclusive in the export
+                        start, end = picked[0], picked[1] + timedelta(days=1)
+
+            def build_export():
+                out = tempfile.TemporaryFile()
+                export_stream(file_path, out, fmt, export_cols, date_col, start, end)
+                out.seek(0)
+                return out
+
+            export_name = os.path.splitext(selected_file)[0] + fmt
+            st.download_button(
+                label=f"Download {export_name}",
+                data=build_export,
+                file_name=export_name,
+                mime=EXPORT_FORMATS[fmt],
+                disabled=not export_cols
+            )
+        except Exception as e:
+            st.error(f"Error preparing the export of {selected_file}: {e}")
 else:
-    st.info("No Excel output files found yet.")
+    st.info("No output files found yet.")
@@ -0,0 +1,55 @@
+"""
+Compare object-string and categorical (dictionary-encoded) text columns.
+
+Reports memory of the flattened frame and the time of the filter,
+normalization, hashing and groupby steps on each.
+
+Usage:
+    python benchmarks/bench_categories.py [n_records]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ingest import encode_categories, event_hashes, flatten_takeout_records
+from utils_1 import clean_mask, map_text, to_local_time
+from utils_2 import aggregate_events
+from synthetic import make_watch_records
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+def steps(df):
+    prepared = df.copy()
+    prepared['time'] = to_local_time(prepared['time'])
+    return {
+        "filter": lambda: df.loc[clean_mask(df)],
+        "normalize": lambda: map_text(df['title'], lambda t: t.str.removeprefix('Watched ')),
+        "hash": lambda: event_hashes(df),
+        "aggregate": lambda: aggregate_events(prepared, get_year_counts=True),
+    }
+
+def main(n):
+    plain = flatten_takeout_records(make_watch_records(n))
+    start = time.perf_counter()
+    encoded = encode_categories(plain.copy())
+    encode_time = time.perf_counter() - start
+
+    mb = lambda df: df.memory_usage(deep=True).sum() / 2**20
+    print(f"{n} records")
+    print(f"{'':>10} {'object':>9} {'category':>9} {'factor':>7}")
+    print(f"{'memory MB':>10} {mb(plain):>9.1f} {mb(encoded):>9.1f} {mb(plain) / mb(encoded):>6.1f}x")
+
+    plain_steps, encoded_steps = steps(plain), steps(encoded)
+    for name in plain_steps:
+        a = timed(plain_steps[name])
+        b = timed(encoded_steps[name])
+        print(f"{name + ' s':>10} {a:>9.3f} {b:>9.3f} {a / b:>6.1f}x")
+    print(f"encoding at ingest: {encode_time:.3f} s")
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
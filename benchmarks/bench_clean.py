@@ -0,0 +1,76 @@
+"""
+Compare the fused clean_on_merge with the previous step-by-step cleaning.
+
+Reports wall time and peak traced memory for each version.
+
+Usage:
+    python benchmarks/bench_clean.py [n_records ...]
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+
+from datetime import timedelta
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ingest import flatten_json_to_dataframe
+from utils_1 import clean_on_merge
+from synthetic import make_watch_records
+
+# Fixed offset the legacy chain applied to UTC times
+TIME_OFFSET = timedelta(hours=5, minutes=30)
+
+def legacy_clean_on_merge(df):
+    """The cleaning chain before it was fused: one filtered copy per step, string times."""
+    for col in ['channel_name', 'details']:
+        if col in df.columns:
+            df = df[~df[col].str.contains('Google Ads', na=False)]
+    df = df[df['titleUrl'].notna() & (df['titleUrl'].str.strip() != '')]
+    df = df[~df['titleUrl'].str.contains('www.google.com', na=False)]
+    empty_cols = [col for col in ['subtitles', 'details', 'description'] if col in df.columns and df[col].isna().all()]
+    if empty_cols:
+        df = df.drop(columns=empty_cols)
+
+    df['title'] = df['title'].str.replace('//music.', '//www.', regex=False)
+    df['titleUrl'] = df['titleUrl'].str.replace('//music.', '//www.', regex=False)
+    for col in ['channel_name', 'details']:
+        if col in df.columns:
+            df = df[df[col] != 'From Google Ads']
+    df['title'] = df['title'].str.removeprefix('Watched ')
+    df['time'] = pd.to_datetime(df['time'].str.slice(0, 19), format='%Y-%m-%dT%H:%M:%S', errors='coerce') + TIME_OFFSET
+    df['time'] = df['time'].dt.strftime('%Y-%m-%d %H:%M:%S')
+    return df
+
+def measure(func, df):
+    # Time without tracing, then trace a second run for peak memory
+    start = time.perf_counter()
+    result = func(df.copy())
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    func(df.copy())
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak / 1e6
+
+def main(sizes):
+    print(f"{'records':>10} {'version':>8} {'time (s)':>9} {'peak (MB)':>10}")
+    for n in sizes:
+        df = flatten_json_to_dataframe(make_watch_records(n, ads_share=0.1))
+        # The legacy chain ran on object strings
+        plain = df.astype({col: object for col in df.select_dtypes('category').columns})
+        legacy, legacy_time, legacy_peak = measure(legacy_clean_on_merge, plain)
+        fused, fused_time, fused_peak = measure(clean_on_merge, df)
+        fused_times = fused['time'].dt.strftime('%Y-%m-%d %H:%M:%S')
+        compared = fused[legacy.columns].astype({col: object for col in legacy.columns if col != 'time'})
+        assert legacy.drop(columns='time').reset_index(drop=True).equals(compared.drop(columns='time').reset_index(drop=True))
+        assert (legacy['time'].to_numpy() == fused_times.to_numpy()).all()
+        print(f"{n:>10} {'legacy':>8} {legacy_time:>9.3f} {legacy_peak:>10.1f}")
+        print(f"{n:>10} {'fused':>8} {fused_time:>9.3f} {fused_peak:>10.1f}")
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100_000, 1_000_000]
+    main(sizes)
@@ -0,0 +1,45 @@
+"""
+Merge successive, overlapping exports with and without dedup after ingest.
+
+Each export contains everything in the previous one plus a slice of new
+events, the way repeated Takeout downloads do.
+
+Usage:
+    python benchmarks/bench_dedup.py [n_exports] [records_per_export]
+"""
+
+import os
+import sys
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ingest import dedup_masks, event_hashes, flatten_json_to_dataframe
+from utils_1 import clean_on_merge
+from synthetic import make_watch_records
+
+def merge_concat(frames):
+    # Previous behaviour: clean everything, duplicates included
+    return pd.concat([clean_on_merge(df.copy()) for df in frames], ignore_index=True)
+
+def merge_dedup(frames):
+    masks, _ = dedup_masks([event_hashes(df) for df in frames])
+    return pd.concat([clean_on_merge(df.loc[mask]) for df, mask in zip(frames, masks)], ignore_index=True)
+
+def main(n_exports, records):
+    step = max(1, records // 10)
+    history = make_watch_records(records + step * (n_exports - 1))
+    frames = [flatten_json_to_dataframe(history[:records + step * i]) for i in range(n_exports)]
+    print(f"{n_exports} exports, {sum(map(len, frames))} rows in total")
+
+    for name, merge in [("concat", merge_concat), ("dedup", merge_dedup)]:
+        start = time.perf_counter()
+        df = merge(frames)
+        elapsed = time.perf_counter() - start
+        print(f"{name:>8}: {elapsed:6.2f} s, {len(df)} rows out")
+
+if __name__ == "__main__":
+    n_exports = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    records = int(sys.argv[2]) if len(sys.argv) > 2 else 200_000
+    main(n_exports, records)
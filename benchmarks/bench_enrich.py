@@ -0,0 +1,64 @@
+"""
+Video metadata enrichment against the local stand-in server.
+
+Runs a cold enrichment (every ID fetched) at several concurrency limits,
+then a warm one where every ID is served from the SQLite cache. Latency
+and failure rate of the stand-in are configurable to exercise retries.
+
+Usage:
+    python benchmarks/bench_enrich.py [--videos 20000] [--latency 0.05] [--fail 0.05]
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils_3 import MetadataCache, YouTubeBackend, enrich_videos
+from standin_server import serve
+
+def make_aggregate(videos):
+    urls = [f"https://www.youtube.com/watch?v=v{i:010d}" for i in range(videos)]
+    return pd.DataFrame({"titleUrl": pd.Categorical(urls), "frequency": 1})
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--videos", type=int, default=20_000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--latency", type=float, default=0.05, help="stand-in seconds per response")
+    parser.add_argument("--fail", type=float, default=0.05, help="stand-in share of 429/503 responses")
+    args = parser.parse_args()
+
+    server, url = serve(latency=args.latency, fail=args.fail)
+    df = make_aggregate(args.videos)
+    print(f"{args.videos} videos, {args.latency * 1000:.0f} ms latency, {args.fail:.0%} failures")
+    print(f"{'run':<16} {'time':>8} {'ids/s':>9} {'requests':>9} {'retries':>8} {'failed':>7}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        for concurrency in args.concurrency:
+            path = os.path.join(directory, f"cold-{concurrency}.sqlite")
+            with MetadataCache(path) as cache:
+                backend = YouTubeBackend("standin", url)
+                start = time.perf_counter()
+                enriched, stats = enrich_videos(df, cache, backend, concurrency=concurrency, backoff=0.05)
+                seconds = time.perf_counter() - start
+                print(f"{f'cold x{concurrency}':<16} {seconds:>7.2f}s {stats.ids_per_second or 0:>9.0f} "
+                      f"{stats.requests:>9} {stats.retries:>8} {stats.failed_batches:>7}")
+
+                start = time.perf_counter()
+                again, stats = enrich_videos(df, cache, backend)
+                seconds = time.perf_counter() - start
+                print(f"{'warm (cache)':<16} {seconds:>7.2f}s {args.videos / seconds:>9.0f} "
+                      f"{stats.requests:>9} {stats.retries:>8} {stats.failed_batches:>7}")
+                assert stats.requested == 0
+                assert again["duration_seconds"].equals(enriched["duration_seconds"])
+
+    print(f"\nfound {enriched['duration_seconds'].notna().mean():.1%}, categories: {enriched['category'].nunique()}")
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
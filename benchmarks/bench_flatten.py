@@ -0,0 +1,34 @@
+"""
+Compare the Takeout fast-path flattener with the generic json_normalize flattener.
+
+Usage:
+    python benchmarks/bench_flatten.py [n_records ...]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ingest import flatten_json_generic, flatten_takeout_records
+from synthetic import make_watch_records
+
+def best_of(func, arg, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(arg)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main(sizes):
+    print(f"{'records':>10} {'generic (s)':>12} {'fast (s)':>10} {'speedup':>8}")
+    for n in sizes:
+        records = make_watch_records(n)
+        generic = best_of(flatten_json_generic, records)
+        fast = best_of(flatten_takeout_records, records)
+        print(f"{n:>10} {generic:>12.3f} {fast:>10.3f} {generic / fast:>7.1f}x")
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10_000, 100_000, 500_000]
+    main(sizes)
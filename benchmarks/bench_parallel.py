@@ -0,0 +1,50 @@
+"""
+Time multi-file ingest (convert + clean) with different worker counts.
+
+Usage:
+    python benchmarks/bench_parallel.py [n_files] [records_per_file]
+"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ingest import WORKERS, convert_json_file, map_files
+from utils_1 import load_and_clean_file
+from synthetic import make_watch_records
+
+def ingest(paths, workers):
+    jobs = [(path, os.path.splitext(path)[0] + '.parquet') for path in paths]
+    for _, _, error in map_files(convert_json_file, jobs, workers):
+        assert error is None, error
+    jobs = [(dst, False) for _, dst in jobs]
+    for _, _, error in map_files(load_and_clean_file, jobs, workers):
+        assert error is None, error
+
+def main(n_files, records):
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for i in range(n_files):
+            path = os.path.join(directory, f"A{i:02d} watch-history.json")
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(make_watch_records(records, seed=i), f)
+            paths.append(path)
+
+        counts = sorted({1, 2, 4, WORKERS} - {0})
+        baseline = None
+        print(f"{n_files} files x {records} records, {os.cpu_count()} CPUs")
+        print(f"{'workers':>8} {'time (s)':>9} {'speedup':>8}")
+        for workers in counts:
+            start = time.perf_counter()
+            ingest(paths, workers)
+            elapsed = time.perf_counter() - start
+            baseline = baseline or elapsed
+            print(f"{workers:>8} {elapsed:>9.2f} {baseline / elapsed:>7.2f}x")
+
+if __name__ == "__main__":
+    n_files = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    records = int(sys.argv[2]) if len(sys.argv) > 2 else 50_000
+    main(n_files, records)
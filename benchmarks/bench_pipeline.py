@@ -0,0 +1,199 @@
+"""
+Time and memory-profile each pipeline stage on synthetic Takeout exports.
+
+Generates watch/search history for several accounts at each scale, then runs
+the stages one by one: streaming parse, flatten, dedup, clean, aggregate,
+the Parquet and Excel writers, and the viewer's page queries (first, last and sorted page).
+Each stage is timed once and then run again under tracemalloc for its peak
+Python-side allocation (Arrow buffers are not included).
+
+Results are written as JSON so runs on different versions can be compared:
+
+    python benchmarks/bench_pipeline.py --events 10000 100000 --output before.json
+    python benchmarks/bench_pipeline.py --events 10000 100000 --output after.json --compare before.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import tempfile
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from ingest import drop_duplicate_events, flatten_json_to_dataframe, read_json_file
+from store import EXCEL_MAX_ROWS, concat_frames, export_xlsx, read_frame, write_frame
+from query import PAGE_ROWS, column_kinds, columns, connect, count_rows, page_query, run, table_name
+from utils_1 import clean_on_merge
+from utils_2 import aggregate
+from synthetic import write_takeout
+
+# Progress goes to stderr so JSON on stdout stays machine-readable
+def log(*args):
+    print(*args, file=sys.stderr)
+
+def _commit():
+    try:
+        out = subprocess.run(["git", "-C", ROOT, "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=10)
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def environment():
+    return {
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "pyarrow": pa.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+def _rows(result):
+    if isinstance(result, pd.DataFrame):
+        return len(result)
+    if isinstance(result, (list, tuple)) and result and isinstance(result[0], pd.DataFrame):
+        return sum(len(df) for df in result)
+    return None
+
+def measure(func, memory=True):
+    """Run `func` for time, then again under tracemalloc. Returns (result, seconds, peak MB)."""
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    peak = None
+    if memory:
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+def run_scale(directory, events, accounts, excel_rows, memory, seed):
+    paths = write_takeout(directory, events, accounts=accounts, seed=seed)
+    watch_paths = [p for p in paths if p.endswith("watch-history.json")]
+    search_paths = [p for p in paths if p.endswith("search-history.json")]
+    input_mb = sum(os.path.getsize(p) for p in paths) / 2**20
+
+    def load_records(path):
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+
+    watch_records = [load_records(p) for p in watch_paths]
+    results = []
+
+    def stage(name, func, memory=memory):
+        result, seconds, peak = measure(func, memory)
+        results.append({
+            "events": events, "stage": name, "seconds": round(seconds, 4),
+            "peak_mb": None if peak is None else round(peak, 1), "rows": _rows(result),
+        })
+        log(f"{events:>9} {name:<16} {seconds:>9.3f} s {'' if peak is None else f'{peak:>9.1f} MB'}")
+        return result
+
+    def parse_stream():
+        frames = []
+        for path in watch_paths:
+            with open(path, 'rb') as f:
+                frames.append(read_json_file(f))
+        return frames
+
+    stage("parse_stream", parse_stream)
+    frames = stage("flatten", lambda: [flatten_json_to_dataframe(r) for r in watch_records])
+    merged = stage("dedup", lambda: drop_duplicate_events(concat_frames(frames))[0])
+    clean = stage("clean", lambda: clean_on_merge(merged.copy()))
+
+    search = [flatten_json_to_dataframe(load_records(p)) for p in search_paths]
+    stage("clean_search", lambda: clean_on_merge(concat_frames(search), search=True))
+
+    agg = stage("aggregate", lambda: aggregate(clean.copy()))
+
+    merged_path = os.path.join(directory, "1_processed.parquet")
+
+    def write_parquet():
+        write_frame(clean, merged_path)
+        write_frame(agg, os.path.join(directory, "2_aggregated.parquet"))
+
+    stage("write_parquet", write_parquet)
+
+    limit = min(excel_rows, EXCEL_MAX_ROWS)
+    if limit > 0:
+        xlsx_path = os.path.join(directory, "1_processed.xlsx")
+        stage("export_xlsx", lambda: export_xlsx(clean.head(limit), xlsx_path))
+
+    stage("read_parquet", lambda: read_frame(merged_path))
+
+    # Viewer path: the app queries one page of the file at a time
+    agg_path = os.path.join(directory, "2_aggregated.parquet")
+
+    def view_page(path, last=False, order=None):
+        con = connect(paths=[path])
+        table = table_name(path)
+        try:
+            kinds = column_kinds(con, table)
+            cols = [c for c, _ in columns(con, table) if c not in kinds["list"]]
+            offset = max(0, count_rows(con, table) - PAGE_ROWS) if last else 0
+            return run(con, page_query(table, cols, "", order, True, PAGE_ROWS, offset, lengths=kinds["list"]))
+        finally:
+            con.close()
+
+    stage("view_page_first", lambda: view_page(merged_path))
+    stage("view_page_last", lambda: view_page(merged_path, last=True))
+    stage("view_page_sorted", lambda: view_page(agg_path, order="frequency"))
+
+    return results, input_mb
+
+def compare(results, baseline):
+    """Print time and memory ratios against a previous run (current / baseline)."""
+    before = {(r["events"], r["stage"]): r for r in baseline["results"]}
+    log(f"\nvs {baseline['environment'].get('commit')}:")
+    log(f"{'events':>9} {'stage':<16} {'time':>8} {'memory':>8}")
+    for r in results:
+        b = before.get((r["events"], r["stage"]))
+        if b is None:
+            continue
+        t = r["seconds"] / b["seconds"] if b["seconds"] else float('nan')
+        m = r["peak_mb"] / b["peak_mb"] if r["peak_mb"] and b["peak_mb"] else float('nan')
+        log(f"{r['events']:>9} {r['stage']:<16} {t:>7.2f}x {m:>7.2f}x")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, nargs="+", default=[10_000, 100_000], help="total events per scale (10k to 5M)")
+    parser.add_argument("--accounts", type=int, default=3, help="accounts (file pairs) per scale")
+    parser.add_argument("--excel-rows", type=int, default=100_000, help="rows to export to Excel, 0 skips the stage")
+    parser.add_argument("--no-memory", action="store_true", help="skip the traced run of each stage")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results as JSON to this file (default: stdout)")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare against")
+    args = parser.parse_args()
+
+    report = {"environment": environment(), "params": vars(args), "inputs": [], "results": []}
+    log(f"{'events':>9} {'stage':<16} {'time':>11} {'peak':>12}")
+    for events in args.events:
+        with tempfile.TemporaryDirectory() as directory:
+            results, input_mb = run_scale(directory, events, args.accounts, args.excel_rows, not args.no_memory, args.seed)
+        report["inputs"].append({"events": events, "json_mb": round(input_mb, 1)})
+        report["results"].extend(results)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        log(f"\nSaved: {args.output}")
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(report["results"], json.load(f))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Build and query the search index over synthetic history texts.
+
+Generates `--texts` distinct titles drawn from a Zipf-like vocabulary,
+indexes them, adds a batch of new texts incrementally, and times prefix
+queries of one to three words.
+
+Usage:
+    python benchmarks/bench_search.py [--texts 1000000] [--queries 200]
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from search_index import SearchIndex
+
+def make_documents(texts, rng, start=0):
+    vocabulary = np.array([f"w{i}" for i in range(200_000)])
+    weights = 1 / np.arange(1, len(vocabulary) + 1)
+    lengths = rng.integers(3, 9, texts)
+    words = rng.choice(vocabulary, lengths.sum(), p=weights / weights.sum())
+    bounds = np.concatenate([[0], np.cumsum(lengths)])
+    titles = [" ".join(words[bounds[i]:bounds[i + 1]]) + f" #{start + i}" for i in range(texts)]
+    times = pd.Timestamp("2024-01-01", tz="UTC") + pd.to_timedelta(rng.integers(0, 365 * 86400, texts), unit="s")
+    return pd.DataFrame({"kind": "title", "text": titles, "count": rng.integers(1, 50, texts), "last_time": times})
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--texts", type=int, default=1_000_000)
+    parser.add_argument("--added", type=int, default=10_000, help="texts added incrementally after the build")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    docs = make_documents(args.texts, rng)
+    index, seconds = timed(lambda: SearchIndex.build(docs))
+    print(f"build     {args.texts:>10,} texts {seconds:8.2f} s  {len(index.terms):,} terms, {len(index.postings):,} postings")
+
+    more = make_documents(args.added, rng, start=args.texts)
+    index, seconds = timed(lambda: index.add(more))
+    print(f"add       {args.added:>10,} texts {seconds:8.2f} s")
+
+    # Queries: one to three words, the last one cut to a prefix
+    samples = docs["text"].sample(args.queries, random_state=args.seed).str.split()
+    queries = [" ".join(words[:n - 1] + [words[n - 1][:3]]) for words, n in zip(samples, rng.integers(1, 4, args.queries))]
+    latencies, hits = [], []
+    for query in queries:
+        found, seconds = timed(lambda: index.search(query))
+        latencies.append(seconds * 1000)
+        hits.append(len(index.matches(query)))
+    latencies = np.array(latencies)
+    print(f"search    {args.queries:>10,} queries  median {np.median(latencies):.2f} ms, p95 {np.percentile(latencies, 95):.2f} ms, "
+          f"max {latencies.max():.2f} ms, median matches {int(np.median(hits)):,}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Local stand-in for the two YouTube Data API endpoints used by enrichment.
+
+Answers videos.list and videoCategories.list with metadata derived from a
+hash of each ID, so results are repeatable without network access or a key.
+Latency and a share of failing requests (503 or 429) can be injected to
+exercise retries:
+
+    python benchmarks/standin_server.py --port 8765 --latency 0.05 --fail 0.1
+
+and point enrichment at it with YouTubeBackend("any", "http://127.0.0.1:8765").
+"""
+
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+CATEGORIES = {"1": "Film & Animation", "2": "Autos & Vehicles", "10": "Music", "17": "Sports",
+              "20": "Gaming", "22": "People & Blogs", "24": "Entertainment", "27": "Education", "28": "Science & Technology"}
+
+# One in this many IDs is reported missing, like private or deleted videos
+NOT_FOUND_EVERY = 25
+
+def video_item(video_id):
+    """Fake videos.list item for `video_id`, or None for a missing video."""
+    h = int.from_bytes(hashlib.blake2b(video_id.encode(), digest_size=8).digest(), "little")
+    if h % NOT_FOUND_EVERY == 0:
+        return None
+    seconds = 30 + h % 3600
+    published = datetime(2008, 1, 1, tzinfo=timezone.utc) + timedelta(seconds=h % (16 * 365 * 24 * 3600))
+    return {
+        "id": video_id,
+        "snippet": {"categoryId": list(CATEGORIES)[h % len(CATEGORIES)], "publishedAt": published.strftime("%Y-%m-%dT%H:%M:%SZ")},
+        "contentDetails": {"duration": f"PT{seconds // 3600}H{seconds // 60 % 60}M{seconds % 60}S"},
+    }
+
+class Handler(BaseHTTPRequestHandler):
+    latency = 0.0
+    fail = 0.0
+    requests = 0
+
+    def do_GET(self):
+        type(self).requests += 1
+        url = urlparse(self.path)
+        ids = [i for i in parse_qs(url.query).get("id", [""])[0].split(",") if i]
+        time.sleep(self.latency)
+        if random.random() < self.fail:
+            # Half the failures ask the client to back off
+            status = random.choice((429, 503))
+            self.send_response(status)
+            if status == 429:
+                self.send_header("Retry-After", "0")
+            self.end_headers()
+            return
+
+        if url.path.endswith("/videos"):
+            items = [item for item in map(video_item, ids) if item is not None]
+        elif url.path.endswith("/videoCategories"):
+            items = [{"id": i, "snippet": {"title": CATEGORIES[i]}} for i in ids if i in CATEGORIES]
+        else:
+            self.send_error(404)
+            return
+        body = json.dumps({"items": items}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def serve(port=0, latency=0.0, fail=0.0):
+    """Start the server in a daemon thread. Returns (server, base_url)."""
+    handler = type("StandinHandler", (Handler,), {"latency": latency, "fail": fail, "requests": 0})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--fail", type=float, default=0.0, help="share of requests answered with 429 or 503")
+    args = parser.parse_args()
+    server, url = serve(args.port, args.latency, args.fail)
+    print(f"Serving on {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Synthetic Google Takeout watch- and search-history records for benchmarks."""
+
+import os
+import json
+import random
+from datetime import datetime, timedelta, timezone
+
+START = datetime(2018, 1, 1, tzinfo=timezone.utc)
+SPAN_SECONDS = 7 * 365 * 24 * 3600
+
+def _random_time(rng):
+    when = START + timedelta(seconds=rng.randrange(SPAN_SECONDS), microseconds=rng.randrange(1000) * 1000)
+    return when.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+def make_watch_records(n, videos=None, channels=500, music_share=0.15, ads_share=0.03, seed=0):
+    """Return `n` watch-history records shaped like a Takeout export."""
+    rng = random.Random(seed)
+    videos = videos or max(1, n // 4)
+    records = []
+    for _ in range(n):
+        time = _random_time(rng)
+
+        if rng.random() < ads_share:
+            records.append({
+                "header": "YouTube",
+                "title": "Watched Sponsored video",
+                "titleUrl": f"https://www.youtube.com/watch?v=ad{rng.randrange(1000):09d}",
+                "time": time,
+                "products": ["YouTube"],
+                "details": [{"name": "From Google Ads"}],
+                "activityControls": ["YouTube watch history"],
+            })
+            continue
+
+        # Skewed toward a small set of frequently rewatched videos
+        video = int(videos * rng.random() ** 3)
+        channel = video % channels
+        music = rng.random() < music_share
+        host = "music" if music else "www"
+        records.append({
+            "header": "YouTube Music" if music else "YouTube",
+            "title": f"Watched Video title {video}",
+            "titleUrl": f"https://{host}.youtube.com/watch?v=v{video:010d}",
+            "subtitles": [{
+                "name": f"Channel {channel}",
+                "url": f"https://www.youtube.com/channel/UC{channel:022d}",
+            }],
+            "time": time,
+            "products": ["YouTube"],
+            "activityControls": ["YouTube watch history"],
+        })
+    return records
+
+def make_search_records(n, queries=None, ads_share=0.03, seed=0):
+    """Return `n` search-history records shaped like a Takeout export."""
+    rng = random.Random(seed)
+    queries = queries or max(1, n // 2)
+    records = []
+    for _ in range(n):
+        query = int(queries * rng.random() ** 2)
+        record = {
+            "header": "YouTube",
+            "title": f"Searched for query {query}",
+            "titleUrl": f"https://www.youtube.com/results?search_query=query+{query}",
+            "time": _random_time(rng),
+            "products": ["YouTube"],
+            "activityControls": ["YouTube search history"],
+        }
+        if rng.random() < ads_share:
+            record["details"] = [{"name": "From Google Ads"}]
+        records.append(record)
+    return records
+
+def write_takeout(directory, events, accounts=1, search_share=0.2, seed=0, **watch_options):
+    """
+    Write `<account> watch-history.json` and `<account> search-history.json` per account.
+
+    `events` is the total across accounts, `search_share` of it search events.
+    Accounts draw from the same videos, so their histories overlap like
+    those of real users with shared interests. Returns the written paths.
+    """
+    paths = []
+    per_account = max(1, events // accounts)
+    searches = int(per_account * search_share)
+    watches = per_account - searches
+    # Same video universe for every account
+    watch_options.setdefault("videos", max(1, events // 4))
+    for i in range(accounts):
+        prefix = f"A{i:02d}"
+        files = [
+            ("watch-history.json", make_watch_records(watches, seed=seed + i, **watch_options)),
+            ("search-history.json", make_search_records(searches, seed=seed + i)),
+        ]
+        for name, records in files:
+            path = os.path.join(directory, f"{prefix} {name}")
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(records, f)
+            paths.append(path)
+    return paths
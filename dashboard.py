@@ -1,59 +1,351 @@
-import streamlit as st
+import os
+import time
+import datetime
+import numpy as np
 import pandas as pd
+import streamlit as st
 import plotly.express as px
+from query import AGGREGATES, BUCKETS, OTHER, PAGE_ROWS, column_kinds, columns, connect, count_rows, distinct_count, group_query, histogram_query, page_query, points_query, quote, run, table_name, time_range, top_values, where_clause
+import query
+from store import file_signature, sidecar_path
+from utils_2 import CUBES, GRAINS, read_cubes
+
+WEEKDAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+# Length of each timeline period, for drill-down date ranges
+GRAIN_OFFSETS = {"day": pd.DateOffset(days=1), "week": pd.DateOffset(weeks=1), "month": pd.DateOffset(months=1)}
+
+# Limits on what is sent to the browser
+MAX_TRACES = 10     # color values charted, the rest are folded into "other"
+MAX_BARS = 50       # bars per trace: the most frequent text x values, or bins of a numeric x
+MAX_POINTS = 2_000  # points per line trace, binned or downsampled beyond that
+WEBGL_ROWS = 1_000  # scatter and line charts switch to WebGL above this
+
+# Text columns the table search looks in
+SEARCH_COLUMNS = ["title", "channel_name"]
+
+# Query results kept between reruns; each is bounded by the limits above
+QUERY_CACHE_ENTRIES = 256
+
+@st.cache_data(max_entries=QUERY_CACHE_ENTRIES, show_spinner=False)
+def _cached_query(path, signature, timezone, name, *args):
+    # `signature` only keys the cache, a rewritten file gets a new one
+    con = connect(timezone=timezone, paths=[path])
+    try:
+        return getattr(query, name)(con, *args)
+    finally:
+        con.close()
+
+def store_query(path, timezone=None):
+    """
+    Call query helpers on one store file, with results cached between reruns.
+
+    ``q(count_rows, table, where, params)`` runs count_rows on a connection
+    to `path`. Results are keyed on the file's (mtime, size), so widget
+    reruns over an unchanged file do not query it again, and a rewritten
+    file is queried afresh.
+    """
+    signature = file_signature(path)
+    def q(func, *args):
+        return _cached_query(path, signature, timezone, func.__name__, *args)
+    return q
+
+@st.cache_data(max_entries=2, show_spinner=False)
+def _load_cubes(agg_path, signatures):
+    return read_cubes(agg_path)
+
+def lttb(x, y, n):
+    """
+    Indices of `n` points of the series (x, y) chosen by Largest-Triangle-Three-Buckets.
+
+    First and last points are kept; from each bucket in between the point
+    forming the largest triangle with the previous pick and the next
+    bucket's average is kept, which preserves peaks and dips.
+    """
+    size = len(x)
+    if n >= size or n < 3:
+        return np.arange(size)
+    edges = np.linspace(1, size - 1, n - 1).astype(np.int64)
+    picked = np.empty(n, dtype=np.int64)
+    picked[0], picked[-1] = 0, size - 1
+    a = 0
+    for i in range(n - 2):
+        lo, hi = edges[i], edges[i + 1]
+        nxt = slice(hi, edges[i + 2]) if i + 2 < len(edges) else slice(size - 1, size)
+        avg_x, avg_y = x[nxt].mean(), y[nxt].mean()
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(np.argmax(area))
+        picked[i + 1] = a
+    return picked
+
+def downsample(data, x, y, color=None, n=MAX_POINTS):
+    """Rows of `data` (sorted by `x`) with each color's line reduced to at most `n` points by LTTB."""
+    groups = data.groupby(color, sort=False, dropna=False).indices.values() if color else [np.arange(len(data))]
+    keep = []
+    for rows in groups:
+        xs = data[x].iloc[rows]
+        xs = xs.array.asi8 if isinstance(xs.dtype, pd.DatetimeTZDtype) or xs.dtype.kind == "M" else xs.to_numpy()
+        ys = data[y].iloc[rows].fillna(0).to_numpy()
+        keep.append(rows[lttb(xs.astype(np.float64), ys.astype(np.float64), n)])
+    return data.iloc[np.sort(np.concatenate(keep))] if keep else data
+
+def show_chart(fig, notes=()):
+    """Render a figure and report what reached the browser: points, payload size and build time."""
+    start = time.perf_counter()
+    payload = len(fig.to_json().encode())
+    st.plotly_chart(fig, use_container_width=True)
+    points = sum(len(trace.x) if trace.x is not None else 0 for trace in fig.data)
+    details = [f"{len(fig.data)} traces", f"{points:,} points", f"{payload / 1024:,.0f} KB",
+               f"{time.perf_counter() - start:.2f} s"] + list(notes)
+    st.caption(" · ".join(details))
+
+def show_overview(agg_path, events_path, timezone=None):
+    """
+    Charts from the rollup cubes stored next to the aggregate.
+
+    The cubes hold a few thousand rows whatever the history size; raw
+    events are only queried when drilling into one period.
+    """
+    paths = [sidecar_path(agg_path, name) for name in CUBES]
+    if not all(os.path.exists(p) for p in paths):
+        return False
+    cubes = _load_cubes(agg_path, tuple(file_signature(p) for p in paths))
+    if cubes is None:
+        return False
+    timeline, heatmap = cubes["timeline"], cubes["heatmap"]
+    if timeline.empty:
+        return False
+
+    st.subheader("📈 Watch Overview")
+    headers = sorted(timeline["header"].dropna().unique())
+    picked = st.multiselect("Headers", headers, default=headers)
+    timeline = timeline[timeline["header"].isin(picked)]
+    heatmap = heatmap[heatmap["header"].isin(picked)]
+
+    grain = st.radio("Period", GRAINS, index=GRAINS.index("week"), horizontal=True)
+    series = timeline[timeline["grain"] == grain].sort_values("period")
+    st.plotly_chart(px.bar(series, x="period", y="views", color="header"), use_container_width=True)
+
+    cols = st.columns(2)
+    with cols[0]:
+        grid = (heatmap.groupby(["weekday", "hour"])["views"].sum()
+                .unstack(fill_value=0).reindex(index=range(7), columns=range(24), fill_value=0))
+        fig = px.imshow(grid.to_numpy(), x=list(range(24)), y=WEEKDAYS, aspect="auto",
+                        labels={"x": "Hour", "y": "Weekday", "color": "Views"})
+        st.plotly_chart(fig, use_container_width=True)
+    with cols[1]:
+        totals = series.groupby("header", as_index=False)["views"].sum()
+        st.plotly_chart(px.pie(totals, names="header", values="views"), use_container_width=True)
+
+    # Drill-down: only this period's events are read from the event file
+    periods = series["period"].drop_duplicates().sort_values(ascending=False)
+    period = st.selectbox(f"Drill into a {grain}", [None] + list(periods),
+                          format_func=lambda p: "—" if p is None else p.strftime("%Y-%m-%d"))
+    if period is not None and events_path is not None:
+        show_period(events_path, period, period + GRAIN_OFFSETS[grain], picked, timezone)
+    return True
+
+def show_period(events_path, start, end, headers, timezone=None):
+    """Most watched videos and views per day in [start, end), queried from the raw events."""
+    q = store_query(events_path, timezone)
+    table = table_name(events_path)
+    where, params = where_clause({"header": headers}, "time", start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d"))
+    daily = q(run, group_query(table, "time", bucket="day", color="header", where=where), params)
+    top = q(run, f"SELECT title, COUNT(*) AS views FROM {quote(table)}{where} GROUP BY title ORDER BY views DESC, title LIMIT 20", params)
+    cols = st.columns(2)
+    with cols[0]:
+        st.plotly_chart(px.bar(daily, x="time", y="count", color="header"), use_container_width=True)
+    with cols[1]:
+        st.dataframe(top, use_container_width=True, hide_index=True)
+
+def local_times(df):
+    """Show timezone-aware columns as wall-clock time, like the rest of the viewer."""
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.DatetimeTZDtype):
+            df[col] = df[col].dt.tz_localize(None)
+    return df
+
+def show_table(path, timezone=None):
+    """
+    Paged view of a store file.
+
+    Only the visible page is queried, sorted, filtered and searched in
+    DuckDB, so a large file costs the same to browse as a small one. List
+    columns (`time_list`) are shown as their length and read for one row
+    on request.
+    """
+    q = store_query(path, timezone)
+    table = table_name(path)
+    kinds = q(column_kinds, table)
+    lists = kinds["list"]
+    cols = [c for c, _ in q(columns, table) if c not in lists]
+
+    top = st.columns([3, 2, 1, 2])
+    search_cols = [c for c in SEARCH_COLUMNS if c in kinds["text"]]
+    search = top[0].text_input("Search " + (" / ".join(search_cols) or "(no text columns)"),
+                               disabled=not search_cols).strip()
+    order = top[1].selectbox("Sort by", [None] + cols, format_func=lambda c: "file order" if c is None else c)
+    descending = top[2].checkbox("Descending", value=True, disabled=order is None)
+    filters = {}
+    filter_col = top[3].selectbox("Filter on", [None] + kinds["text"], format_func=lambda c: "—" if c is None else c)
+    if filter_col is not None:
+        filters[filter_col] = st.multiselect(f"Keep {filter_col} (most frequent first)", q(top_values, table, filter_col))
+    where, params = where_clause(filters, search=search, search_columns=search_cols)
+
+    matched = q(count_rows, table, where, params)
+    page_rows = st.session_state.get("page_rows", PAGE_ROWS)
+    pages = max(1, -(-matched // page_rows))
+    nav = st.columns([1, 1, 4])
+    page = nav[0].number_input(f"Page (of {pages:,})", min_value=1, max_value=pages, value=1)
+    nav[1].selectbox("Rows per page", [50, PAGE_ROWS, 500], index=1, key="page_rows")
+    offset = (page - 1) * page_rows
+
+    data = q(run, page_query(table, cols, where, order, descending, page_rows, offset, lengths=lists), params)
+    data.index = pd.RangeIndex(offset + 1, offset + 1 + len(data))
+    nav[2].caption(f"Rows {offset + 1:,}–{offset + len(data):,} of {matched:,}" if len(data) else "No matching rows")
+    st.dataframe(local_times(data), use_container_width=True, height=min(700, 38 + 35 * len(data)))
+
+    # Heavy list columns of one row, read only when asked for
+    if lists and len(data):
+        row = st.selectbox(f"Show {', '.join(lists)} of row", [None] + list(data.index),
+                           format_func=lambda r: "—" if r is None else f"{r:,}")
+        if row is not None:
+            full = q(run, page_query(table, cols + lists, where, order, descending, 1, row - 1), params)
+            for col in lists:
+                values = full[col].iloc[0]
+                values = [] if values is None else list(values)
+                st.write(f"**{col}** ({len(values)})")
+                st.dataframe(local_times(pd.DataFrame({col: values})), use_container_width=True, height=250)
 
-def show_dashboard(df: pd.DataFrame):
+def show_dashboard(path, timezone=None):
+    """Chart a store file. Filters, date ranges and group-bys run as queries, only the chart's rows are loaded."""
     st.subheader("📊 Data Dashboard")
 
-    if df.empty:
+    q = store_query(path, timezone)
+    table = table_name(path)
+    total = q(count_rows, table)
+    if total == 0:
         st.info("No data available for dashboard.")
         return
 
     # Identify column types
-    numeric_cols = df.select_dtypes(include=["number"]).columns.tolist()
-    date_cols = df.select_dtypes(include=["datetime", "datetimetz"]).columns.tolist()
-    categorical_cols = df.select_dtypes(include=["object", "category"]).columns.tolist()
-    all_cols = df.columns.tolist()
+    kinds = q(column_kinds, table)
+    numeric_cols, date_cols, categorical_cols = kinds["numeric"], kinds["datetime"], kinds["text"]
+    all_cols = numeric_cols + date_cols + categorical_cols
 
     st.markdown("### Column Types")
     st.write(f"**Numeric:** {numeric_cols}")
     st.write(f"**Date/Datetime:** {date_cols}")
     st.write(f"**Categorical:** {categorical_cols}")
 
+    # Filters become the query's WHERE clause
+    date_col, start, end, filters = None, None, None, {}
+    with st.expander("Filters"):
+        if date_cols:
+            date_col = st.selectbox("Date range on", date_cols)
+            low, high = q(time_range, table, date_col)
+            if low is not None:
+                picked = st.date_input("Date range", value=(low.date(), high.date()), min_value=low.date(), max_value=high.date())
+                if len(picked) == 2:
+                    # End date is inclusive in the picker, exclusive in the query
+                    start, end = picked[0], picked[1] + datetime.timedelta(days=1)
+        if categorical_cols:
+            filter_col = st.selectbox("Filter column", ["None"] + categorical_cols)
+            if filter_col != "None":
+                filters[filter_col] = st.multiselect("Keep values (most frequent first)", q(top_values, table, filter_col))
+    where, params = where_clause(filters, date_col, start, end)
+
     # X-axis can be any column
     x_axis = st.selectbox("Select X-axis column", all_cols)
+    bucket = None
+    if x_axis in date_cols:
+        bucket = st.selectbox("Group dates by", BUCKETS, index=BUCKETS.index("month"))
 
-    # Y-axis can be numeric or None
+    # Y-axis can be numeric or None (count of rows)
     y_axis_options = ["None"] + numeric_cols
     y_axis = st.selectbox("Select Y-axis column (or None)", y_axis_options)
+    how = "count"
+    if y_axis != "None":
+        how = st.selectbox("Aggregate Y by", [a for a in AGGREGATES if a != "count"])
+
+    color = st.selectbox("Color by", ["None"] + categorical_cols)
+    color = None if color == "None" else color
 
     chart_type = st.radio("Chart Type", ["Bar", "Line", "Scatter", "Histogram", "Boxplot"])
 
     try:
-        # Auto-handle date columns
-        if x_axis in date_cols:
-            df[x_axis] = pd.to_datetime(df[x_axis], errors="coerce")
-
-        # Prepare kwargs for Plotly
+        y = None if y_axis == "None" else y_axis
         plot_kwargs = {"x": x_axis}
-        if y_axis != "None":
-            plot_kwargs["y"] = y_axis
-        if categorical_cols:
-            plot_kwargs["color"] = categorical_cols[0]
+        notes = []
+
+        # Long tails are folded server-side so the browser gets a bounded number of traces and bars
+        keep = None
+        if color:
+            plot_kwargs["color"] = color
+            top = q(top_values, table, color, MAX_TRACES + 1, where, params)
+            if len(top) > MAX_TRACES:
+                keep = top[:MAX_TRACES]
+                notes.append(f"{color}: top {MAX_TRACES} values, rest as '{OTHER}'")
+        if x_axis in categorical_cols and chart_type in ("Bar", "Line", "Histogram") and not filters.get(x_axis):
+            # Ranked by the charted value, e.g. the 50 titles with the highest summed frequency
+            ranked = chart_type != "Histogram" and y is not None and how != "count"
+            by = AGGREGATES[how].format(quote(y)) if ranked else AGGREGATES["count"]
+            top = q(top_values, table, x_axis, MAX_BARS + 1, where, params, by)
+            if len(top) > MAX_BARS:
+                where, params = where_clause({**filters, x_axis: top[:MAX_BARS]}, date_col, start, end)
+                notes.append(f"{x_axis}: top {MAX_BARS} by {how + ' of ' + y if ranked else 'rows'}")
+
+        # A numeric x with more values than bars or line points is binned like a histogram
+        bins = {"Bar": MAX_BARS, "Line": MAX_POINTS}.get(chart_type)
+        if bins and x_axis in numeric_cols and q(distinct_count, table, x_axis, where, params) <= bins:
+            bins = None
+
+        if chart_type == "Histogram" and x_axis in numeric_cols:
+            # Binned in the query
+            low, high = q(time_range, table, x_axis, where, params)
+            sql = histogram_query(table, x_axis, low or 0, high or 0, color=color, where=where, keep=keep)
+            plot_kwargs["y"] = "count"
+        elif bins and x_axis in numeric_cols:
+            low, high = q(time_range, table, x_axis, where, params)
+            sql = histogram_query(table, x_axis, low, high, bins, color, where, keep, y, how)
+            plot_kwargs["y"] = "count" if how == "count" or y is None else y
+            notes.append(f"{x_axis}: {bins} bins")
+        elif chart_type in ("Bar", "Line", "Histogram"):
+            # Grouped in the query; a histogram is the row count per x value or date bucket
+            if chart_type == "Histogram":
+                y, how = None, "count"
+            sql = group_query(table, x_axis, y, how, color, bucket, where, keep=keep)
+            plot_kwargs["y"] = y or "count"
+        else:
+            # Scatter and box plots need individual rows, sampled beyond POINT_LIMIT
+            sql = points_query(table, [x_axis, y, color], where)
+            if y:
+                plot_kwargs["y"] = y
+        data = q(run, sql, params)
+        rows = len(data)
+        if keep is not None and chart_type in ("Scatter", "Boxplot"):
+            data[color] = data[color].astype(object).where(data[color].isin(keep), OTHER)
+        if chart_type == "Line" and x_axis not in categorical_cols:
+            data = downsample(data, x_axis, plot_kwargs["y"], color)
+            if len(data) < rows:
+                notes.append(f"downsampled from {rows:,} points")
+        st.caption(f"{rows:,} rows returned from {total:,}")
+
+        # WebGL traces draw large scatter and line charts on the GPU
+        if chart_type in ("Line", "Scatter") and len(data) > WEBGL_ROWS:
+            plot_kwargs["render_mode"] = "webgl"
+            notes.append("WebGL")
 
         # Generate chart
-        if chart_type == "Bar":
-            fig = px.bar(df, **plot_kwargs)
+        if chart_type in ("Bar", "Histogram"):
+            fig = px.bar(data, **plot_kwargs)
         elif chart_type == "Line":
-            fig = px.line(df, **plot_kwargs)
+            fig = px.line(data, **plot_kwargs)
         elif chart_type == "Scatter":
-            fig = px.scatter(df, **plot_kwargs)
-        elif chart_type == "Histogram":
-            fig = px.histogram(df, x=x_axis)
+            fig = px.scatter(data, **plot_kwargs)
         elif chart_type == "Boxplot":
-            fig = px.box(df, **plot_kwargs)
+            fig = px.box(data, **plot_kwargs)
 
-        st.plotly_chart(fig, use_container_width=True)
+        show_chart(fig, notes)
 
     except Exception as e:
         st.error(f"Error generating chart: {e}")
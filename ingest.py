@@ -0,0 +1,565 @@
+import io
+import os
+import json
+import multiprocessing
+import posixpath
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from pandas import json_normalize
+from jobs import JobCancelled, check_cancelled, progress
+from profiling import current_trace, run_traced, stage
+from store import concat_frames, read_frame, write_frame, write_frame_chunks
+
+REMOVE_COLUMNS = {"products", "activityControls"}
+
+# Top-level keys of Takeout watch/search activity records
+TAKEOUT_KEYS = frozenset({
+    "header", "title", "titleUrl", "subtitles", "time",
+    "products", "activityControls", "details", "description",
+})
+
+# Columns produced by the Takeout fast path, in output order
+TAKEOUT_COLUMNS = [
+    "header", "title", "titleUrl", "channel_name", "channel_url",
+    "time", "details", "description",
+]
+
+# Text columns repeated on every view, stored dictionary-encoded (categorical)
+CATEGORY_COLUMNS = ["header", "title", "titleUrl", "channel_name", "channel_url", "details"]
+
+# IDs extracted from watch and channel URLs
+VIDEO_ID_PATTERN = r"[?&]v=([^&#]+)"
+CHANNEL_ID_PATTERN = r"/channel/([^/?#]+)"
+
+# Number of records flattened and written at a time when streaming
+CHUNK_SIZE = 50_000
+
+# Characters read from the file per refill of the streaming buffer
+BUFFER_SIZE = 1 << 20
+
+# History files inside a Takeout export, matched on the end of the file name
+WATCH_HISTORY = "watch-history.json"
+SEARCH_HISTORY = "search-history.json"
+HISTORY_FILES = (WATCH_HISTORY, SEARCH_HISTORY)
+
+# Columns identifying one event across overlapping exports (those present are used)
+EVENT_KEY_COLUMNS = ["titleUrl", "time", "header"]
+
+# Integer value of NaT, also used for missing times in epoch-second arrays
+NAT = np.iinfo(np.int64).min
+
+# Worker processes for multi-file ingest (1 runs everything in the calling process)
+WORKERS = os.cpu_count() or 1
+
+def simplify_column_names(columns):
+    """Keep only the lowest-level key from dot-separated column names."""
+    return [col.split('.')[-1] for col in columns]
+
+def deduplicate_column_names(columns):
+    """Suffix repeated names with .1, .2, ... the same way pandas does when reading Excel."""
+    seen = {}
+    result = []
+    for col in columns:
+        if col in seen:
+            seen[col] += 1
+            result.append(f"{col}.{seen[col]}")
+        else:
+            seen[col] = 0
+            result.append(col)
+    return result
+
+def preprocess_json(obj):
+    """
+    Recursively walk through the object.
+    - Convert list of one element to the element itself.
+    """
+    if isinstance(obj, list):
+        if len(obj) == 1:
+            return preprocess_json(obj[0])
+        return [preprocess_json(item) for item in obj]
+    elif isinstance(obj, dict):
+        return {k: preprocess_json(v) for k, v in obj.items()}
+    else:
+        return obj
+
+def flatten_takeout_records(records):
+    """
+    Flatten Takeout activity records in a single pass over the known schema.
+
+    The first subtitle becomes explicit `channel_name`/`channel_url` columns
+    and detail names are joined into `details`. Keys outside TAKEOUT_KEYS
+    (e.g. `locationInfos`) are ignored, so one unusual record does not change
+    the columns of its chunk. Returns None if a record is not an object or
+    has none of the known keys, so the caller can fall back to the generic path.
+    """
+    header, title, title_url, channel_name, channel_url = [], [], [], [], []
+    time, details, description = [], [], []
+    known = TAKEOUT_KEYS
+
+    for record in records:
+        if type(record) is not dict or (record and known.isdisjoint(record)):
+            return None
+        get = record.get
+
+        header.append(get("header"))
+        title.append(get("title"))
+        title_url.append(get("titleUrl"))
+        time.append(get("time"))
+        description.append(get("description"))
+
+        # Subtitles and details that are not lists of objects are left empty
+        subtitles = get("subtitles")
+        if subtitles and type(subtitles) is list and type(subtitles[0]) is dict:
+            subtitle = subtitles[0]
+            channel_name.append(subtitle.get("name"))
+            channel_url.append(subtitle.get("url"))
+        else:
+            channel_name.append(None)
+            channel_url.append(None)
+
+        detail_list = get("details")
+        if detail_list and type(detail_list) is list:
+            names = [d["name"] for d in detail_list if type(d) is dict and d.get("name")]
+            details.append(", ".join(names) if names else None)
+        else:
+            details.append(None)
+
+    columns = [header, title, title_url, channel_name, channel_url, time, details, description]
+    return pd.DataFrame(dict(zip(TAKEOUT_COLUMNS, columns)), columns=TAKEOUT_COLUMNS)
+
+def map_categories(values, func):
+    """
+    Apply a vectorized string function to a categorical Series through its categories.
+
+    `func` runs once per distinct value instead of once per row. The result
+    is categorical again; categories are re-factorized since different
+    inputs may map to the same output.
+    """
+    mapped = func(pd.Series(values.cat.categories, dtype=object))
+    codes, uniques = pd.factorize(mapped)
+    # Code -1 (missing) picks the appended -1
+    new_codes = np.append(codes, -1)[values.cat.codes.to_numpy()]
+    return pd.Series(
+        pd.Categorical.from_codes(new_codes, categories=uniques),
+        index=values.index, name=values.name,
+    )
+
+def encode_categories(df):
+    """
+    Store repeated text columns as categoricals and add `video_id`/`channel_id`.
+
+    Filters, groupbys and hashes then run on integer codes, and string
+    functions only run once per distinct value. Columns holding unhashable
+    values (e.g. lists from the generic flattener) are left as they are.
+    """
+    for col in CATEGORY_COLUMNS:
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            try:
+                # Categories in order of first appearance; sorting them costs more than the hashing
+                codes, uniques = pd.factorize(df[col])
+            except TypeError:
+                continue
+            df[col] = pd.Categorical.from_codes(codes, dtype=pd.CategoricalDtype(uniques))
+
+    ids = [('video_id', 'titleUrl', VIDEO_ID_PATTERN), ('channel_id', 'channel_url', CHANNEL_ID_PATTERN)]
+    for id_col, url_col, pattern in ids:
+        if url_col in df.columns and id_col not in df.columns and isinstance(df[url_col].dtype, pd.CategoricalDtype):
+            df[id_col] = map_categories(df[url_col], lambda urls: urls.str.extract(pattern, expand=False))
+    return df
+
+def flatten_json_to_dataframe(json_data):
+    """Flatten nested JSON into a pandas DataFrame with simplified columns."""
+    records = [json_data] if isinstance(json_data, dict) else json_data
+    with stage("flatten", rows_in=len(records) if isinstance(records, list) else None) as s:
+        df = flatten_takeout_records(records) if isinstance(records, list) else None
+        if df is None:
+            df = flatten_json_generic(json_data)
+        df = encode_categories(df)
+        s.rows_out = len(df)
+    return df
+
+def flatten_json_generic(json_data):
+    """Flatten arbitrary nested JSON with json_normalize (slow path for unknown shapes)."""
+    json_data = preprocess_json(json_data)
+
+    if isinstance(json_data, dict):
+        data_to_normalize = [json_data]
+    elif isinstance(json_data, list):
+        data_to_normalize = json_data
+    else:
+        raise ValueError("Unsupported JSON format: must be a dict or list")
+
+    df = json_normalize(data_to_normalize)
+
+    # Simplify column names
+    df.columns = deduplicate_column_names(simplify_column_names(df.columns))
+
+    # Drop unwanted columns if present
+    columns_to_drop = [col for col in df.columns if col in REMOVE_COLUMNS]
+    df.drop(columns=columns_to_drop, inplace=True, errors='ignore')
+
+    return df
+
+def iter_json_records(fp, buffer_size=BUFFER_SIZE):
+    """
+    Yield the elements of a top-level JSON array one at a time.
+
+    Only the current record and a bounded read buffer are held in memory.
+    A top-level object is yielded as a single record.
+    """
+    if isinstance(fp, io.TextIOBase):
+        yield from _iter_json_records(fp, buffer_size)
+        return
+
+    # Uploaded files and files opened in binary mode yield bytes
+    text = io.TextIOWrapper(fp, encoding='utf-8')
+    try:
+        yield from _iter_json_records(text, buffer_size)
+    finally:
+        # Leave the caller's file open
+        text.detach()
+
+def _iter_json_records(fp, buffer_size):
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+
+    def fill():
+        nonlocal buf, pos, eof
+        data = fp.read(buffer_size)
+        if not data:
+            eof = True
+        buf = buf[pos:] + data
+        pos = 0
+
+    def skip(chars):
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in chars:
+                pos += 1
+            if pos < len(buf) or eof:
+                return
+            fill()
+
+    fill()
+    if buf.startswith('\ufeff'):
+        pos = 1
+    skip(' \t\r\n')
+    if pos >= len(buf):
+        return
+
+    if buf[pos] != '[':
+        # Not an array, decode the whole document as one record
+        rest = buf[pos:] + fp.read()
+        yield json.loads(rest)
+        return
+    pos += 1
+
+    while True:
+        skip(' \t\r\n,')
+        if pos >= len(buf):
+            raise ValueError("Unexpected end of JSON input: unterminated array")
+        if buf[pos] == ']':
+            return
+        try:
+            record, end = decoder.raw_decode(buf, pos)
+            # A value not followed by a delimiter may be cut at the buffer edge (e.g. "4.5e")
+            if end == len(buf) or buf[end] not in ' \t\r\n,]':
+                raise json.JSONDecodeError("Value not terminated", buf, end)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            fill()
+            continue
+        pos = end
+        yield record
+
+def iter_record_chunks(fp, chunk_size=CHUNK_SIZE):
+    """Group streamed JSON records into lists of at most `chunk_size`."""
+    chunk = []
+    for record in iter_json_records(fp):
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def iter_flattened_chunks(fp, chunk_size=CHUNK_SIZE):
+    """Yield flattened DataFrames of at most `chunk_size` rows from a JSON file."""
+    for chunk in iter_record_chunks(fp, chunk_size):
+        check_cancelled()
+        yield flatten_json_to_dataframe(chunk)
+
+def read_json_file(fp, chunk_size=CHUNK_SIZE):
+    """Stream a JSON file into a single flattened DataFrame."""
+    chunks = list(iter_flattened_chunks(fp, chunk_size))
+    if not chunks:
+        return pd.DataFrame()
+    return concat_frames(chunks)
+
+def with_source(df, source):
+    """Tag rows with the account they came from, if known."""
+    if source is not None:
+        df['source'] = pd.Categorical.from_codes(np.zeros(len(df), dtype=np.int8), [source])
+    return df
+
+def _convert_stream(fp, dst, streaming, chunk_size, source):
+    if streaming:
+        chunks = (with_source(chunk, source) for chunk in iter_flattened_chunks(fp, chunk_size))
+        return write_frame_chunks(chunks, dst)
+    df = with_source(flatten_json_to_dataframe(json.load(fp)), source)
+    write_frame(df, dst)
+    return len(df)
+
+def convert_json_file(src, dst, streaming=True, chunk_size=CHUNK_SIZE, source=None):
+    """Flatten one JSON file into the store at `dst`. Returns the row count."""
+    with stage(f"convert {os.path.basename(src)}") as s, open(src, 'rb') as f:
+        s.rows_out = _convert_stream(f, dst, streaming, chunk_size, source)
+        s.bytes_read = os.path.getsize(src)
+    return s.rows_out
+
+def account_prefix(name):
+    """
+    Account prefix of a folder or archive name, or None.
+
+    Same rule as 1_add_prefix.py: a 2-4 character word followed by a space,
+    e.g. "AB Takeout.zip" -> "AB".
+    """
+    parts = os.path.basename(name.rstrip('/')).split(' ', 1)
+    if len(parts) == 2 and 2 <= len(parts[0]) <= 4:
+        return parts[0]
+    return None
+
+def archive_source(archive_name, member):
+    """
+    Account an archive member belongs to.
+
+    The prefix of the archive name wins, then the prefix of the member's top
+    folder; otherwise the archive name itself identifies the account.
+    """
+    source = account_prefix(archive_name)
+    if source is None and '/' in member:
+        source = account_prefix(member.split('/', 1)[0])
+    if source is None:
+        source = os.path.splitext(os.path.basename(archive_name))[0]
+    return source
+
+def find_history_members(zf, kinds=HISTORY_FILES):
+    """Return (member, kind) for every history file in an open zip archive, in archive order."""
+    members = []
+    for info in zf.infolist():
+        if info.is_dir():
+            continue
+        filename = posixpath.basename(info.filename)
+        for kind in kinds:
+            if filename.endswith(kind):
+                members.append((info.filename, kind))
+                break
+    return members
+
+def takeout_jobs(archive, kinds=HISTORY_FILES):
+    """List (member, kind, source) for the history files of a Takeout zip without extracting it."""
+    with zipfile.ZipFile(archive) as zf:
+        return [
+            (member, kind, archive_source(archive, member))
+            for member, kind in find_history_members(zf, kinds)
+        ]
+
+def convert_zip_member(archive, member, dst, streaming=True, chunk_size=CHUNK_SIZE, source=None):
+    """Stream one JSON member of a zip archive into the store at `dst`. Returns the row count."""
+    with stage(f"convert {posixpath.basename(member)}") as s, zipfile.ZipFile(archive) as zf:
+        s.bytes_read = zf.getinfo(member).compress_size
+        with zf.open(member) as f:
+            s.rows_out = _convert_stream(f, dst, streaming, chunk_size, source)
+    return s.rows_out
+
+def read_zip(fp, name, kind=WATCH_HISTORY, chunk_size=CHUNK_SIZE):
+    """Read every `kind` history file of a Takeout zip into one DataFrame tagged with `source`."""
+    frames = []
+    with zipfile.ZipFile(fp) as zf:
+        for member, _ in find_history_members(zf, (kind,)):
+            with zf.open(member) as f:
+                df = read_json_file(f, chunk_size)
+            frames.append(with_source(df, archive_source(name, member)))
+    if not frames:
+        return pd.DataFrame()
+    return concat_frames(frames)
+
+def read_upload(name, data, kind=WATCH_HISTORY):
+    """Parse an uploaded JSON, Excel or Takeout zip file given as bytes."""
+    with stage(f"parse {name}") as s:
+        lower = name.lower()
+        if lower.endswith('.zip'):
+            df = read_zip(io.BytesIO(data), name, kind)
+        elif lower.endswith('.json'):
+            df = read_json_file(io.BytesIO(data))
+        else:
+            df = pd.read_excel(io.BytesIO(data))
+        s.rows_out = len(df)
+        s.bytes_read = len(data)
+    return df
+
+def epoch_seconds(times):
+    """
+    UTC epoch seconds (floored) of a datetime or ISO 8601 string column; NaT -> NAT.
+
+    Raw ISO strings and parsed datetimes of the same event give the same
+    value. Naive datetimes are taken as UTC.
+    """
+    if not pd.api.types.is_datetime64_any_dtype(times):
+        try:
+            # Arrow's ISO 8601 cast is much faster than pandas' parser
+            strings = pa.array(times.to_numpy(dtype=object), pa.string(), from_pandas=True)
+            ns = pc.cast(pc.cast(strings, pa.timestamp('ns', 'UTC')), pa.int64())
+            ns = ns.fill_null(NAT).to_numpy()
+            return np.where(ns == NAT, NAT, ns // 10**9)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            times = pd.to_datetime(times, format='ISO8601', errors='coerce', utc=True)
+    elif times.dt.tz is None:
+        times = times.dt.tz_localize('UTC')
+    return times.dt.as_unit('s').array.asi8
+
+def event_hashes(df, columns=EVENT_KEY_COLUMNS):
+    """
+    Hash each row's key `columns` (titleUrl, time, header by default) into a uint64 key.
+
+    Time is compared at UTC second resolution, so parsed and string times
+    of the same event match. Key columns missing from `df` are left out.
+    """
+    key_frame = pd.DataFrame(index=df.index)
+    for col in columns:
+        if col in df.columns:
+            if col == 'time':
+                key_frame[col] = epoch_seconds(df[col])
+            elif isinstance(df[col].dtype, pd.CategoricalDtype):
+                # Categorical values hash the same as the equivalent strings
+                key_frame[col] = df[col]
+            else:
+                key_frame[col] = df[col].astype(object)
+    return pd.util.hash_pandas_object(key_frame, index=False).to_numpy()
+
+def file_event_hashes(path):
+    """Event keys of a file in the store, in row order. Runs in ingest worker processes."""
+    df = read_frame(path)
+    with stage("hash events", rows_in=len(df)):
+        return event_hashes(df)
+
+def sorted_unique(values):
+    """np.unique for 1-D integer arrays via sort; numpy's hash-based unique is far slower here."""
+    values = np.sort(values)
+    if len(values) == 0:
+        return values
+    return values[np.concatenate([[True], values[1:] != values[:-1]])]
+
+def is_known(keys, known):
+    """Membership of `keys` in the sorted array `known`, one binary search per key."""
+    if known is None or len(known) == 0:
+        return np.zeros(len(keys), dtype=bool)
+    pos = np.searchsorted(known, keys)
+    pos[pos == len(known)] = 0
+    return known[pos] == keys
+
+def first_new_events(keys, known=None):
+    """Mask of rows that are the first occurrence of their key and not in sorted `known`."""
+    keep = np.zeros(len(keys), dtype=bool)
+    keep[np.unique(keys, return_index=True)[1]] = True
+    keep &= ~is_known(keys, known)
+    return keep
+
+def dedup_masks(key_arrays, known=None):
+    """
+    Keep-masks that drop repeated events across several files, in file order.
+
+    An event is kept in the first file it appears in, unless it is already in
+    `known`. Returns the masks and the sorted union of `known` and kept keys.
+    """
+    with stage("dedup", rows_in=sum(len(keys) for keys in key_arrays)) as s:
+        seen = np.empty(0, dtype=np.uint64) if known is None else np.asarray(known, dtype=np.uint64)
+        masks = []
+        for keys in key_arrays:
+            keep = first_new_events(keys, seen)
+            seen = sorted_unique(np.concatenate([seen, keys[keep]]))
+            masks.append(keep)
+        s.rows_out = sum(int(mask.sum()) for mask in masks)
+    return masks, seen
+
+def drop_duplicate_events(df, known=None):
+    """Drop repeated events (and those in sorted `known`). Returns the frame and its keys."""
+    with stage("dedup", rows_in=len(df)) as s:
+        keys = event_hashes(df)
+        keep = first_new_events(keys, known)
+        if not keep.all():
+            df, keys = df.loc[keep], keys[keep]
+        s.rows_out = len(df)
+    return df, keys
+
+def _job_label(func, job):
+    # e.g. "convert_json_file AB watch-history.json"
+    first = job[0] if job else None
+    name = os.path.basename(first) if isinstance(first, str) else None
+    return f"{func.__name__} {name}" if name else func.__name__
+
+def _pool_context():
+    # The fork server is a fresh single-threaded process, so forking from it is
+    # safe, and its children start with ingest already imported. Windows has
+    # no fork server and spawns each worker
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["ingest", "utils_1"])
+        return context
+    return multiprocessing.get_context("spawn")
+
+def map_files(func, jobs, workers=WORKERS):
+    """
+    Run `func(*job)` for every job tuple across worker processes.
+
+    Yields (job, result, error) in the order of `jobs`, whichever worker
+    finishes first, so merged output is deterministic. A failing job yields
+    its exception as `error` and does not stop the others.
+    """
+    jobs = list(jobs)
+    if workers <= 1 or len(jobs) <= 1:
+        for done, job in enumerate(jobs, 1):
+            try:
+                with stage(_job_label(func, job)):
+                    result = func(*job)
+            except JobCancelled:
+                raise
+            except Exception as e:
+                result, error = None, e
+            else:
+                error = None
+            progress(done, len(jobs), "files")
+            yield job, result, error
+        return
+
+    # Workers record their own stages, which are merged into the caller's trace
+    trace = current_trace()
+    # Never forked from here: the app calls this from a job thread, and forking
+    # a process that runs threads can deadlock the child
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), mp_context=_pool_context()) as pool:
+        if trace is None:
+            futures = [pool.submit(func, *job) for job in jobs]
+        else:
+            futures = [pool.submit(run_traced, func, _job_label(func, job), trace.profile, *job) for job in jobs]
+        for done, (job, future) in enumerate(zip(jobs, futures), 1):
+            try:
+                result, error = future.result(), None
+            except Exception as e:
+                result, error = None, e
+            try:
+                progress(done, len(jobs), "files")
+            except JobCancelled:
+                # Leaving the pool would otherwise wait for every queued file
+                pool.shutdown(wait=False, cancel_futures=True)
+                raise
+            if error is None and trace is not None:
+                result, stages = result
+                trace.adopt(stages)
+            yield job, result, error
@@ -0,0 +1,191 @@
+import time
+import itertools
+import threading
+import traceback
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from profiling import stage, tracing
+
+# Job states
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+ACTIVE = (QUEUED, RUNNING)
+
+# Finished jobs kept for display, oldest are forgotten first
+KEEP_JOBS = 20
+
+_current = contextvars.ContextVar("job", default=None)
+_ids = itertools.count(1)
+
+class JobCancelled(Exception):
+    """Raised inside a job at the next progress check after it was cancelled."""
+
+class Job:
+    """
+    A queued run of one or more pipeline steps.
+
+    Each step is a (label, func, args) tuple run in order, so several
+    buttons can be chained into one job. Steps report through `progress()`
+    and `note()`, which find the running job through a context variable.
+    """
+
+    def __init__(self, name, steps, key=None, profile=None):
+        self.id = next(_ids)
+        self.name = name
+        self.steps = list(steps)
+        self.key = key
+        self.profile = profile
+        self.status = QUEUED
+        self.step = 0
+        self.done = None
+        self.total = None
+        self.message = None
+        self.notes = []
+        self.results = []
+        self.error = None
+        self.trace = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self._cancel = threading.Event()
+
+    def cancel(self):
+        """Ask the job to stop. A queued job never starts, a running one stops at its next progress check."""
+        self._cancel.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    @property
+    def fraction(self):
+        """Overall progress in [0, 1]: finished steps plus the reported share of the current one."""
+        if self.status == DONE:
+            return 1.0
+        part = self.done / self.total if self.done is not None and self.total else 0.0
+        return min((self.step + part) / max(len(self.steps), 1), 1.0)
+
+    @property
+    def activity(self):
+        """Label of the current step and the innermost open trace stage."""
+        if self.status != RUNNING or self.step >= len(self.steps):
+            return None
+        label = self.steps[self.step][0]
+        stages = self.trace.open_stages() if self.trace is not None else []
+        if stages and stages[-1] != label:
+            label = f"{label}: {stages[-1]}"
+        if self.message:
+            label = f"{label} ({self.message})"
+        return label
+
+    @property
+    def seconds(self):
+        if self.started is None:
+            return None
+        return (self.finished or time.time()) - self.started
+
+class JobRunner:
+    """
+    Runs jobs in a background thread so the app stays responsive.
+
+    Jobs run one at a time in submission order, so two jobs never write the
+    same output file at once. Submitting a job whose key matches a queued or
+    running job returns that job instead of starting a duplicate.
+    """
+
+    def __init__(self, workers=1, keep=KEEP_JOBS):
+        self.keep = keep
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, name, steps, key=None, profile=None):
+        """Queue a job and return (job, created)."""
+        with self._lock:
+            if key is not None:
+                for job in self._jobs.values():
+                    if job.key == key and job.status in ACTIVE:
+                        return job, False
+            job = Job(name, steps, key, profile)
+            self._jobs[job.id] = job
+            self._forget()
+        self._pool.submit(self._run, job)
+        return job, True
+
+    def _forget(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.status not in ACTIVE]
+        for job_id in finished[:max(len(finished) - self.keep, 0)]:
+            del self._jobs[job_id]
+
+    def _run(self, job):
+        if job.cancelled:
+            job.status = CANCELLED
+            job.finished = time.time()
+            return
+        token = _current.set(job)
+        job.status = RUNNING
+        job.started = time.time()
+        try:
+            with tracing(job.name, job.profile) as trace:
+                job.trace = trace
+                for i, (label, func, args) in enumerate(job.steps):
+                    job.step, job.done, job.total, job.message = i, None, None, None
+                    check_cancelled()
+                    with stage(label):
+                        job.results.append(func(*args))
+            job.step = len(job.steps)
+            job.status = DONE
+        except JobCancelled:
+            job.status = CANCELLED
+        except Exception as e:
+            # Short message for the app, full traceback in the server log
+            job.error = "".join(traceback.format_exception_only(type(e), e)).strip()
+            traceback.print_exc()
+            job.status = FAILED
+        finally:
+            job.finished = time.time()
+            _current.reset(token)
+
+    def jobs(self):
+        """All remembered jobs, newest first."""
+        with self._lock:
+            return list(reversed(self._jobs.values()))
+
+    def active(self):
+        return [job for job in self.jobs() if job.status in ACTIVE]
+
+def check_cancelled():
+    """Raise JobCancelled if the current job was cancelled. No-op outside a job."""
+    job = _current.get()
+    if job is not None and job.cancelled:
+        raise JobCancelled(job.name)
+
+def progress(done, total=None, message=None):
+    """
+    Report progress of the current step (e.g. files or chunks done of total).
+
+    Also the point where a cancelled job stops, so call it between chunks,
+    never halfway through writing an output. No-op outside a job.
+    """
+    job = _current.get()
+    if job is None:
+        return
+    job.done, job.total, job.message = done, total, message
+    check_cancelled()
+
+def note(level, text):
+    """
+    Record a message for the user, shown with the job ("info", "success", "warning" or "error").
+
+    Streamlit elements cannot be drawn from the job thread, so steps leave
+    notes instead. Outside a job the note is printed.
+    """
+    job = _current.get()
+    if job is None:
+        print(text)
+        return
+    job.notes.append((level, text))
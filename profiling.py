@@ -0,0 +1,238 @@
+import os
+import io
+import json
+import time
+import pstats
+import cProfile
+import resource
+import contextvars
+from contextlib import contextmanager
+import pandas as pd
+
+# Trace the pipeline writes to when the CLI scripts run, e.g. PIPELINE_TRACE=trace.json
+TRACE_ENV = "PIPELINE_TRACE"
+# Stage to run under cProfile, e.g. PIPELINE_PROFILE=aggregate
+PROFILE_ENV = "PIPELINE_PROFILE"
+
+# Lines of cProfile output kept per profiled stage
+PROFILE_LINES = 30
+
+_current = contextvars.ContextVar("trace", default=None)
+
+# Bytes the tracer itself read from and wrote to /proc, left out of stage I/O
+_own_io = [0, 0]
+
+def _read_proc(path):
+    try:
+        with open(path) as f:
+            text = f.read()
+    except OSError:
+        return None
+    _own_io[0] += len(text)
+    return text
+
+def _io_counters():
+    # Bytes passed through read/write syscalls (memory-mapped reads are not counted)
+    own_read, own_written = _own_io
+    text = _read_proc("/proc/self/io")
+    if text is None:
+        return None, None
+    fields = dict(line.split(": ") for line in text.splitlines() if ": " in line)
+    return int(fields.get("rchar", 0)) - own_read, int(fields.get("wchar", 0)) - own_written
+
+def _peak_rss():
+    # High-water mark of resident memory in bytes
+    text = _read_proc("/proc/self/status")
+    if text is not None:
+        for line in text.splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def _reset_peak_rss():
+    # Linux resets VmHWM to the current RSS when "5" is written to clear_refs
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        _own_io[1] += 1
+        return True
+    except OSError:
+        return False
+
+class Stage:
+    """
+    One timed step of a trace.
+
+    Set `rows_out` (and, where known, `rows_in`, `bytes_read` or
+    `bytes_written`) inside the `with stage(...)` block. Explicit byte
+    counts win over the process I/O counters, which miss memory-mapped reads.
+    """
+
+    __slots__ = ("name", "parent", "depth", "rows_in", "rows_out", "seconds",
+                 "peak_rss", "bytes_read", "bytes_written", "profile", "_child_peak")
+
+    def __init__(self, name, parent=None, depth=0, rows_in=None):
+        self.name = name
+        self.parent = parent
+        self.depth = depth
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.seconds = None
+        self.peak_rss = None
+        self.bytes_read = None
+        self.bytes_written = None
+        self.profile = None
+        self._child_peak = 0
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "parent": self.parent,
+            "depth": self.depth,
+            "seconds": None if self.seconds is None else round(self.seconds, 6),
+            "rows_in": self.rows_in,
+            "rows_out": self.rows_out,
+            "peak_rss_mb": None if self.peak_rss is None else round(self.peak_rss / 2**20, 1),
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "profile": self.profile,
+        }
+
+class Trace:
+    """
+    Records every stage entered while the trace is active, in start order.
+
+    Library code calls `stage()` unconditionally; without an active trace
+    nothing is measured. `profile` names a stage to run under cProfile.
+    """
+
+    def __init__(self, name, profile=None):
+        self.name = name
+        self.profile = profile
+        self.stages = []
+        self._stack = []
+        self._resets = _reset_peak_rss()
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        parent = self._stack[-1] if self._stack else None
+        record = Stage(name, parent.name if parent else None, len(self._stack), rows_in)
+        self.stages.append(record)
+
+        # Resetting the high-water mark would hide the parent's peak so far, keep it
+        if parent is not None:
+            parent._child_peak = max(parent._child_peak, _peak_rss())
+        if self._resets:
+            _reset_peak_rss()
+
+        profiler = cProfile.Profile() if self.profile and name == self.profile else None
+        io_start = _io_counters()
+        self._stack.append(record)
+        start = time.perf_counter()
+        try:
+            if profiler is not None:
+                profiler.enable()
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            record.seconds = time.perf_counter() - start
+            self._stack.pop()
+            record.peak_rss = max(_peak_rss(), record._child_peak)
+            if parent is not None:
+                parent._child_peak = max(parent._child_peak, record.peak_rss)
+            io_end = _io_counters()
+            if io_start[0] is not None:
+                if record.bytes_read is None:
+                    record.bytes_read = io_end[0] - io_start[0]
+                if record.bytes_written is None:
+                    record.bytes_written = io_end[1] - io_start[1]
+            if profiler is not None:
+                out = io.StringIO()
+                pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(PROFILE_LINES)
+                record.profile = out.getvalue()
+
+    def open_stages(self):
+        """Names of the stages currently running, outermost first."""
+        return [s.name for s in list(self._stack)]
+
+    def adopt(self, stages):
+        """Append stages recorded elsewhere (e.g. in a worker process) under the current stage."""
+        parent = self._stack[-1] if self._stack else None
+        base = len(self._stack)
+        for data in stages:
+            record = Stage(data["name"], data["parent"], data["depth"] + base, data["rows_in"])
+            if data["depth"] == 0 and parent is not None:
+                record.parent = parent.name
+            record.rows_out = data["rows_out"]
+            record.seconds = data["seconds"]
+            record.peak_rss = None if data["peak_rss_mb"] is None else data["peak_rss_mb"] * 2**20
+            record.bytes_read = data["bytes_read"]
+            record.bytes_written = data["bytes_written"]
+            record.profile = data["profile"]
+            self.stages.append(record)
+
+    def to_dict(self):
+        return {"name": self.name, "stages": [s.to_dict() for s in self.stages]}
+
+    def to_frame(self):
+        """Stages as a DataFrame, names indented by depth, for display."""
+        rows = []
+        for s in self.stages:
+            row = s.to_dict()
+            row["name"] = "  " * s.depth + s.name
+            del row["parent"], row["depth"], row["profile"]
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+    def write(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+def current_trace():
+    return _current.get()
+
+@contextmanager
+def tracing(name, profile=None):
+    """Activate a new Trace for the duration of the block and yield it."""
+    trace = Trace(name, profile)
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+
+@contextmanager
+def stage(name, rows_in=None):
+    """Time a step in the active trace, if any. Yields a Stage to fill in rows and bytes."""
+    trace = _current.get()
+    if trace is None:
+        yield Stage(name, rows_in=rows_in)
+        return
+    with trace.stage(name, rows_in) as record:
+        yield record
+
+@contextmanager
+def trace_from_env(name):
+    """
+    Trace a CLI run when PIPELINE_TRACE is set and write the JSON trace there on exit.
+
+    PIPELINE_PROFILE optionally names one stage to run under cProfile.
+    """
+    path = os.environ.get(TRACE_ENV)
+    if not path:
+        yield None
+        return
+    with tracing(name, os.environ.get(PROFILE_ENV)) as trace:
+        try:
+            yield trace
+        finally:
+            trace.write(path)
+            print(f"Trace written: {path}")
+
+def run_traced(func, label, profile, *args):
+    """Call `func(*args)` as stage `label` of a fresh trace and return (result, stages). Used in worker processes."""
+    with tracing(label, profile) as trace:
+        with trace.stage(label):
+            result = func(*args)
+    return result, trace.to_dict()["stages"]
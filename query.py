@@ -0,0 +1,237 @@
+import os
+import re
+import sys
+import argparse
+import duckdb
+import pandas as pd
+from store import STORE_EXT
+from profiling import stage
+
+# Aggregations the dashboard can push down, by label
+AGGREGATES = {"count": "COUNT(*)", "sum": "SUM({})", "mean": "AVG({})", "min": "MIN({})", "max": "MAX({})"}
+# Date buckets for datetime axes
+BUCKETS = ["hour", "day", "week", "month", "quarter", "year"]
+# Rows returned for charts that plot individual points (scatter, box), sampled beyond that
+POINT_LIMIT = 50_000
+# Bins of a histogram over a numeric column
+HISTOGRAM_BINS = 50
+# Label for values folded together by `fold`
+OTHER = "other"
+# Rows per page of the table view
+PAGE_ROWS = 100
+
+def table_name(path):
+    """View name for a store file: '1_processed.parquet' -> processed, 'watch-history-joined' -> watch_history_joined."""
+    stem = os.path.splitext(os.path.basename(path.rstrip(os.sep)))[0]
+    return re.sub(r"\W+", "_", stem).lstrip("_0123456789") or "t"
+
+def quote(name):
+    """Quote an identifier for SQL (column names such as '21' or 'name.1' need it)."""
+    return '"' + str(name).replace('"', '""') + '"'
+
+def literal(value):
+    """Quote a value as an SQL string literal."""
+    return "'" + str(value).replace("'", "''") + "'"
+
+def fold(column, keep, other=OTHER):
+    """SQL expression for `column` as text, with every value not in `keep` replaced by `other`."""
+    if not keep:
+        return literal(other)
+    return (f"CASE WHEN CAST({quote(column)} AS VARCHAR) IN ({', '.join(literal(v) for v in keep)})"
+            f" THEN CAST({quote(column)} AS VARCHAR) ELSE {literal(other)} END")
+
+def _scan(path):
+    # A directory of parts is read as one table, with columns matched by name
+    # across parts so a part that lacks a column or has it all null still reads
+    if os.path.isdir(path):
+        path = os.path.join(path, f"*{STORE_EXT}")
+        return "read_parquet('" + path.replace("'", "''") + "', union_by_name = true)"
+    return "read_parquet('" + path.replace("'", "''") + "')"
+
+def store_tables(directory):
+    """{view name: path} for every store file (or directory of parts) in `directory`."""
+    tables = {}
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if name.endswith(STORE_EXT):
+            tables[table_name(path)] = path
+    return tables
+
+def connect(directory=None, timezone=None, paths=()):
+    """
+    In-process DuckDB connection with one view per store file.
+
+    Views read the Parquet files lazily, so filters and group-bys run in
+    DuckDB and only their result is materialized. `timezone` sets the
+    session zone used to display and bucket timezone-aware times.
+    """
+    con = duckdb.connect()
+    if timezone:
+        con.execute("SET TimeZone = '" + timezone.replace("'", "''") + "'")
+    tables = store_tables(directory) if directory else {}
+    tables.update({table_name(p): p for p in paths})
+    for name, path in tables.items():
+        con.execute(f"CREATE VIEW {quote(name)} AS SELECT * FROM {_scan(path)}")
+    return con
+
+def run(con, sql, params=None):
+    """Run a query and return the result as a DataFrame."""
+    with stage("query") as s:
+        df = con.execute(sql, params or []).df()
+        s.rows_out = len(df)
+    return df
+
+def columns(con, table):
+    """(name, DuckDB type) of every column of `table`."""
+    return [(row[0], row[1]) for row in con.execute(f"DESCRIBE {quote(table)}").fetchall()]
+
+def column_kinds(con, table):
+    """Columns of `table` grouped as numeric, datetime, text and list (lists are not charted)."""
+    kinds = {"numeric": [], "datetime": [], "text": [], "list": []}
+    for name, kind in columns(con, table):
+        if kind.endswith("[]") or kind.startswith(("STRUCT", "MAP")):
+            kinds["list"].append(name)
+        elif kind.startswith(("TIMESTAMP", "DATE")):
+            kinds["datetime"].append(name)
+        elif kind in ("VARCHAR", "BOOLEAN") or kind.startswith("ENUM"):
+            kinds["text"].append(name)
+        else:
+            kinds["numeric"].append(name)
+    return kinds
+
+def where_clause(filters=None, date_column=None, start=None, end=None, search=None, search_columns=()):
+    """
+    SQL condition and parameters for value filters, a date range and a text search.
+
+    `filters` maps a column to the values to keep. `start` is inclusive
+    and `end` exclusive, compared in the session timezone. `search` keeps
+    rows where any of `search_columns` contains it, ignoring case.
+    """
+    conditions, params = [], []
+    if search and search_columns:
+        pattern = "%" + search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        conditions.append("(" + " OR ".join(f"{quote(c)} ILIKE ? ESCAPE '\\'" for c in search_columns) + ")")
+        params.extend([pattern] * len(search_columns))
+    for col, values in (filters or {}).items():
+        if values:
+            conditions.append(f"{quote(col)} IN ({', '.join('?' for _ in values)})")
+            params.extend(values)
+    if date_column is not None:
+        if start is not None:
+            conditions.append(f"{quote(date_column)} >= CAST(? AS TIMESTAMPTZ)")
+            params.append(str(start))
+        if end is not None:
+            conditions.append(f"{quote(date_column)} < CAST(? AS TIMESTAMPTZ)")
+            params.append(str(end))
+    return (" WHERE " + " AND ".join(conditions)) if conditions else "", params
+
+def _color_key(color, keep):
+    if not color:
+        return []
+    return [quote(color) if keep is None else f"{fold(color, keep)} AS {quote(color)}"]
+
+def group_query(table, x, y=None, how="count", color=None, bucket=None, where="", limit=None, keep=None):
+    """
+    SQL that groups `table` by `x` (and `color`) and aggregates `y`.
+
+    Datetime `x` columns are truncated to `bucket` first. The value column
+    is named after `y`, or 'count'. With `keep`, color values outside it
+    are grouped together as 'other'.
+    """
+    x_expr = f"date_trunc('{bucket}', {quote(x)})" if bucket else quote(x)
+    value = "count" if how == "count" or y is None else y
+    agg = AGGREGATES["count"] if value == "count" else AGGREGATES[how].format(quote(y))
+    keys = [f"{x_expr} AS {quote(x)}"] + _color_key(color, keep)
+    sql = (f"SELECT {', '.join(keys)}, {agg} AS {quote(value)} FROM {quote(table)}{where}"
+           f" GROUP BY ALL ORDER BY {quote(x)}")
+    if limit:
+        sql += f" LIMIT {int(limit)}"
+    return sql
+
+def histogram_query(table, x, low, high, bins=HISTOGRAM_BINS, color=None, where="", keep=None, y=None, how="count"):
+    """
+    SQL aggregating the rows of `table` in `bins` equal-width bins of numeric `x` between `low` and `high`.
+
+    Each row is one bin, `x` being its lower edge, so the browser gets
+    `bins` bars per color instead of every value. Rows are counted, or
+    `y` is aggregated by `how` as in group_query.
+    """
+    width = (float(high) - float(low)) / bins or 1.0
+    index = f"LEAST(FLOOR(({quote(x)} - {float(low)!r}) / {width!r}), {bins - 1})"
+    value = "count" if how == "count" or y is None else y
+    agg = AGGREGATES["count"] if value == "count" else AGGREGATES[how].format(quote(y))
+    keys = [f"{float(low)!r} + {index} * {width!r} AS {quote(x)}"] + _color_key(color, keep)
+    return (f"SELECT {', '.join(keys)}, {agg} AS {quote(value)} FROM {quote(table)}{where}"
+            f"{' AND ' if where else ' WHERE '}{quote(x)} IS NOT NULL GROUP BY ALL ORDER BY {quote(x)}")
+
+def points_query(table, cols, where="", limit=POINT_LIMIT):
+    """SQL selecting `cols` of at most `limit` rows, sampled when there are more."""
+    selected = ", ".join(quote(c) for c in dict.fromkeys(c for c in cols if c))
+    return f"SELECT {selected} FROM (SELECT * FROM {quote(table)}{where}) USING SAMPLE reservoir({int(limit)} ROWS) REPEATABLE (0)"
+
+def page_query(table, cols, where="", order=None, descending=False, limit=PAGE_ROWS, offset=0, lengths=()):
+    """
+    SQL for `limit` rows of `table` starting at `offset`, sorted by `order`.
+
+    List columns named in `lengths` are returned as their length only
+    ('time_list (n)'), so a page never carries them. Ties are broken on
+    the other columns, so a row keeps its position between queries.
+    """
+    selected = [quote(c) for c in cols] + [f"len({quote(c)}) AS {quote(c + ' (n)')}" for c in lengths]
+    sql = f"SELECT {', '.join(selected)} FROM {quote(table)}{where}"
+    if order:
+        direction = "DESC" if descending else "ASC"
+        sql += f" ORDER BY {quote(order)} {direction} NULLS LAST, " + ", ".join(quote(c) for c in cols if c != order)
+    return sql + f" LIMIT {int(limit)} OFFSET {int(offset)}"
+
+def count_rows(con, table, where="", params=None):
+    """Number of rows of `table` matching `where`."""
+    return con.execute(f"SELECT COUNT(*) FROM {quote(table)}{where}", params or []).fetchone()[0]
+
+def distinct_count(con, table, column, where="", params=None):
+    """Number of distinct non-null values of `column` among rows matching `where`."""
+    return con.execute(f"SELECT COUNT(DISTINCT {quote(column)}) FROM {quote(table)}{where}", params or []).fetchone()[0]
+
+def top_values(con, table, column, limit=50, where="", params=None, by=AGGREGATES["count"]):
+    """
+    The `limit` most frequent values of `column` among rows matching `where`, for filter pickers.
+
+    `by` ranks the values by another aggregate instead, e.g. 'SUM("frequency")'.
+    """
+    sql = (f"SELECT {quote(column)} FROM {quote(table)}{where}{' AND ' if where else ' WHERE '}{quote(column)} IS NOT NULL"
+           f" GROUP BY 1 ORDER BY {by} DESC NULLS LAST, 1 LIMIT {int(limit)}")
+    return [row[0] for row in con.execute(sql, params or []).fetchall()]
+
+def time_range(con, table, column, where="", params=None):
+    """(min, max) of a datetime or numeric column."""
+    return con.execute(f"SELECT MIN({quote(column)}), MAX({quote(column)}) FROM {quote(table)}{where}", params or []).fetchone()
+
+def main():
+    parser = argparse.ArgumentParser(description="Run SQL over the pipeline outputs. Every store file is a view, e.g. 'watch-history-aggregated.parquet' is watch_history_aggregated.")
+    parser.add_argument("sql", nargs="?", help="query to run; omit to list the tables")
+    parser.add_argument("--dir", default="output", help="directory holding the store files (default: output)")
+    parser.add_argument("--timezone", help="timezone to show times in")
+    parser.add_argument("--output", help="write the result to .csv or .parquet instead of printing it")
+    parser.add_argument("--max-rows", type=int, default=50, help="rows to print")
+    args = parser.parse_args()
+
+    con = connect(args.dir, args.timezone)
+    if not args.sql:
+        for name, path in store_tables(args.dir).items():
+            cols = ", ".join(f"{c} {t}" for c, t in columns(con, name))
+            print(f"{name}  ({os.path.basename(path)})\n    {cols}")
+        return
+
+    df = run(con, args.sql)
+    if args.output:
+        if args.output.endswith(".csv"):
+            df.to_csv(args.output, index=False)
+        else:
+            df.to_parquet(args.output, index=False)
+        print(f"{len(df)} rows written to {args.output}")
+    else:
+        with pd.option_context("display.max_rows", args.max_rows, "display.width", 200):
+            print(df)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,256 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from ingest import event_hashes, first_new_events, sorted_unique
+from store import STORE_EXT, index_path, read_frame, read_index, sidecar_path, write_frame, write_index
+from profiling import stage
+
+# Text indexed per history kind, as (document kind, column)
+WATCH_FIELDS = [('title', 'title'), ('channel', 'channel_name')]
+SEARCH_FIELDS = [('query', 'title')]
+
+# Words are split on anything but letters, digits, marks and '_', and compared lower-cased
+SEPARATOR_PATTERN = r'[^\p{L}\p{N}\p{M}_]+'
+# Longer words are cut to this many characters (still found by prefix)
+MAX_TERM_LENGTH = 32
+# Results returned for a query
+RESULT_LIMIT = 50
+# Suffix of the term arrays next to the history file
+ARRAYS_EXT = '.search.npz'
+
+def _words(texts):
+    # Lower-cased words of all texts in one Arrow array, with the position of the text each came from
+    lists = pc.split_pattern_regex(pc.utf8_lower(pa.array(texts, pa.string(), from_pandas=True)), pattern=SEPARATOR_PATTERN)
+    words, parents = pc.list_flatten(lists), pc.list_parent_indices(lists)
+    keep = pc.not_equal(words, '')
+    return pc.utf8_slice_codeunits(words.filter(keep), 0, MAX_TERM_LENGTH), parents.filter(keep).to_numpy()
+
+def tokenize(text):
+    """Lower-cased words of `text`, cut to MAX_TERM_LENGTH."""
+    return _words([text])[0].to_pylist()
+
+def history_documents(df, search=False):
+    """
+    Distinct texts of a history frame as documents: kind, text, count and last time.
+
+    Watch history gives video titles and channel names, search history its
+    queries. `count` is the number of events carrying the text.
+    """
+    frames = []
+    for kind, col in (SEARCH_FIELDS if search else WATCH_FIELDS):
+        if col not in df.columns:
+            continue
+        part = pd.DataFrame({'text': df[col].astype(object), 'time': df['time']}).dropna(subset=['text'])
+        grouped = part.groupby('text', sort=False).agg(count=('time', 'size'), last_time=('time', 'max'))
+        grouped.insert(0, 'kind', kind)
+        frames.append(grouped.reset_index()[['kind', 'text', 'count', 'last_time']])
+    if not frames:
+        return pd.DataFrame({'kind': [], 'text': [], 'count': np.array([], dtype=np.int64), 'last_time': df['time'].iloc[:0]})
+    return pd.concat(frames, ignore_index=True)
+
+def document_keys(docs):
+    """Hash each document's (kind, text) into a uint64 key."""
+    return pd.util.hash_pandas_object(docs[['kind', 'text']].astype(object), index=False).to_numpy()
+
+def _postings(docs, first_id):
+    # Sorted vocabulary of `docs` and (term id, document id) pairs, documents numbered from `first_id`
+    words, parents = _words(docs['text'].astype(object).to_numpy())
+    encoded = words.dictionary_encode()
+    order = pc.sort_indices(encoded.dictionary).to_numpy()
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    vocabulary = encoded.dictionary.take(order).to_numpy(zero_copy_only=False).astype(str)
+    return vocabulary, rank[encoded.indices.to_numpy()], parents + first_id
+
+def _csr(n_terms, n_docs, term_ids, doc_ids):
+    # One sort of term * n_docs + doc orders the pairs by term, then document, and drops repeats
+    pairs = sorted_unique(term_ids * n_docs + doc_ids)
+    counts = np.bincount(pairs // n_docs, minlength=n_terms)
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    return offsets, (pairs % n_docs).astype(np.int32)
+
+class SearchIndex:
+    """
+    Inverted index from words to the documents containing them.
+
+    `terms` is the sorted array of distinct words; the documents of term i
+    are ``postings[offsets[i]:offsets[i + 1]]``, sorted. Words with a given
+    prefix form one run of `terms`, so a prefix lookup is two binary
+    searches and one slice of `postings`.
+    """
+
+    def __init__(self, docs, terms, offsets, postings):
+        self.docs = docs
+        self.terms = terms
+        self.offsets = offsets
+        self.postings = postings
+
+    @classmethod
+    def build(cls, docs):
+        """Index the documents of `docs` (see history_documents)."""
+        docs = docs.reset_index(drop=True)
+        terms, term_ids, doc_ids = _postings(docs, 0)
+        offsets, postings = _csr(len(terms), max(len(docs), 1), term_ids, doc_ids)
+        return cls(docs, terms, offsets, postings)
+
+    def add(self, docs):
+        """
+        Merge new `docs` into the index, returning a new index.
+
+        Texts already indexed only have their count and last time updated;
+        only new texts are tokenized and posted.
+        """
+        keys = document_keys(docs)
+        existing = pd.Index(document_keys(self.docs))
+        pos = existing.get_indexer(keys)
+        known = pos >= 0
+
+        merged = self.docs.copy()
+        counts = merged['count'].to_numpy(dtype=np.int64, copy=True)
+        np.add.at(counts, pos[known], docs['count'].to_numpy()[known])
+        merged['count'] = counts
+        times = pd.DataFrame({'old': merged['last_time'].iloc[pos[known]].to_numpy(),
+                              'new': docs['last_time'][known].to_numpy()})
+        merged.loc[pos[known], 'last_time'] = times.max(axis=1).to_numpy()
+
+        added = docs[~known].reset_index(drop=True)
+        if added.empty:
+            return SearchIndex(merged, self.terms, self.offsets, self.postings)
+        merged = pd.concat([merged, added], ignore_index=True)
+
+        # Insert the new words into the sorted vocabulary and shift the old term ids past them
+        new_terms, new_term_ids, new_doc_ids = _postings(added, len(self.docs))
+        at = np.searchsorted(self.terms, new_terms)
+        unseen = at == len(self.terms)
+        unseen[~unseen] = self.terms[at[~unseen]] != new_terms[~unseen]
+        # Widened first, np.insert would cut longer words to the old width
+        terms = np.insert(self.terms.astype(np.result_type(self.terms, new_terms)), at[unseen], new_terms[unseen])
+        shift = np.cumsum(np.bincount(at[unseen], minlength=len(self.terms) + 1))[:len(self.terms)]
+        old_term_ids = np.repeat(np.arange(len(self.terms)) + shift, np.diff(self.offsets))
+        new_term_ids = np.searchsorted(terms, new_terms)[new_term_ids]
+
+        offsets, postings = _csr(len(terms), len(merged),
+                                 np.concatenate([old_term_ids, new_term_ids]),
+                                 np.concatenate([self.postings.astype(np.int64), new_doc_ids]))
+        return SearchIndex(merged, terms, offsets, postings)
+
+    def matches(self, query, kinds=None):
+        """Sorted ids of documents (of `kinds`, if given) containing a word starting with each word of `query`."""
+        # Postings of each word's run of terms, narrowest first
+        runs = []
+        for token in tokenize(query):
+            lo = np.searchsorted(self.terms, token, side='left')
+            hi = np.searchsorted(self.terms, token + '\U0010ffff', side='left')
+            runs.append(self.postings[self.offsets[lo]:self.offsets[hi]])
+        if not runs:
+            return np.array([], dtype=np.int64)
+        runs.sort(key=len)
+        # A run may post a document under several words; marking documents avoids sorting it
+        hit = np.zeros(len(self.docs), dtype=bool)
+        hit[runs[0]] = True
+        result = np.flatnonzero(hit)
+        for run in runs[1:]:
+            if len(result) == 0:
+                break
+            hit[:] = False
+            hit[run] = True
+            result = result[hit[result]]
+        if kinds:
+            result = result[self.docs['kind'].isin(kinds).to_numpy()[result]]
+        return result
+
+    def search(self, query, limit=RESULT_LIMIT, kinds=None):
+        """Documents matching `query`, most frequent first, then most recent."""
+        ids = self.matches(query, kinds)
+        # Only the most frequent matches are looked up and sorted, the match set can be large
+        if len(ids) > limit:
+            counts = self.docs['count'].to_numpy()[ids]
+            ids = ids[counts >= np.partition(counts, len(counts) - limit)[len(counts) - limit]]
+        found = self.docs.iloc[ids]
+        return found.sort_values(['count', 'last_time'], ascending=False, kind='stable').head(limit)
+
+    def __len__(self):
+        return len(self.docs)
+
+def search_paths(path):
+    """Documents, term arrays and event keys of the index kept next to history file `path`."""
+    stem = os.path.splitext(path.rstrip(os.sep))[0]
+    return sidecar_path(path, 'search'), stem + ARRAYS_EXT, index_path(path, 'search-events')
+
+def read_search_index(path):
+    """(index, event keys) kept next to `path`, or (None, None) if there is none."""
+    docs_path, arrays_path, keys_path = search_paths(path)
+    if not (os.path.exists(docs_path) and os.path.exists(arrays_path)):
+        return None, None
+    with np.load(arrays_path) as arrays:
+        index = SearchIndex(read_frame(docs_path), arrays['terms'], arrays['offsets'], arrays['postings'])
+    return index, read_index(keys_path)
+
+def write_search_index(index, keys, path):
+    docs_path, arrays_path, keys_path = search_paths(path)
+    write_frame(index.docs, docs_path)
+    with open(arrays_path, 'wb') as f:
+        np.savez(f, terms=index.terms, offsets=index.offsets, postings=index.postings)
+    write_index(keys, keys_path)
+
+def update_search_index(df, index=None, existing_keys=None, search=False):
+    """
+    Incrementally index the history frame `df` into `index`.
+
+    `existing_keys` is the sorted event-key index of everything already
+    indexed; only events missing from it are counted and their new texts
+    tokenized. Returns (index, keys), or (None, existing_keys) when there
+    is nothing new.
+    """
+    with stage("search index", rows_in=len(df)) as s:
+        if index is None or existing_keys is None:
+            index, existing_keys = None, None
+        keys = event_hashes(df)
+        new = first_new_events(keys, existing_keys)
+        if existing_keys is not None and not new.any():
+            return None, existing_keys
+        docs = history_documents(df[new] if not new.all() else df, search)
+        index = SearchIndex.build(docs) if index is None else index.add(docs)
+        s.rows_out = len(index)
+        all_keys = keys if existing_keys is None else np.concatenate([existing_keys, keys[new]])
+    return index, sorted_unique(all_keys)
+
+def find_indexes(directory):
+    """History files in `directory` that have a search index next to them."""
+    found = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(ARRAYS_EXT):
+            found.append(os.path.join(directory, name[:-len(ARRAYS_EXT)] + STORE_EXT))
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description="Search watched titles, channel names and search queries. Every word matches as a prefix, case-insensitively.")
+    parser.add_argument("query", help="words to look for, e.g. 'lofi beat'")
+    parser.add_argument("--dir", default="output", help="directory holding the history files and their indexes (default: output)")
+    parser.add_argument("--kind", action="append", choices=[k for k, _ in WATCH_FIELDS + SEARCH_FIELDS], help="only this kind of text (repeatable)")
+    parser.add_argument("--limit", type=int, default=20, help="results to print per index")
+    args = parser.parse_args()
+
+    paths = find_indexes(args.dir)
+    if not paths:
+        print(f"No search index in {args.dir}; run the merge step first.")
+        return 1
+    for path in paths:
+        index, _ = read_search_index(path)
+        start = time.perf_counter()
+        found = index.search(args.query, args.limit, args.kind)
+        ms = (time.perf_counter() - start) * 1000
+        total = len(index.matches(args.query, args.kind))
+        print(f"{os.path.basename(path)}: {total} of {len(index)} texts match ({ms:.1f} ms)")
+        with pd.option_context("display.max_rows", args.limit, "display.width", 200, "display.max_colwidth", 80):
+            if not found.empty:
+                print(found.to_string(index=False))
+        print()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,424 @@
+import io
+import os
+import gzip
+import hashlib
+import shutil
+import threading
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import xlsxwriter
+from profiling import stage
+
+# Intermediate outputs are kept as Parquet so dtypes survive between stages.
+# Excel is only written when explicitly exported.
+STORE_EXT = ".parquet"
+
+# Formats a store file can be exported to on request, by suffix, with their MIME type
+EXPORT_FORMATS = {
+    ".xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    ".csv.gz": "application/gzip",
+    ".parquet": "application/vnd.apache.parquet",
+}
+# Rows read from the store at a time while exporting
+EXPORT_BATCH_ROWS = 50_000
+# Data rows that fit on an Excel sheet below the header
+EXCEL_MAX_ROWS = 1_048_575
+
+def index_path(path, name="events"):
+    """Return the path of a sidecar index file stored next to `path`."""
+    return f"{os.path.splitext(path)[0]}.{name}.npy"
+
+def sidecar_path(path, name):
+    """Return the path of a sidecar table stored next to `path`, e.g. 2_aggregated.timeline.parquet."""
+    return f"{os.path.splitext(path)[0]}.{name}{STORE_EXT}"
+
+def _prepare_for_parquet(df):
+    # Sets (e.g. aggregate 'time_list') have no Parquet type, store them as sorted lists
+    df = df.copy()
+    for col in df.columns:
+        if df[col].dtype == "object":
+            sample = df[col].dropna()
+            first = None if sample.empty else sample.iloc[0]
+            if first is not None and not isinstance(first, str) and pd.api.types.is_list_like(first):
+                df[col] = df[col].apply(lambda x: sorted(x) if isinstance(x, (set, frozenset)) else x)
+    return df
+
+def concat_frames(frames):
+    """
+    Concatenate frames row-wise, keeping categorical columns categorical.
+
+    pd.concat falls back to object strings when categories differ between
+    frames, so the categories of each categorical column are unioned first.
+    """
+    frames = list(frames)
+    if not frames:
+        return pd.DataFrame()
+
+    categorical = set()
+    for df in frames:
+        categorical.update(col for col in df.columns if isinstance(df[col].dtype, pd.CategoricalDtype))
+
+    dtypes = {}
+    for col in categorical:
+        # Union in order of first appearance
+        values = {}
+        for df in frames:
+            if col not in df.columns:
+                continue
+            if isinstance(df[col].dtype, pd.CategoricalDtype):
+                values.update(dict.fromkeys(df[col].cat.categories))
+            else:
+                values.update(dict.fromkeys(df[col].dropna().unique()))
+        dtypes[col] = pd.CategoricalDtype(list(values))
+
+    if dtypes:
+        frames = [df.astype({col: dtype for col, dtype in dtypes.items() if col in df.columns}) for df in frames]
+    return pd.concat(frames, ignore_index=True)
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def write_frame(df, path):
+    """Write a DataFrame to the columnar store."""
+    with stage(f"write {os.path.basename(path)}", rows_in=len(df)) as s:
+        df = _prepare_for_parquet(df)
+        if os.path.isdir(path):
+            _remove(path)
+        df.to_parquet(path, index=False, engine="pyarrow")
+        s.rows_out = len(df)
+        s.bytes_written = os.path.getsize(path)
+
+def _stable_type(arrow_type):
+    # All-null columns get a concrete type and dictionaries one index width,
+    # so a column keeps its type from part to part
+    if pa.types.is_null(arrow_type):
+        return pa.string()
+    if pa.types.is_dictionary(arrow_type):
+        return pa.dictionary(pa.int32(), _stable_type(arrow_type.value_type))
+    return arrow_type
+
+def _conform(table, schema):
+    # Cast `table` to the running part schema, extending the schema with columns seen for the first time
+    fields = {f.name: f for f in schema}
+    for field in table.schema:
+        if field.name not in fields:
+            fields[field.name] = pa.field(field.name, _stable_type(field.type))
+    columns = []
+    for name, field in fields.items():
+        if name not in table.column_names:
+            columns.append(pa.nulls(table.num_rows, field.type))
+            continue
+        column = table.column(name)
+        try:
+            columns.append(column.cast(field.type))
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+            # Values of another kind than earlier parts (generic path only), left for readers to unify
+            field = pa.field(name, column.type)
+            columns.append(column)
+        fields[name] = field
+    schema = pa.schema(list(fields.values()), metadata=table.schema.metadata)
+    return pa.Table.from_arrays(columns, schema=schema), schema
+
+def write_frame_chunks(chunks, path):
+    """
+    Write an iterable of DataFrames to the store one part file at a time.
+
+    The output is a directory of Parquet parts, so only one chunk is held in
+    memory. Parts share one schema: a column that is all null in one chunk
+    is still typed, and a column missing from a chunk is written as nulls.
+    Returns the row count.
+    """
+    _remove(path)
+    os.makedirs(path)
+    rows = 0
+    schema = pa.schema([])
+    for i, chunk in enumerate(chunks):
+        part = os.path.join(path, f"part-{i:05d}{STORE_EXT}")
+        with stage(f"write {os.path.basename(path)}/{os.path.basename(part)}", rows_in=len(chunk)) as s:
+            table = pa.Table.from_pandas(_prepare_for_parquet(chunk), preserve_index=False)
+            table, schema = _conform(table, schema)
+            pq.write_table(table, part)
+            s.rows_out = len(chunk)
+            s.bytes_written = os.path.getsize(part)
+        rows += len(chunk)
+    return rows
+
+def _arrow_types(arrow_type):
+    # List columns (e.g. 'time_list') stay in Arrow's offsets + values layout
+    if pa.types.is_list(arrow_type) or pa.types.is_large_list(arrow_type):
+        return pd.ArrowDtype(arrow_type)
+    return None
+
+def _read_parquet(path, columns=None):
+    table = pq.read_table(path, columns=columns, memory_map=True)
+    return table.to_pandas(types_mapper=_arrow_types)
+
+def read_frame(path, columns=None):
+    """
+    Read a DataFrame from the columnar store (a single file or a directory of parts).
+
+    Files are memory-mapped and list columns are returned as Arrow-backed
+    columns rather than Python objects.
+    """
+    with stage(f"read {os.path.basename(path)}") as s:
+        df = _read_frame(path, columns)
+        s.rows_out = len(df)
+        # Memory-mapped reads are not seen by the I/O counters
+        s.bytes_read = file_signature(path)[1]
+    return df
+
+def _read_frame(path, columns=None):
+    if os.path.isdir(path):
+        parts = sorted(f for f in os.listdir(path) if f.endswith(STORE_EXT))
+        frames = [_read_parquet(os.path.join(path, f)) for f in parts]
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        df = concat_frames(frames)
+        return df if columns is None else df.reindex(columns=columns)
+    return _read_parquet(path, columns)
+
+def file_signature(path):
+    """(mtime, size) of a store file, or of the newest part in a directory of parts."""
+    if os.path.isdir(path):
+        stats = [os.stat(os.path.join(path, f)) for f in os.listdir(path) if f.endswith(STORE_EXT)]
+        stats.append(os.stat(path))
+        return max(st.st_mtime_ns for st in stats), sum(st.st_size for st in stats)
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+def content_key(data, *params):
+    """Hash of file contents plus any parameters that change how they are parsed."""
+    digest = hashlib.sha256(data)
+    for param in params:
+        digest.update(b"\0" + str(param).encode())
+    return digest.hexdigest()
+
+class DiskCache:
+    """
+    Persistent cache of frames in the store, one Parquet file per key.
+
+    Survives restarts. Each hit bumps the file's mtime, and the least
+    recently used files are deleted once the directory exceeds `max_bytes`.
+    `hits` and `misses` count lookups made through this instance.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + STORE_EXT)
+
+    def get(self, key):
+        """Return the cached frame for `key`, or None."""
+        path = self._path(key)
+        try:
+            df = read_frame(path)
+            os.utime(path)
+        except (OSError, pa.ArrowInvalid):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return df
+
+    def put(self, key, df):
+        """Store `df` under `key` and evict old entries over the size cap."""
+        path = self._path(key)
+        # Write to a temporary name so a reader never sees a partial file
+        tmp = f"{path}.{os.getpid()}.tmp"
+        _prepare_for_parquet(df).to_parquet(tmp, index=False, engine="pyarrow")
+        os.replace(tmp, path)
+        with self._lock:
+            self._evict(keep=path)
+
+    def _entries(self):
+        entries = []
+        for f in os.listdir(self.directory):
+            if f.endswith(STORE_EXT):
+                path = os.path.join(self.directory, f)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, path))
+        return entries
+
+    def _evict(self, keep=None):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            # Keep the entry just written, even if it alone exceeds the budget
+            if path == keep:
+                continue
+            os.remove(path)
+            total -= size
+
+    def clear(self):
+        with self._lock:
+            for _, _, path in self._entries():
+                os.remove(path)
+
+    @property
+    def nbytes(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def __len__(self):
+        return len(self._entries())
+
+def write_index(keys, path):
+    """Persist a sorted key array (e.g. event keys) as .npy."""
+    np.save(path, np.asarray(keys))
+
+def read_index(path, dtype=np.uint64):
+    """Load a key array written by write_index, or None if it does not exist."""
+    if not os.path.isfile(path):
+        return None
+    return np.load(path).astype(dtype, copy=False)
+
+def _join_arrow_list(series):
+    # Render each list as comma separated values without leaving Arrow
+    lists = series.array.__arrow_array__().combine_chunks()
+    values = lists.flatten()
+    if pa.types.is_timestamp(values.type):
+        # Lists read back from Parquet as timestamp[ms]; format whole seconds
+        values = values.cast(pa.timestamp("s", tz=values.type.tz), safe=False)
+        values = pc.strftime(values, format="%Y-%m-%d %H:%M:%S")
+    else:
+        values = values.cast(pa.string())
+    offsets = pc.subtract(lists.offsets, lists.offsets[0])
+    joined = pc.binary_join(pa.ListArray.from_arrays(offsets, values), ", ")
+    return pd.Series(joined.to_pandas(), index=series.index)
+
+def _prepare_for_excel(df):
+    df = df.copy()
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.ArrowDtype) and pa.types.is_list(df[col].dtype.pyarrow_dtype):
+            df[col] = _join_arrow_list(df[col])
+        elif df[col].dtype == "object":
+            sample = df[col].dropna()
+            if not sample.empty and not isinstance(sample.iloc[0], str) and pd.api.types.is_list_like(sample.iloc[0]):
+                df[col] = df[col].apply(lambda x: str(set(x)) if pd.api.types.is_list_like(x) else x)
+        # Excel cannot store timezone-aware datetimes
+        if isinstance(df[col].dtype, pd.DatetimeTZDtype):
+            df[col] = df[col].dt.tz_localize(None)
+    return df
+
+def _write_xlsx(frames, columns, out):
+    # xlsxwriter in constant-memory mode flushes each row once written,
+    # so memory stays flat however many rows are exported
+    workbook = xlsxwriter.Workbook(out, {
+        "constant_memory": True,
+        "strings_to_urls": False,  # Excel caps a sheet at 65,530 links
+        "nan_inf_to_errors": True,
+        "default_date_format": "yyyy-mm-dd hh:mm:ss",
+    })
+    sheet = workbook.add_worksheet()
+    sheet.write_row(0, 0, columns)
+    rows = 0
+    for df in frames:
+        df = _prepare_for_excel(df).head(EXCEL_MAX_ROWS - rows)
+        values = df.astype(object).where(df.notna(), None)
+        for row in values.itertuples(index=False, name=None):
+            rows += 1
+            sheet.write_row(rows, 0, row)
+        if rows >= EXCEL_MAX_ROWS:
+            break
+    workbook.close()
+    return rows
+
+def export_xlsx(df, path):
+    """Export a DataFrame to Excel. List columns are written as text."""
+    with stage(f"export {os.path.basename(path)}", rows_in=len(df)) as s:
+        s.rows_out = _write_xlsx([df], [str(c) for c in df.columns], path)
+        s.bytes_written = os.path.getsize(path)
+
+def _dataset(path):
+    # A directory of parts is read as one dataset. Its schema is unified over
+    # all parts, not taken from the first, so a column that is null there
+    # (or was written with a narrower type) keeps the values of later parts
+    if not os.path.isdir(path):
+        return ds.dataset(path, format="parquet")
+    parts = [os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith(STORE_EXT)]
+    schema = pa.unify_schemas([pq.read_schema(p) for p in parts], promote_options="permissive") if parts else None
+    return ds.dataset(parts, format="parquet", schema=schema)
+
+def export_columns(path):
+    """(all columns, timezone-aware or naive datetime columns) of a store file, from its schema."""
+    schema = _dataset(path).schema
+    return schema.names, [f.name for f in schema if pa.types.is_timestamp(f.type)]
+
+def date_range(path, column):
+    """(min, max) of a datetime column of a store file, reading only that column."""
+    values = _dataset(path).to_table(columns=[column]).column(column)
+    bounds = pc.min_max(values)
+    low, high = bounds["min"].as_py(), bounds["max"].as_py()
+    return (None, None) if low is None else (pd.Timestamp(low), pd.Timestamp(high))
+
+def _date_filter(dataset, column, start, end):
+    # Dates are compared as wall-clock days in the column's own timezone
+    kind = dataset.schema.field(column).type
+    def bound(day):
+        return pa.scalar(pd.Timestamp(day, tz=kind.tz).as_unit(kind.unit), type=kind)
+    conditions = []
+    if start is not None:
+        conditions.append(ds.field(column) >= bound(start))
+    if end is not None:
+        conditions.append(ds.field(column) < bound(end))
+    condition = None
+    for c in conditions:
+        condition = c if condition is None else condition & c
+    return condition
+
+def export_stream(path, out, fmt, columns=None, date_column=None, start=None, end=None):
+    """
+    Export a store file to `out` (a path or binary file object) as one of EXPORT_FORMATS.
+
+    The file is read and written EXPORT_BATCH_ROWS rows at a time, so
+    memory does not grow with its size. `columns` selects columns and
+    rows can be limited to start <= `date_column` < end (`end` exclusive).
+    Excel exports stop at EXCEL_MAX_ROWS. Returns the number of rows written.
+    """
+    dataset = _dataset(path)
+    columns = list(dict.fromkeys(columns)) if columns else None
+    condition = _date_filter(dataset, date_column, start, end) if date_column else None
+    scanner = dataset.scanner(columns=columns, filter=condition, batch_size=EXPORT_BATCH_ROWS)
+    batches = (b for b in scanner.to_batches() if b.num_rows)
+    frames = (b.to_pandas(types_mapper=_arrow_types) for b in batches)
+    name = os.path.basename(path.rstrip(os.sep))
+
+    with stage(f"export {name} as {fmt}") as s:
+        rows = 0
+        if fmt == ".parquet":
+            # Without the pandas metadata, so pd.read_parquet can open it anywhere
+            with pq.ParquetWriter(out, scanner.projected_schema.remove_metadata()) as writer:
+                for batch in batches:
+                    writer.write_batch(batch)
+                    rows += batch.num_rows
+        elif fmt == ".csv.gz":
+            with gzip.open(out, "wb") as compressed, io.TextIOWrapper(compressed, encoding="utf-8", newline="") as text:
+                for i, df in enumerate(frames):
+                    _prepare_for_excel(df).to_csv(text, index=False, header=i == 0)
+                    rows += len(df)
+                if rows == 0:
+                    text.write(",".join(scanner.projected_schema.names) + "\n")
+        elif fmt == ".xlsx":
+            rows = _write_xlsx(frames, scanner.projected_schema.names, out)
+        else:
+            raise ValueError(f"Unknown export format {fmt!r}, expected one of {', '.join(EXPORT_FORMATS)}")
+        s.rows_out = rows
+    return rows
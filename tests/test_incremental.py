@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+import pytest
+from benchmarks.synthetic import make_search_records, make_watch_records
+from ingest import drop_duplicate_events, flatten_json_to_dataframe
+from utils_1 import clean_on_merge
+from utils_2 import update_aggregate, update_cubes
+from search_index import update_search_index
+
+def merged_history(records, search=False):
+    """A cleaned history frame like the merge step writes: one row per event."""
+    df, _ = drop_duplicate_events(clean_on_merge(flatten_json_to_dataframe(records), search))
+    return df.reset_index(drop=True)
+
+@pytest.fixture(scope="module")
+def watch():
+    records = make_watch_records(3000, seed=1)
+    # An older export, then the merged history once a newer export overlapping it is added
+    return merged_history(records[:1800]), merged_history(records)
+
+def by_key(df, key):
+    return df.sort_values(key, kind="stable").reset_index(drop=True)
+
+def test_update_aggregate_incremental_matches_full(watch):
+    old, full = watch
+    expected, expected_keys = update_aggregate(full)
+    agg, keys = update_aggregate(old)
+    agg, keys = update_aggregate(full, agg, keys)
+
+    np.testing.assert_array_equal(keys, expected_keys)
+    assert sorted(agg.columns) == sorted(expected.columns)
+    agg, expected = by_key(agg[expected.columns], "titleUrl"), by_key(expected, "titleUrl")
+    pd.testing.assert_frame_equal(agg.drop(columns="time_list"), expected.drop(columns="time_list"), check_dtype=False)
+    assert agg["time_list"].tolist() == expected["time_list"].tolist()
+
+def test_update_aggregate_without_new_events(watch):
+    _, full = watch
+    agg, keys = update_aggregate(full)
+    unchanged, same_keys = update_aggregate(full, agg, keys)
+    assert unchanged is None and same_keys is keys
+
+def test_update_cubes_incremental_matches_full(watch):
+    old, full = watch
+    expected = update_cubes(full)
+    _, old_keys = update_aggregate(old)
+    cubes = update_cubes(full, update_cubes(old), old_keys)
+
+    assert set(cubes) == set(expected)
+    for name, cube in cubes.items():
+        keys = [c for c in cube.columns if c != "views"]
+        pd.testing.assert_frame_equal(by_key(cube, keys), by_key(expected[name], keys), check_dtype=False)
+
+@pytest.mark.parametrize("search", [False, True])
+def test_update_search_index_incremental_matches_full(search):
+    records = make_search_records(2000, seed=2) if search else make_watch_records(2000, seed=2)
+    old, full = merged_history(records[:1200], search), merged_history(records, search)
+    expected, expected_keys = update_search_index(full, search=search)
+    index, keys = update_search_index(old, search=search)
+    index, keys = update_search_index(full, index, keys, search=search)
+
+    np.testing.assert_array_equal(keys, expected_keys)
+    np.testing.assert_array_equal(index.terms, expected.terms)
+    docs, expected_docs = by_key(index.docs, ["kind", "text"]), by_key(expected.docs, ["kind", "text"])
+    pd.testing.assert_frame_equal(docs, expected_docs, check_dtype=False)
+    for query in ["video", "channel 1", "query 4", "title 12", "nothing here"]:
+        assert set(index.docs["text"].iloc[index.matches(query)]) == set(expected.docs["text"].iloc[expected.matches(query)])
+    unchanged, same_keys = update_search_index(full, index, keys, search=search)
+    assert unchanged is None and same_keys is keys
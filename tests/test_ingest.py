@@ -0,0 +1,90 @@
+import io
+import os
+import json
+import pytest
+import jobs
+from ingest import TAKEOUT_COLUMNS, flatten_json_to_dataframe, iter_json_records, map_files
+from utils_1 import clean_on_merge
+
+RECORDS = [
+    {"title": "Watched [live] {set}, part 1", "titleUrl": "https://www.youtube.com/watch?v=a1"},
+    {"title": "Say \"hi\" \\ ]\n", "n": 4.5e10, "list": [1, [2, {"x": "]"}]]},
+    {"title": "Ünïcödé ✓ 日本語", "empty": {}, "none": None, "flag": True},
+    -12,
+    "a string, with ] and [",
+]
+
+def records(text, buffer_size):
+    return list(iter_json_records(io.StringIO(text), buffer_size))
+
+@pytest.mark.parametrize("buffer_size", [1, 2, 3, 7, 64, 1 << 20])
+def test_records_match_json_loads_at_any_buffer_size(buffer_size):
+    text = json.dumps(RECORDS, ensure_ascii=False, indent=1)
+    assert records(text, buffer_size) == RECORDS
+
+@pytest.mark.parametrize("buffer_size", [1, 5])
+def test_bytes_input_with_multibyte_characters(buffer_size):
+    data = ("\ufeff" + json.dumps(RECORDS, ensure_ascii=False)).encode("utf-8")
+    fp = io.BytesIO(data)
+    assert list(iter_json_records(fp, buffer_size)) == RECORDS
+    # The caller's file is left open
+    assert not fp.closed
+
+@pytest.mark.parametrize("text", ["", "   \n", "[]", " [ \r\n ] ", "\ufeff[]"])
+def test_empty_inputs(text):
+    assert records(text, 2) == []
+
+def test_top_level_object_is_one_record():
+    assert records(' {"a": [1, 2]} ', 3) == [{"a": [1, 2]}]
+
+@pytest.mark.parametrize("text", ["[", '[{"a": 1},', '[{"a": 1}, {"b"'])
+def test_unterminated_array_raises(text):
+    with pytest.raises(ValueError):
+        records(text, 4)
+
+def test_unknown_top_level_keys_keep_the_takeout_columns():
+    records = [
+        {"header": "YouTube", "title": "Watched A", "titleUrl": "https://www.youtube.com/watch?v=a",
+         "subtitles": [{"name": "Channel A", "url": "https://www.youtube.com/channel/UCa"},
+                       {"name": "Channel B", "url": "https://www.youtube.com/channel/UCb"}],
+         "time": "2024-01-01T10:00:00Z", "locationInfos": [{"name": "At home", "source": "From your device"}]},
+        {"header": "YouTube", "title": "Watched Ad", "titleUrl": "https://www.youtube.com/watch?v=ad",
+         "time": "2024-01-01T11:00:00Z", "details": [{"name": "From Google Ads"}]},
+    ]
+    df = flatten_json_to_dataframe(records)
+    assert list(df.columns[:len(TAKEOUT_COLUMNS)]) == TAKEOUT_COLUMNS
+    assert df["channel_name"].iloc[0] == "Channel A"
+    assert df["details"].iloc[1] == "From Google Ads"
+
+    cleaned = clean_on_merge(df)
+    assert cleaned["titleUrl"].astype(str).tolist() == ["https://www.youtube.com/watch?v=a"]
+
+def test_cleaning_prunes_categories_of_dropped_rows():
+    records = [
+        {"header": "YouTube", "title": "Watched A", "titleUrl": "https://www.youtube.com/watch?v=a",
+         "time": "2024-01-01T10:00:00Z"},
+        {"header": "YouTube", "title": "Watched Ad", "titleUrl": "https://www.youtube.com/watch?v=ad",
+         "time": "2024-01-01T11:00:00Z", "details": [{"name": "From Google Ads"}]},
+        {"header": "YouTube", "title": "Visited https://www.google.com/", "titleUrl": "https://www.google.com/",
+         "time": "2024-01-01T12:00:00Z"},
+    ]
+    cleaned = clean_on_merge(flatten_json_to_dataframe(records))
+    assert cleaned["title"].cat.categories.tolist() == ["A"]
+    assert cleaned["titleUrl"].cat.categories.tolist() == ["https://www.youtube.com/watch?v=a"]
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_map_files_reports_failed_jobs_in_order(tmp_path, workers):
+    paths = [tmp_path / name for name in ("a", "missing", "b")]
+    paths[0].write_bytes(b"12")
+    paths[2].write_bytes(b"1234")
+    job = jobs.Job("sizes", [])
+    token = jobs._current.set(job)
+    try:
+        seen = []
+        for done, (args, size, error) in enumerate(map_files(os.path.getsize, [(str(p),) for p in paths], workers), 1):
+            # Progress is reported for every file, failed ones included
+            assert (job.done, job.total) == (done, len(paths))
+            seen.append((os.path.basename(args[0]), size, type(error)))
+    finally:
+        jobs._current.reset(token)
+    assert seen == [("a", 2, type(None)), ("missing", None, FileNotFoundError), ("b", 4, type(None))]
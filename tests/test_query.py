@@ -0,0 +1,16 @@
+import os
+import pandas as pd
+import query
+
+def test_connect_reads_parts_with_different_schemas(tmp_path):
+    path = tmp_path / "watch-history.parquet"
+    os.makedirs(path)
+    # 'details' is all null in the first part and 'source' only exists in the second
+    pd.DataFrame({"title": ["a", "b"], "details": [None, None]}).to_parquet(path / "part-00000.parquet", index=False)
+    pd.DataFrame({"title": ["c"], "details": ["From Google Ads"], "source": ["AB"]}).to_parquet(path / "part-00001.parquet", index=False)
+
+    con = query.connect(str(tmp_path))
+    df = query.run(con, 'SELECT title, details, source FROM watch_history ORDER BY title')
+    assert df["title"].tolist() == ["a", "b", "c"]
+    assert df["details"].tolist()[2] == "From Google Ads"
+    assert df["source"].isna().tolist() == [True, True, False]
@@ -0,0 +1,110 @@
+import io
+import os
+import gzip
+import json
+import pandas as pd
+import pyarrow.parquet as pq
+import query
+from benchmarks.synthetic import make_watch_records
+from ingest import convert_json_file
+from store import export_columns, export_stream, read_frame, write_frame
+from utils_2 import TimeList
+
+def write_mixed_parts(path):
+    """A directory store whose parts disagree: 'details' is all null in the first one, and 'title' widens its index."""
+    os.makedirs(path)
+    first = pd.DataFrame({
+        "title": pd.Categorical(["a", "b", "a"]),
+        "details": [None, None, None],
+        "time": pd.to_datetime(["2024-01-01", "2024-01-02", "2024-01-03"], utc=True),
+    })
+    second = pd.DataFrame({
+        "title": pd.Categorical([f"t{i}" for i in range(300)]),
+        "details": ["From Google Ads"] * 300,
+        "time": pd.date_range("2024-02-01", periods=300, freq="h", tz="UTC"),
+    })
+    first.to_parquet(os.path.join(path, "part-00000.parquet"), index=False)
+    second.to_parquet(os.path.join(path, "part-00001.parquet"), index=False)
+    return pd.concat([first.astype({"title": object}), second.astype({"title": object})], ignore_index=True)
+
+def test_export_columns_unifies_parts(tmp_path):
+    path = str(tmp_path / "history.parquet")
+    write_mixed_parts(path)
+    columns, dates = export_columns(path)
+    assert columns == ["title", "details", "time"]
+    assert dates == ["time"]
+
+def test_export_parquet_keeps_later_part_values(tmp_path):
+    path = str(tmp_path / "history.parquet")
+    expected = write_mixed_parts(path)
+    out = io.BytesIO()
+    assert export_stream(path, out, ".parquet") == len(expected)
+    out.seek(0)
+    table = pq.read_table(out)
+    assert table.column("details").to_pylist() == expected["details"].tolist()
+    assert table.column("title").to_pylist() == expected["title"].tolist()
+
+def test_export_csv_with_date_filter(tmp_path):
+    path = str(tmp_path / "history.parquet")
+    write_mixed_parts(path)
+    out = io.BytesIO()
+    rows = export_stream(path, out, ".csv.gz", columns=["title", "details"], date_column="time",
+                         start=pd.Timestamp("2024-02-01"), end=pd.Timestamp("2024-02-02"))
+    assert rows == 24
+    df = pd.read_csv(io.BytesIO(gzip.decompress(out.getvalue())))
+    assert list(df.columns) == ["title", "details"]
+    assert (df["details"] == "From Google Ads").all()
+
+def test_chunked_store_round_trip(tmp_path):
+    # Ads (the only records with 'details') first appear in the last chunk
+    records = make_watch_records(900, ads_share=0, seed=3)
+    records[-50:] = [dict(r, details=[{"name": "From Google Ads"}]) for r in records[-50:]]
+    src = tmp_path / "AB watch-history.json"
+    src.write_text(json.dumps(records))
+    path = str(tmp_path / "AB watch-history.parquet")
+    assert convert_json_file(str(src), path, chunk_size=200, source="AB") == len(records)
+    parts = sorted(os.listdir(path))
+    assert len(parts) == 5
+    schemas = [pq.read_schema(os.path.join(path, p)).remove_metadata() for p in parts]
+    assert all(schema.equals(schemas[0]) for schema in schemas)
+
+    df = read_frame(path)
+    assert len(df) == len(records)
+    assert df["details"].notna().sum() == 50
+
+    out = io.BytesIO()
+    assert export_stream(path, out, ".parquet") == len(records)
+    out.seek(0)
+    exported = pd.read_parquet(out)
+    assert exported["title"].tolist() == df["title"].astype(object).tolist()
+    assert exported["details"].notna().sum() == 50
+
+    con = query.connect(paths=[path])
+    table = query.table_name(path)
+    counts = query.run(con, f"SELECT count(*) AS n, count(details) AS ads, min(source) AS source FROM {query.quote(table)}")
+    assert counts.iloc[0].tolist() == [len(records), 50, "AB"]
+
+def test_chunk_with_unknown_keys_exports_as_text(tmp_path):
+    records = make_watch_records(400, ads_share=0, seed=4)
+    # One record in the second chunk carries a key the fast path does not know, and two subtitles
+    records[300]["locationInfos"] = [{"name": "At home", "url": "https://maps.google.com", "source": "From your device"}]
+    records[300]["subtitles"] = records[300]["subtitles"] * 2
+    src = tmp_path / "watch-history.json"
+    src.write_text(json.dumps(records))
+    path = str(tmp_path / "watch-history.parquet")
+    convert_json_file(str(src), path, chunk_size=200)
+
+    df = read_frame(path)
+    assert df["channel_name"].notna().all()
+    assert "name" not in df.columns and "locationInfos" not in df.columns
+    for fmt in (".csv.gz", ".xlsx"):
+        assert export_stream(path, io.BytesIO(), fmt) == len(records)
+
+def test_csv_export_formats_time_lists_in_whole_seconds(tmp_path):
+    path = str(tmp_path / "agg.parquet")
+    times = TimeList([0, 2, 3], [1704067200, 1704070800, 1704153600])
+    write_frame(pd.DataFrame({"title": ["a", "b"], "time_list": times.to_series()}), path)
+    out = io.BytesIO()
+    export_stream(path, out, ".csv.gz")
+    df = pd.read_csv(io.BytesIO(gzip.decompress(out.getvalue())))
+    assert df["time_list"].tolist() == ["2024-01-01 00:00:00, 2024-01-01 01:00:00", "2024-01-02 00:00:00"]
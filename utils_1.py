@@ -1,13 +1,33 @@
 import os
 import pandas as pd
-from datetime import timedelta
+from ingest import SEARCH_HISTORY, WATCH_HISTORY, encode_categories, map_categories, read_upload
+from store import read_frame
+from profiling import stage
 
 import warnings
 warnings.filterwarnings('ignore', category=pd.errors.SettingWithCopyWarning)
 
-# Time offset (5 hours, 30 minutes)
+# Local timezone (IANA name) that times are converted to
 # YouTube Timestamps are in +00:00
-TIME_OFFSET = timedelta(hours=5, minutes=30)
+TIMEZONE = 'Asia/Kolkata'
+
+def to_local_time(times, timezone=TIMEZONE):
+    """
+    Convert a time column to timezone-aware datetime64 in `timezone`, at second resolution.
+
+    Takeout ISO strings ("...Z") are parsed as UTC. Naive values, e.g. from
+    files written before times were stored as datetimes, are taken as local time.
+    """
+    if isinstance(times.dtype, pd.DatetimeTZDtype):
+        return times.dt.tz_convert(timezone)
+    if not pd.api.types.is_datetime64_any_dtype(times):
+        sample = times.dropna()
+        sample = str(sample.iloc[0]) if not sample.empty else ''
+        aware = sample.endswith('Z') or '+' in sample[10:] or '-' in sample[19:]
+        times = pd.to_datetime(times, format='ISO8601', errors='coerce', utc=aware)
+        if aware:
+            return times.dt.floor('s').dt.tz_convert(timezone)
+    return times.dt.floor('s').dt.tz_localize(timezone, ambiguous='NaT', nonexistent='shift_forward')
 
 def parse_date_columns(df):
         # # Optional: parse date columns
@@ -28,53 +48,137 @@ def parse_date_columns(df):
         
         return df
 
-def clean_dataframe(df):
+# Column names written by the old generic flattener (via Excel) and their explicit equivalents
+LEGACY_COLUMNS = {'name': 'channel_name', 'url': 'channel_url', 'name.1': 'details'}
 
-    # 1. Remove rows where 'name' or 'name.1' contains "Google Ads"
-    for col in ['name', 'name.1']:
-        if col in df.columns:
-            df = df[~df[col].str.contains('Google Ads', na=False)]
-
-    # 2. Remove rows where 'titleUrl' is empty or null
-    df = df[df['titleUrl'].notna() & (df['titleUrl'].str.strip() != '')]
-
-    # 3. Remove rows where 'titleUrl' contains 'www.google.com'
-    df = df[~df['titleUrl'].str.contains('www.google.com', na=False)]
+def rename_legacy_columns(df):
+    if 'channel_name' not in df.columns:
+        df = df.rename(columns={k: v for k, v in LEGACY_COLUMNS.items() if k in df.columns})
+    return df
 
-    # 4. Drop 'subtitles' and 'name.1' if both exist and are fully empty
-    empty_cols = []
-    for col in ['subtitles', 'name.1', 'description']:
-        if col in df.columns and df[col].isna().all():
-            empty_cols.append(col)
+# Columns that mark ads, either as the channel or as a detail line
+AD_COLUMNS = ['channel_name', 'details']
+
+# Optional columns dropped when nothing survives cleaning in them
+OPTIONAL_COLUMNS = ['subtitles', 'details', 'description']
+
+def clean_mask(df, search=False):
+    """
+    Build one boolean keep-mask for every row filter.
+
+    Watch history drops ads, rows without a titleUrl and www.google.com links.
+    Both watch and search history drop rows marked "From Google Ads".
+    """
+    keep = pd.Series(True, index=df.index)
+
+    for col in AD_COLUMNS:
+        if col not in df.columns:
+            continue
+        values = df[col]
+        with stage(f"filter ads in {col}") as s:
+            if search:
+                # 1. Drop rows marked "From Google Ads"
+                keep &= values != 'From Google Ads'
+            else:
+                # 1. Remove rows where the channel or details mention "Google Ads"
+                keep &= ~values.str.contains('Google Ads', na=False, regex=False)
+            s.rows_out = int(keep.sum())
+
+    if not search:
+        url = df['titleUrl']
+        with stage("filter empty titleUrl") as s:
+            # 2. Remove rows where 'titleUrl' is empty or null
+            keep &= url.notna() & ~url.str.fullmatch(r'\s*', na=False)
+            s.rows_out = int(keep.sum())
+
+        with stage("filter google.com titleUrl") as s:
+            # 3. Remove rows where 'titleUrl' contains 'www.google.com'
+            keep &= ~url.str.contains('www.google.com', na=False, regex=False)
+            s.rows_out = int(keep.sum())
+
+    return keep
+
+def clean_dataframe(df, search=False):
+    """Apply the combined row filter once and drop optional columns left fully empty."""
+    df = encode_categories(rename_legacy_columns(df))
+    with stage("filter", rows_in=len(df)) as s:
+        df = df.loc[clean_mask(df, search)]
+        s.rows_out = len(df)
+
+    # Categories of filtered-out rows (ads, bare URLs) would still be mapped and stored.
+    # The filter already copied the rows, so set the columns in place by position.
+    for i, dtype in enumerate(df.dtypes):
+        if isinstance(dtype, pd.CategoricalDtype):
+            df.isetitem(i, df.iloc[:, i].cat.remove_unused_categories())
+
+    empty_cols = [col for col in OPTIONAL_COLUMNS if col in df.columns and df[col].isna().all()]
     if empty_cols:
-        df.drop(columns=empty_cols, inplace=True)
-    
+        df = df.drop(columns=empty_cols)
+
     return df
 
-def format_dataframe(df, search=False):
-    
-    # 1. Replace "//music." with "//www." in title and titleUrl
-    df['title'] = df['title'].str.replace('//music.', '//www.', regex=False)
-    df['titleUrl'] = df['titleUrl'].str.replace('//music.', '//www.', regex=False)
+def map_text(values, func):
+    """Apply a string function once per category for categoricals, else per row."""
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return map_categories(values, func)
+    return func(values)
+
+def _normalize_title(titles, search=False):
+    # 1. Replace "//music." with "//www."
+    titles = titles.str.replace('//music.', '//www.', regex=False)
+    # 2. Remove starting "Watched " (and "Searched for " in search history)
+    titles = titles.str.removeprefix('Watched ')
+    if search:
+        titles = titles.str.removeprefix('Searched for ')
+    return titles
 
-    # 2. Drop rows where name is "From Google Ads"
-    df = df[df['name'] != 'From Google Ads']
+def format_dataframe(df, search=False, timezone=TIMEZONE):
+    """Normalize text and time columns in place. Expects rows that already passed cleaning."""
 
-    # 3. Remove starting "Watched " from title
-    df['title'] = df['title'].str.removeprefix('Watched ')
+    # 1. Normalize title and titleUrl (per distinct value for categoricals)
+    with stage("normalize text", rows_in=len(df)):
+        df['title'] = map_text(df['title'], lambda titles: _normalize_title(titles, search))
+        if 'titleUrl' in df.columns:
+            df['titleUrl'] = map_text(df['titleUrl'], lambda urls: urls.str.replace('//music.', '//www.', regex=False))
 
+    # 2. Search history has no video or channel
     if search:
-        df['title'] = df['title'].str.removeprefix('Searched for ')
-        df.drop(columns=[col for col in ['titleUrl', 'name', 'description'] if col in df.columns], inplace=True)
+        df.drop(columns=[col for col in ['titleUrl', 'video_id', 'channel_name', 'channel_url', 'channel_id', 'details', 'description'] if col in df.columns], inplace=True)
+
+    # 3. Convert time column to timezone-aware datetime
+    with stage("convert time", rows_in=len(df)):
+        df['time'] = to_local_time(df['time'], timezone)
 
-    # 4. Convert time column to datetime
-    df['time'] = pd.to_datetime(df['time'].str.slice(0, 19), format='%Y-%m-%dT%H:%M:%S', errors='coerce') + TIME_OFFSET
-    df['time'] = df['time'].dt.strftime('%Y-%m-%d %H:%M:%S')
+    return df
 
+def clean_on_merge(df, search=False, timezone=TIMEZONE):
+    """
+    Clean and format merged history in a single pass.
+
+    All row filters are combined into one mask and applied with one copy;
+    string normalization then only runs on the surviving rows.
+    """
+    with stage("clean", rows_in=len(df)) as s:
+        df = parse_date_columns(df)
+        df = clean_dataframe(df, search)
+        df = format_dataframe(df, search, timezone)
+        s.rows_out = len(df)
     return df
 
-def clean_on_merge(df, search=False):
-    df = parse_date_columns(df)
-    df = clean_dataframe(df)
-    df = format_dataframe(df, search)
-    return df
\ No newline at end of file
+def load_and_clean_upload(name, data, search=False, timezone=TIMEZONE):
+    """Parse and clean one uploaded file. Runs in ingest worker processes."""
+    df = read_upload(name, data, SEARCH_HISTORY if search else WATCH_HISTORY)
+    if df.empty:
+        return df
+    return clean_on_merge(df, search, timezone)
+
+def load_and_clean_file(path, search=False, timezone=TIMEZONE, keep=None):
+    """
+    Read one converted file from the store and clean it. Runs in ingest worker processes.
+
+    `keep` is an optional boolean mask of rows to clean, e.g. from dedup_masks.
+    """
+    df = read_frame(path)
+    if keep is not None:
+        df = df.loc[keep]
+    return clean_on_merge(df, search, timezone)
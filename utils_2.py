@@ -1,67 +1,448 @@
 import os
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 import ast
+from utils_1 import to_local_time
+from ingest import NAT, epoch_seconds, event_hashes, first_new_events, sorted_unique
+from store import read_frame, sidecar_path, write_frame
+from profiling import stage
 
-def aggregate(input_df, existing_agg = None, get_year_counts=True):
+MUSIC_HEADER = 'YouTube Music'
+
+# Rollup cubes stored next to the aggregate: view counts per period and per weekday x hour
+CUBES = ('timeline', 'heatmap')
+# Periods of the timeline cube; weeks start on Monday
+GRAINS = ('day', 'week', 'month')
+
+# Channel identity carried from events to the aggregate (first non-null per video)
+CHANNEL_COLUMNS = ['channel_name', 'channel_url', 'channel_id']
+
+# Event key columns of the aggregate's index; header is not kept per view, so
+# the index can be rebuilt from time_list
+AGGREGATE_KEY_COLUMNS = ['titleUrl', 'time']
 
-    # Read the data
-    df = input_df
+class TimeList:
+    """
+    Per-video view times in CSR layout.
 
-    # Check if aggregate file exists
-    if existing_agg is not None:
-        
-        # Safely convert string representation of time_list back to set
-        existing_agg['time_list'] = existing_agg['time_list'].apply(
-            lambda x: ast.literal_eval(x) if isinstance(x, str) else x
+    Row i's times are ``values[offsets[i]:offsets[i + 1]]`` as sorted int64
+    UTC epoch seconds. Built from / converted to the aggregate's 'time_list'
+    column without per-row Python objects.
+    """
+
+    def __init__(self, offsets, values):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.values = np.asarray(values, dtype=np.int64)
+
+    @classmethod
+    def from_series(cls, series):
+        """Convert a 'time_list' column to a TimeList (one vectorised pass, no per-row objects)."""
+        if not (isinstance(series.dtype, pd.ArrowDtype)
+                and pa.types.is_timestamp(series.dtype.pyarrow_dtype.value_type)):
+            return _parse_time_lists(series)
+        lists = series.array.__arrow_array__().combine_chunks()
+        offsets = lists.offsets.to_numpy()
+        values = lists.flatten()
+        if values.type.tz is None:
+            # Lists written before times were timezone-aware hold local wall-clock times
+            local = pd.Series(values.to_numpy(zero_copy_only=False))
+            values = epoch_seconds(to_local_time(local))
+        else:
+            # Parquet has no second resolution, so lists read back as timestamp[ms]
+            values = values.cast(pa.timestamp('s', tz='UTC'), safe=False).cast(pa.int64())
+            values = values.to_numpy(zero_copy_only=False)
+        return cls(offsets - offsets[0], values)
+
+    def to_series(self, index=None, tz='UTC'):
+        """Build an Arrow-backed 'time_list' column displayed in timezone `tz`."""
+        lists = pa.ListArray.from_arrays(
+            pa.array(self.offsets, pa.int32()), pa.array(self.values, pa.int64()).cast(pa.timestamp('s', tz=tz))
         )
-        
-        # Get all unique timestamps from existing data
-        existing_times = set()
-        for times in existing_agg['time_list']:
-            existing_times.update(times)
-        
-        # Filter df to only include rows with new timestamps
-        df = df[~df['time'].isin(existing_times)]
-        
-        if len(df) == 0:
-            print("\nNo new entries found to update. Aggregate file remains unchanged.\n")
-            return
-        
-        # Create mapping of titleUrl to header from existing aggregate
-        header_mapping = existing_agg.set_index('titleUrl')['header'].to_dict()
-        mask = df['titleUrl'].isin(header_mapping.keys())
-        df.loc[mask, 'header'] = df.loc[mask, 'titleUrl'].map(header_mapping)
-        
-        # Prepare existing data for merging by exploding time_list
-        existing_data = existing_agg.explode('time_list').rename(columns={'time_list': 'time'})
-        existing_data = existing_data[['titleUrl', 'title', 'time', 'header']]  # Keep only necessary columns
-        
-        # Combine with existing data for re-aggregation
-        df = pd.concat([existing_data, df], ignore_index=True)
-
-    # 1. Aggregate by titleUrl
-    grouped = df.groupby('titleUrl').agg({
-        'title': 'first',
-        'time': ['min', 'max', lambda x : len(set(x)), lambda x: set(x)],
-        'header': lambda x: (
-            'YouTube Music' if 'YouTube Music' in x.values
-            else x.mode().iloc[0] if not x.mode().empty
-            else None
+        return pd.Series(pd.arrays.ArrowExtensionArray(lists), index=index, name='time_list')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def explode(self):
+        """Return (row position, time) for every stored view."""
+        return np.repeat(np.arange(len(self)), self.lengths()), self.values
+
+    def rewatched(self, min_views=2):
+        """Boolean mask of rows viewed at least `min_views` distinct times."""
+        return self.lengths() >= min_views
+
+    def union(self, other):
+        """Row-wise union with another TimeList of the same length."""
+        rows_a, values_a = self.explode()
+        rows_b, values_b = other.explode()
+        return TimeList.from_pairs(
+            np.concatenate([rows_a, rows_b]), np.concatenate([values_a, values_b]), len(self)
         )
-    }).reset_index()
 
-    # Flatten multi-level columns
-    grouped.columns = ['titleUrl', 'title', 'first_time', 'last_time', 'frequency', 'time_list', 'header']
+    @classmethod
+    def from_pairs(cls, rows, values, n_rows):
+        """Build from (row position, time) pairs, sorting and dropping repeats."""
+        order = np.lexsort((values, rows))
+        rows, values = rows[order], values[order]
+        keep = np.ones(len(rows), dtype=bool)
+        keep[1:] = (rows[1:] != rows[:-1]) | (values[1:] != values[:-1])
+        rows, values = rows[keep], values[keep]
+        offsets = np.zeros(n_rows + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(rows, minlength=n_rows))
+        return cls(offsets, values)
+
+def _parse_time_lists(series):
+    # Older aggregates stored time_list as sets/lists of local time strings or their repr
+    lists = series.apply(lambda x: ast.literal_eval(x) if isinstance(x, str) else x)
+    lists = lists.apply(lambda x: list(x) if pd.api.types.is_list_like(x) else [])
+    exploded = pd.Series(lists.to_numpy(), dtype=object).explode().dropna()
+    seconds = epoch_seconds(to_local_time(exploded.astype(str)))
+    valid = seconds != NAT
+    rows = exploded.index.to_numpy(dtype=np.int64)[valid]
+    return TimeList.from_pairs(rows, seconds[valid], len(series))
+
+def time_list(agg):
+    """Accessor for the view times of an aggregate result."""
+    return TimeList.from_series(agg['time_list'])
+
+def _as_datetime(times):
+    # Keep timezone-aware columns as they are, localize everything else
+    if isinstance(times.dtype, pd.DatetimeTZDtype):
+        return times
+    return to_local_time(times)
+
+def _from_epoch_seconds(seconds, tz):
+    return pd.Series(np.asarray(seconds, dtype=np.int64).view('datetime64[s]')).dt.tz_localize('UTC').dt.tz_convert(tz)
+
+def _first_index_per_group(codes, n_groups):
+    # Position of the first occurrence of each code, -1 where a group has none
+    first = np.full(n_groups, -1, dtype=np.int64)
+    positions = np.arange(len(codes), dtype=np.int64)[::-1]
+    first[codes[::-1]] = positions
+    return first
+
+def first_value_per_group(values, codes, n_groups):
+    """First non-null value of `values` for each of `n_groups` groups given by `codes` (None where a group has none)."""
+    value_codes, uniques = pd.factorize(values)
+    has_value = value_codes >= 0
+    first = _first_index_per_group(codes[has_value], n_groups)
+    out = np.full(n_groups, None, dtype=object)
+    out[first >= 0] = np.asarray(uniques, dtype=object)[value_codes[has_value][first[first >= 0]]]
+    return out
+
+def _factorize_sorted(values):
+    # pd.factorize(sort=True) orders categoricals by category order, sort by value instead
+    if not isinstance(values.dtype, pd.CategoricalDtype):
+        return pd.factorize(values, sort=True)
+    cat_codes = values.cat.codes.to_numpy()
+    present = cat_codes >= 0
+    inverse, used = pd.factorize(cat_codes[present])
+    labels = np.asarray(values.cat.categories, dtype=object)[used]
+    order = np.argsort(labels, kind='stable')
+    rank = np.empty(len(order), dtype=np.intp)
+    rank[order] = np.arange(len(order))
+    codes = np.full(len(values), -1, dtype=np.intp)
+    codes[present] = rank[inverse]
+    return codes, pd.Index(labels[order], dtype=object)
+
+def aggregate_events(df, get_year_counts=True):
+    """
+    Aggregate watch events by titleUrl in one vectorized pass over factorized keys.
+
+    Returns one row per video with the first title and channel, first/last view time,
+    the number of distinct view times, the view times (see TimeList), the header vote
+    (YouTube Music if any view was on Music, else the most common header) and,
+    optionally, per-year view counts.
+    """
+    with stage("groupby", rows_in=len(df)) as s:
+        grouped = _aggregate_events(df, get_year_counts)
+        s.rows_out = len(grouped)
+    return grouped
+
+def _aggregate_events(df, get_year_counts):
+    df = df[df['titleUrl'].notna()]
+    codes, urls = _factorize_sorted(df['titleUrl'])
+    n = len(urls)
+
+    # Times are factorized as sorted epoch seconds, so time codes compare like times
+    times = _as_datetime(df['time'])
+    tz = times.dt.tz
+    seconds = epoch_seconds(times)
+    has_time = seconds != NAT
+    time_codes = np.full(len(df), -1, dtype=np.int64)
+    time_codes[has_time], unique_seconds = pd.factorize(seconds[has_time], sort=True)
+    n_times = max(len(unique_seconds), 1)
+
+    # Distinct (video, time) pairs, sorted by video then time
+    pairs = sorted_unique(codes[has_time].astype(np.int64) * n_times + time_codes[has_time])
+    pair_codes = pairs // n_times
+    pair_seconds = unique_seconds[pairs % n_times]
+    frequency = np.bincount(pair_codes, minlength=n)
+    bounds = np.cumsum(frequency)
+    starts = bounds - frequency
+    seen = frequency > 0
+
+    first_seconds = np.full(n, NAT, dtype=np.int64)
+    last_seconds = np.full(n, NAT, dtype=np.int64)
+    first_seconds[seen] = pair_seconds[starts[seen]]
+    last_seconds[seen] = pair_seconds[bounds[seen] - 1]
+    views = TimeList(np.concatenate([[0], bounds]), pair_seconds)
+
+    # First non-null title per video
+    title = first_value_per_group(df['title'], codes, n)
+
+    # Header vote: Music wins, otherwise the most common header (ties go to the smallest)
+    header_codes, headers = _factorize_sorted(df['header'])
+    has_header = header_codes >= 0
+    n_headers = max(len(headers), 1)
+    counts = np.bincount(
+        codes[has_header].astype(np.int64) * n_headers + header_codes[has_header],
+        minlength=n * n_headers,
+    ).reshape(n, n_headers)
+    header = np.full(n, None, dtype=object)
+    voted = counts.any(axis=1)
+    header[voted] = np.asarray(headers, dtype=object)[counts[voted].argmax(axis=1)]
+    if MUSIC_HEADER in headers:
+        header[counts[:, headers.get_loc(MUSIC_HEADER)] > 0] = MUSIC_HEADER
 
-    # Get the year counts from the original df
+    grouped = pd.DataFrame({
+        'titleUrl': np.asarray(urls, dtype=object),
+        'title': title,
+        'first_time': _from_epoch_seconds(first_seconds, tz),
+        'last_time': _from_epoch_seconds(last_seconds, tz),
+        'frequency': frequency,
+        'time_list': views.to_series(tz=str(tz)),
+        'header': header,
+    })
+    for col in CHANNEL_COLUMNS:
+        if col in df.columns:
+            grouped[col] = first_value_per_group(df[col], codes, n)
+
+    # Per-year view counts (every event counts, like the old pivot_table)
     if get_year_counts:
-        df['year'] = df['time'].str[2:4]  # extract last 2 digits of year
-        year_counts = df.pivot_table(index='titleUrl', columns='year', values='time', aggfunc='count').fillna(0).astype(int)
-        year_counts.columns = [str(y).zfill(2) for y in year_counts.columns]  # e.g. '21', '22'
-        grouped = grouped.merge(year_counts, on='titleUrl', how='left')
+        with stage("pivot years", rows_in=len(df)):
+            _add_year_counts(grouped, codes, n, has_time, time_codes, unique_seconds, tz)
+    return grouped
+
+def _add_year_counts(grouped, codes, n, has_time, time_codes, unique_seconds, tz):
+    years = _from_epoch_seconds(unique_seconds, tz).dt.year % 100  # last 2 digits of year
+    year_codes, year_labels = pd.factorize(years, sort=True)
+    n_years = len(year_labels)
+    row_years = year_codes[time_codes[has_time]]
+    year_counts = np.bincount(
+        codes[has_time].astype(np.int64) * n_years + row_years,
+        minlength=n * n_years,
+    ).reshape(n, n_years)
+    for i, year in enumerate(year_labels):
+        grouped[str(year).zfill(2)] = year_counts[:, i]  # e.g. '21', '22'
+
+def event_keys(df):
+    """Hash each event's (titleUrl, UTC epoch second) into a uint64 key."""
+    events = pd.DataFrame({'titleUrl': df['titleUrl'].array, 'time': _as_datetime(df['time']).array})
+    return event_hashes(events, AGGREGATE_KEY_COLUMNS)
+
+def _keys_from_aggregate(existing_agg):
+    # Rebuild the event index from an aggregate saved without one
+    rows, seconds = time_list(existing_agg).explode()
+    urls = existing_agg['titleUrl'].to_numpy(dtype=object)[rows]
+    events = pd.DataFrame({'titleUrl': urls, 'time': _from_epoch_seconds(seconds, 'UTC')})
+    return sorted_unique(event_hashes(events, AGGREGATE_KEY_COLUMNS))
+
+def _earliest(a, b):
+    return a.where(b.isna() | (a.notna() & (a <= b)), b)
+
+def _latest(a, b):
+    return a.where(b.isna() | (a.notna() & (a >= b)), b)
+
+def merge_aggregates(existing_agg, delta):
+    """
+    Fold an aggregate of new events into an existing aggregate.
+
+    Only rows whose titleUrl appears in `delta` are updated; unseen videos are
+    appended. Known videos keep their title, channel and header unless a
+    new view was on YouTube Music.
+    """
+    existing = existing_agg.set_index('titleUrl')
+    delta = delta.set_index('titleUrl')
+
+    # Bring older or differently zoned aggregates onto the delta's time types
+    tz = delta['first_time'].dt.tz
+    for col in ['first_time', 'last_time']:
+        existing[col] = _as_datetime(existing[col]).dt.tz_convert(tz)
+    if existing['time_list'].dtype != delta['time_list'].dtype:
+        existing['time_list'] = TimeList.from_series(existing['time_list']).to_series(existing.index, str(tz))
+    year_cols = sorted(
+        {c for c in existing.columns if c.isdigit()} | {c for c in delta.columns if c.isdigit()}
+    )
+    channel_cols = [c for c in CHANNEL_COLUMNS if c in existing.columns or c in delta.columns]
+    for frame in (existing, delta):
+        for col in year_cols:
+            if col not in frame.columns:
+                frame[col] = 0
+        for col in channel_cols:
+            if col not in frame.columns:
+                frame[col] = None
+
+    known = delta.index.isin(existing.index)
+    updates = delta[known]
+    rows = existing.loc[updates.index]
+
+    rows['title'] = rows['title'].fillna(updates['title'])
+    for col in channel_cols:
+        rows[col] = rows[col].fillna(updates[col])
+    rows['header'] = rows['header'].fillna(updates['header']).mask(updates['header'] == MUSIC_HEADER, MUSIC_HEADER)
+    rows['first_time'] = _earliest(rows['first_time'], updates['first_time'])
+    rows['last_time'] = _latest(rows['last_time'], updates['last_time'])
+    rows['frequency'] = rows['frequency'] + updates['frequency']
+    merged_views = TimeList.from_series(rows['time_list']).union(TimeList.from_series(updates['time_list']))
+    rows['time_list'] = merged_views.to_series(rows.index, str(tz))
+    for col in year_cols:
+        rows[col] = rows[col].fillna(0).astype(int) + updates[col]
+
+    merged = pd.concat([existing.drop(index=rows.index), rows, delta[~known]])
+    merged[year_cols] = merged[year_cols].fillna(0).astype(int)
+    columns = ['title', 'first_time', 'last_time', 'frequency', 'time_list', 'header'] + channel_cols + year_cols
+    return merged[columns].rename_axis('titleUrl').reset_index()
+
+def new_events(input_df, existing_keys=None):
+    """Event keys of `input_df` and a mask of events missing from `existing_keys` (first occurrence only)."""
+    keys = event_keys(input_df)
+    return keys, first_new_events(keys, existing_keys)
+
+def update_aggregate(input_df, existing_agg=None, existing_keys=None, get_year_counts=True):
+    """
+    Incrementally aggregate `input_df` into `existing_agg`.
 
-    grouped.sort_values(by='first_time', ascending=False, inplace=True)
+    `existing_keys` is the sorted event-key index of everything already
+    aggregated; only events missing from it are aggregated and merged, so
+    the cost scales with the new data. Returns (aggregate, keys), or
+    (None, existing_keys) when there is nothing new.
+    """
+    with stage("aggregate", rows_in=len(input_df)) as s:
+        grouped, keys = _update_aggregate(input_df, existing_agg, existing_keys, get_year_counts)
+        s.rows_out = None if grouped is None else len(grouped)
+    return grouped, keys
 
+def _update_aggregate(input_df, existing_agg, existing_keys, get_year_counts):
+    if existing_agg is None:
+        grouped = aggregate_events(input_df, get_year_counts)
+        with stage("sort", rows_in=len(grouped)):
+            grouped.sort_values(by='first_time', ascending=False, inplace=True, kind='stable')
+        with stage("event keys", rows_in=len(input_df)):
+            keys = sorted_unique(event_keys(input_df))
+        return grouped, keys
+
+    if existing_keys is None:
+        with stage("rebuild event keys", rows_in=len(existing_agg)):
+            existing_keys = _keys_from_aggregate(existing_agg)
+
+    with stage("event keys", rows_in=len(input_df)) as s:
+        keys, new = new_events(input_df, existing_keys)
+        s.rows_out = int(new.sum())
+    if not new.any():
+        print("\nNo new entries found to update. Aggregate file remains unchanged.\n")
+        return None, existing_keys
+
+    delta = aggregate_events(input_df[new], get_year_counts)
+    with stage("merge", rows_in=len(existing_agg) + len(delta)) as s:
+        grouped = merge_aggregates(existing_agg, delta)
+        s.rows_out = len(grouped)
+    with stage("sort", rows_in=len(grouped)):
+        grouped.sort_values(by='first_time', ascending=False, inplace=True, kind='stable')
+    return grouped, sorted_unique(np.concatenate([existing_keys, keys[new]]))
+
+def _count(grain=None, **columns):
+    # Rows per distinct combination of `columns`, headers back as text
+    keys = list(columns)
+    counts = pd.DataFrame(columns).groupby(keys, observed=True, dropna=False).size().rename('views').reset_index()
+    counts['header'] = counts['header'].astype(object)
+    if grain is not None:
+        counts.insert(0, 'grain', grain)
+    return counts
+
+def build_cubes(df):
+    """
+    View counts of watch events in local time, split by header.
+
+    'timeline' has one row per (grain, period, header) with period the
+    local start of the day, week or month; 'heatmap' one row per
+    (weekday, hour, header). Weekday 0 is Monday.
+    """
+    with stage("build cubes", rows_in=len(df)) as s:
+        df = df[df['titleUrl'].notna()]
+        # Wall-clock seconds, so periods follow the local calendar across DST changes
+        local = _as_datetime(df['time']).dt.tz_localize(None).dt.as_unit('s').array.asi8
+        valid = local != NAT
+        local = local[valid]
+        # Grouped by header code, string comparisons would dominate
+        header_codes, headers = pd.factorize(df['header'])
+        header = pd.Categorical.from_codes(header_codes[valid], categories=np.asarray(headers, dtype=object))
+
+        # Day numbers since 1970-01-01 (a Thursday); only distinct days go through the calendar
+        days = local // 86400
+        weekday = (days + 3) % 7
+        day_codes, unique_days = pd.factorize(days)
+        month_start = pd.to_datetime(unique_days, unit='D').to_period('M').start_time.to_numpy()
+        periods = {
+            'day': days.astype('datetime64[D]'),
+            'week': (days - weekday).astype('datetime64[D]'),
+            'month': month_start[day_codes],
+        }
+        timeline = pd.concat([
+            _count(grain=grain, period=period.astype('datetime64[s]'), header=header)
+            for grain, period in periods.items()
+        ], ignore_index=True)
+        heatmap = _count(weekday=weekday, hour=local % 86400 // 3600, header=header)
+        s.rows_out = len(timeline) + len(heatmap)
+    return {'timeline': timeline, 'heatmap': heatmap}
+
+def merge_cubes(existing, delta):
+    """Add the counts of `delta` cubes into `existing` ones."""
+    keys = {'timeline': ['grain', 'period', 'header'], 'heatmap': ['weekday', 'hour', 'header']}
+    merged = {}
+    for name in CUBES:
+        both = pd.concat([existing[name], delta[name]], ignore_index=True)
+        merged[name] = both.groupby(keys[name], dropna=False)['views'].sum().reset_index()
+    return merged
+
+def update_cubes(input_df, existing_cubes=None, existing_keys=None):
+    """
+    Incrementally count `input_df` into the rollup cubes.
+
+    Pass the aggregate's event-key index from before the aggregate is
+    updated: only events missing from it are counted. Without existing
+    cubes or keys they are rebuilt from every (distinct) event. Returns
+    the cubes, or None when there is nothing new.
+    """
+    with stage("cubes", rows_in=len(input_df)):
+        if existing_cubes is None or existing_keys is None:
+            _, new = new_events(input_df)
+            return build_cubes(input_df[new])
+        _, new = new_events(input_df, existing_keys)
+        if not new.any():
+            return None
+        return merge_cubes(existing_cubes, build_cubes(input_df[new]))
+
+def read_cubes(path):
+    """Cubes stored next to the aggregate at `path`, or None if any is missing."""
+    paths = {name: sidecar_path(path, name) for name in CUBES}
+    if not all(os.path.exists(p) for p in paths.values()):
+        return None
+    return {name: read_frame(p) for name, p in paths.items()}
+
+def write_cubes(cubes, path):
+    for name, cube in cubes.items():
+        write_frame(cube, sidecar_path(path, name))
+
+def aggregate(input_df, existing_agg = None, get_year_counts=True):
+    grouped, _ = update_aggregate(input_df, existing_agg, get_year_counts=get_year_counts)
     return grouped
 
 if __name__ == "__main__":
@@ -0,0 +1,338 @@
+import os
+import re
+import time
+import random
+import sqlite3
+import asyncio
+import threading
+import numpy as np
+import pandas as pd
+import httpx
+from ingest import VIDEO_ID_PATTERN, map_categories
+from jobs import progress
+from profiling import stage
+
+# YouTube Data API key; without one, enrichment only uses cached metadata
+API_KEY_ENV = "YOUTUBE_API_KEY"
+API_URL = "https://www.googleapis.com/youtube/v3"
+
+# IDs per videos.list request (the API maximum)
+BATCH_SIZE = 50
+# Requests in flight at once, also the size of the connection pool
+CONCURRENCY = 8
+# Attempts per batch; waits between them double from BACKOFF seconds
+RETRIES = 4
+BACKOFF = 0.5
+# Seconds before a request is given up and retried
+TIMEOUT = 30
+
+# Cached metadata older than this (seconds) is fetched again
+CACHE_TTL = 30 * 24 * 3600
+
+METADATA_COLUMNS = ["duration_seconds", "category", "published_at"]
+
+# ISO 8601 durations as used by the API, e.g. PT1H2M3S or P1DT2H
+DURATION_PATTERN = re.compile(r"P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+(?:\.\d+)?)S)?)?$")
+
+def parse_duration(text):
+    """Seconds in an ISO 8601 duration, or None if it cannot be parsed."""
+    match = DURATION_PATTERN.match(text or "")
+    if match is None:
+        return None
+    days, hours, minutes, seconds = (float(g) if g else 0.0 for g in match.groups())
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
+class YouTubeBackend:
+    """
+    Video metadata from the YouTube Data API (videos.list, videoCategories.list).
+
+    Any server answering the same two endpoints can stand in through
+    `base_url`, e.g. benchmarks/standin_server.py. A backend needs
+    `batch_size` and `async fetch(client, ids)` returning
+    {video_id: (duration_seconds, category, published_at)} for the IDs found.
+    """
+
+    batch_size = BATCH_SIZE
+
+    def __init__(self, api_key, base_url=API_URL):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        # Category titles by ID, looked up once per backend
+        self._categories = {}
+
+    async def _get(self, client, endpoint, **params):
+        response = await client.get(f"{self.base_url}/{endpoint}", params={**params, "key": self.api_key})
+        response.raise_for_status()
+        return response.json()
+
+    async def fetch(self, client, ids):
+        payload = await self._get(client, "videos", part="contentDetails,snippet", id=",".join(ids), maxResults=len(ids))
+        items = payload.get("items", [])
+
+        # Parts missing from an item (or an item without an ID) leave its fields empty
+        unknown = {item.get("snippet", {}).get("categoryId") for item in items} - set(self._categories) - {None}
+        if unknown:
+            categories = await self._get(client, "videoCategories", part="snippet", id=",".join(sorted(unknown)))
+            for item in categories.get("items", []):
+                if "id" in item:
+                    self._categories[item["id"]] = item.get("snippet", {}).get("title")
+
+        records = {}
+        for item in items:
+            if "id" not in item:
+                continue
+            snippet = item.get("snippet", {})
+            records[item["id"]] = (
+                parse_duration(item.get("contentDetails", {}).get("duration")),
+                self._categories.get(snippet.get("categoryId")),
+                snippet.get("publishedAt"),
+            )
+        return records
+
+def backend_from_env(base_url=API_URL):
+    """A YouTubeBackend using the key in YOUTUBE_API_KEY, or None if it is not set."""
+    api_key = os.environ.get(API_KEY_ENV)
+    return YouTubeBackend(api_key, base_url) if api_key else None
+
+class MetadataCache:
+    """
+    Video metadata kept in a local SQLite file for `ttl` seconds.
+
+    IDs the backend did not return (private or deleted videos) are stored
+    with empty fields, so they are not asked for again until they expire.
+    """
+
+    def __init__(self, path, ttl=CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS videos ("
+            "video_id TEXT PRIMARY KEY, duration_seconds REAL, category TEXT, "
+            "published_at TEXT, fetched REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE TEMP TABLE wanted (video_id TEXT PRIMARY KEY)")
+
+    def _select(self, ids, query, now):
+        # Look IDs up through a temporary table, there can be more than SQLite allows as parameters
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM wanted")
+            self._conn.executemany("INSERT OR IGNORE INTO wanted VALUES (?)", ((i,) for i in ids))
+            return self._conn.execute(query, (now - self.ttl,)).fetchall()
+
+    def get(self, ids, now=None):
+        """Fresh cached metadata for `ids` as a DataFrame indexed by video_id."""
+        rows = self._select(ids, (
+            "SELECT v.video_id, v.duration_seconds, v.category, v.published_at FROM videos v "
+            "JOIN wanted w ON v.video_id = w.video_id WHERE v.fetched >= ?"
+        ), time.time() if now is None else now)
+        df = pd.DataFrame(rows, columns=["video_id"] + METADATA_COLUMNS).set_index("video_id")
+        df["duration_seconds"] = df["duration_seconds"].astype(float)
+        df["published_at"] = pd.to_datetime(df["published_at"], utc=True, errors="coerce")
+        return df
+
+    def missing(self, ids, now=None):
+        """IDs of `ids` with no cached entry or an expired one."""
+        rows = self._select(ids, (
+            "SELECT w.video_id FROM wanted w LEFT JOIN videos v "
+            "ON v.video_id = w.video_id AND v.fetched >= ? WHERE v.video_id IS NULL"
+        ), time.time() if now is None else now)
+        return [row[0] for row in rows]
+
+    def put(self, ids, records, now=None):
+        """Store fetched `records` ({id: fields}); IDs of `ids` without a record are stored as not found."""
+        now = time.time() if now is None else now
+        rows = [(i, *records.get(i, (None, None, None)), now) for i in ids]
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO videos VALUES (?, ?, ?, ?, ?)", rows)
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM videos").fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class FetchStats:
+    """Counters of one enrichment run, for throughput and retry reporting."""
+
+    __slots__ = ("ids", "cached", "requested", "fetched", "not_found", "requests", "retries",
+                 "failed_batches", "last_error", "seconds")
+
+    def __init__(self, ids=0):
+        self.ids = ids
+        self.cached = 0
+        self.requested = 0
+        self.fetched = 0
+        self.not_found = 0
+        self.requests = 0
+        self.retries = 0
+        self.failed_batches = 0
+        self.last_error = None
+        self.seconds = 0.0
+
+    @property
+    def ids_per_second(self):
+        return self.requested / self.seconds if self.seconds else None
+
+    def to_dict(self):
+        data = {name: getattr(self, name) for name in self.__slots__}
+        data["ids_per_second"] = self.ids_per_second
+        return data
+
+    def summary(self):
+        text = f"{self.ids} videos, {self.cached} cached, {self.requested} looked up"
+        if self.ids > self.cached + self.requested:
+            text += f", {self.ids - self.cached - self.requested} without metadata"
+        if self.requested:
+            text += (f" ({self.fetched} found, {self.not_found} not found) in {self.seconds:.1f} s,"
+                     f" {self.requests} requests, {self.retries} retries")
+        if self.failed_batches:
+            text += f", {self.failed_batches} batches failed: {self.last_error}"
+        return text
+
+def _retryable(error):
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(error, httpx.TransportError)
+
+def _retry_delay(error, attempt, backoff):
+    # Honour Retry-After when the server sends one, else exponential backoff with jitter
+    if isinstance(error, httpx.HTTPStatusError):
+        retry_after = error.response.headers.get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+    return backoff * 2 ** attempt * (0.5 + random.random())
+
+async def _fetch_batch(client, backend, ids, semaphore, stats, retries, backoff):
+    for attempt in range(retries):
+        async with semaphore:
+            stats.requests += 1
+            try:
+                return await backend.fetch(client, ids)
+            except httpx.HTTPError as e:
+                if attempt == retries - 1 or not _retryable(e):
+                    raise
+                delay = _retry_delay(e, attempt, backoff)
+        # Wait outside the semaphore so other batches keep going
+        stats.retries += 1
+        await asyncio.sleep(delay)
+
+async def _fetch_all(ids, backend, cache, stats, concurrency, retries, backoff, timeout):
+    batches = [ids[i:i + backend.batch_size] for i in range(0, len(ids), backend.batch_size)]
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+        tasks = {
+            asyncio.ensure_future(_fetch_batch(client, backend, batch, semaphore, stats, retries, backoff)): batch
+            for batch in batches
+        }
+        pending = set(tasks)
+        try:
+            while pending:
+                finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    batch = tasks[task]
+                    try:
+                        records = task.result()
+                    except (httpx.HTTPError, ValueError) as e:
+                        # Left uncached, the batch is retried on the next run.
+                        # ValueError is a response body that is not JSON
+                        stats.failed_batches += 1
+                        stats.last_error = f"{type(e).__name__}: {e}"
+                        continue
+                    # Cached per batch, so a cancelled or failed run keeps what it fetched
+                    cache.put(batch, records)
+                    stats.fetched += len(records)
+                    stats.not_found += len(batch) - len(records)
+                progress(len(batches) - len(pending), len(batches), "batches")
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+def fetch_metadata(ids, backend, cache, stats=None, concurrency=CONCURRENCY, retries=RETRIES,
+                   backoff=BACKOFF, timeout=TIMEOUT):
+    """
+    Fetch metadata for `ids` in batches over a pooled async client and store it in `cache`.
+
+    At most `concurrency` requests are in flight. Timeouts, connection
+    errors, 429 and 5xx responses are retried with backoff; batches that
+    still fail, or whose response cannot be read, are counted in the
+    returned FetchStats and left uncached.
+    """
+    if retries < 1:
+        raise ValueError(f"retries must be at least 1, got {retries}")
+    stats = FetchStats(len(ids)) if stats is None else stats
+    ids = list(ids)
+    stats.requested = len(ids)
+    if not ids:
+        return stats
+    start = time.perf_counter()
+    try:
+        asyncio.run(_fetch_all(ids, backend, cache, stats, concurrency, retries, backoff, timeout))
+    finally:
+        stats.seconds = time.perf_counter() - start
+    return stats
+
+def video_ids(urls):
+    """Video IDs from watch URLs (None where there is none), extracted once per distinct URL."""
+    if isinstance(urls.dtype, pd.CategoricalDtype):
+        return map_categories(urls, lambda values: values.str.extract(VIDEO_ID_PATTERN, expand=False))
+    return urls.astype(object).str.extract(VIDEO_ID_PATTERN, expand=False)
+
+def _lookup(ids, meta):
+    # Row positions in `meta` for each id, -1 where there is no metadata
+    if isinstance(ids.dtype, pd.CategoricalDtype):
+        positions = np.append(meta.index.get_indexer(ids.cat.categories), -1)
+        return positions[ids.cat.codes.to_numpy()]
+    return meta.index.get_indexer(ids.astype(object))
+
+def enrich_videos(df, cache, backend=None, **fetch_options):
+    """
+    Add video_id, duration_seconds, category and published_at to a frame with `titleUrl`.
+
+    Metadata comes from `cache`. With a backend, IDs missing from the cache
+    or expired are fetched first; without one the stage runs offline.
+    Returns (df, FetchStats).
+    """
+    with stage("enrich videos", rows_in=len(df)) as s:
+        df = df.copy()
+        if "video_id" not in df.columns:
+            df["video_id"] = video_ids(df["titleUrl"])
+        ids = df["video_id"]
+        unique = [str(i) for i in pd.unique(ids.dropna())]
+        stats = FetchStats(len(unique))
+
+        if backend is not None:
+            wanted = cache.missing(unique)
+            stats.cached = len(unique) - len(wanted)
+            with stage("fetch metadata", rows_in=len(wanted)) as f:
+                fetch_metadata(wanted, backend, cache, stats, **fetch_options)
+                f.rows_out = stats.fetched
+
+        meta = cache.get(unique)
+        if backend is None:
+            stats.cached = len(meta)
+        positions = _lookup(ids, meta)
+        for col in METADATA_COLUMNS:
+            df[col] = meta[col].array.take(positions, allow_fill=True)
+        codes, categories = pd.factorize(df["category"])
+        if categories.empty:
+            # Keep the column typed as text in the store even when nothing was found
+            categories = pd.Index([], dtype="string")
+        df["category"] = pd.Categorical.from_codes(codes, dtype=pd.CategoricalDtype(categories))
+        s.rows_out = len(df)
+    return df, stats
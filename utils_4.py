@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+from ingest import NAT, is_known, sorted_unique
+from utils_2 import first_value_per_group
+from profiling import stage
+
+# Per-channel totals, followed by per-year view counts ('21', '22', ...)
+ROLLUP_COLUMNS = ['channel_key', 'channel_name', 'channel_url', 'channel_id',
+                  'watches', 'videos', 'first_time', 'last_time']
+
+def channel_key(agg):
+    """The channel each video is counted under: channel_id, else channel URL, else name."""
+    key = pd.Series(None, index=agg.index, dtype=object)
+    for col in ['channel_name', 'channel_url', 'channel_id']:
+        if col in agg.columns:
+            key = agg[col].astype(object).where(agg[col].notna(), key)
+    return key
+
+def _group_extreme(times, codes, n, reduce, empty):
+    # Earliest or latest time per group, ignoring NaT, through UTC epoch seconds
+    seconds = times.dt.as_unit('s').array.asi8
+    valid = seconds != NAT
+    out = np.full(n, empty, dtype=np.int64)
+    reduce.at(out, codes[valid], seconds[valid])
+    out[out == empty] = NAT
+    return pd.Series(out.view('datetime64[s]')).dt.tz_localize('UTC').dt.tz_convert(times.dt.tz)
+
+def rollup_channels(agg):
+    """
+    Roll a video aggregate up to one row per channel in a single vectorized pass.
+
+    `watches` sums the videos' view counts (frequency), `videos` counts
+    distinct videos, first/last watch are the extremes over the channel's
+    videos and year columns are summed. Videos without a channel are left out.
+    """
+    with stage("rollup channels", rows_in=len(agg)) as s:
+        keys = channel_key(agg)
+        codes, channels = pd.factorize(keys)
+        has_channel = codes >= 0
+        agg, codes = agg[has_channel], codes[has_channel]
+        n = len(channels)
+
+        rollup = pd.DataFrame({'channel_key': np.asarray(channels, dtype=object)})
+        for col in ['channel_name', 'channel_url', 'channel_id']:
+            if col in agg.columns:
+                rollup[col] = first_value_per_group(agg[col], codes, n)
+        rollup['watches'] = np.bincount(codes, weights=agg['frequency'].to_numpy(), minlength=n).astype(np.int64)
+        rollup['videos'] = np.bincount(codes, minlength=n)
+        rollup['first_time'] = _group_extreme(agg['first_time'], codes, n, np.minimum, np.iinfo(np.int64).max)
+        rollup['last_time'] = _group_extreme(agg['last_time'], codes, n, np.maximum, NAT)
+        for col in sorted(c for c in agg.columns if c.isdigit()):
+            rollup[col] = np.bincount(codes, weights=agg[col].fillna(0).to_numpy(), minlength=n).astype(np.int64)
+
+        rollup.sort_values(by=['watches', 'channel_key'], ascending=[False, True], inplace=True, kind='stable')
+        rollup.reset_index(drop=True, inplace=True)
+        s.rows_out = len(rollup)
+    return rollup
+
+def video_keys(agg):
+    """Hash each video's (titleUrl, frequency) into a uint64 key; the key changes whenever the video gets new views."""
+    key_frame = pd.DataFrame({'titleUrl': agg['titleUrl'].array, 'frequency': agg['frequency'].to_numpy()})
+    return pd.util.hash_pandas_object(key_frame, index=False).to_numpy()
+
+def update_channel_rollup(agg, existing_rollup=None, existing_keys=None):
+    """
+    Incrementally roll the video aggregate `agg` into `existing_rollup`.
+
+    `existing_keys` is the sorted index of video keys the rollup was built
+    from. Videos whose key is missing from it are new or have new views;
+    only their channels are rolled up again, from their rows of `agg`.
+    Returns (rollup, keys), or (None, existing_keys) when nothing changed.
+    """
+    with stage("channel rollup", rows_in=len(agg)) as s:
+        keys = video_keys(agg)
+        if existing_rollup is None or existing_keys is None:
+            rollup = rollup_channels(agg)
+            s.rows_out = len(rollup)
+            return rollup, sorted_unique(keys)
+
+        changed = ~is_known(keys, existing_keys)
+        if not changed.any():
+            return None, existing_keys
+
+        # Recompute every channel touched by a changed video from all of its videos
+        channels = channel_key(agg)
+        affected = channels.isin(channels[changed].dropna().unique())
+        part = rollup_channels(agg[affected])
+        kept = existing_rollup[~existing_rollup['channel_key'].isin(part['channel_key'])]
+
+        rollup = pd.concat([kept, part], ignore_index=True)
+        year_cols = sorted(c for c in rollup.columns if c.isdigit())
+        rollup[year_cols] = rollup[year_cols].fillna(0).astype(np.int64)
+        rollup = rollup[[c for c in ROLLUP_COLUMNS if c in rollup.columns] + year_cols]
+        rollup.sort_values(by=['watches', 'channel_key'], ascending=[False, True], inplace=True, kind='stable')
+        rollup.reset_index(drop=True, inplace=True)
+        s.rows_out = len(rollup)
+    return rollup, sorted_unique(keys)